@@ -0,0 +1,123 @@
+"""
+媒体加密格式吞吐量基准：旧的 AES Crypt (pyAesCrypt) 格式 vs 分块 AES-GCM 容器格式。
+
+用法:
+    python -m benchmarks.media_container --size-mb 64 --small-files 200
+"""
+import argparse
+import io
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pyAesCrypt
+
+from telegram_logger.utils.file_encrypt import (
+    BUFFER_SIZE,
+    ChunkedDecryptingReader,
+    ChunkedEncryptingWriter,
+    DecryptingReader,
+    EncryptingWriter,
+    _master_key,
+)
+
+PASSWORD = "benchmark-password"
+
+
+def _timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def _write(writer_cls, path, payload):
+    writer = writer_cls(path, PASSWORD)
+    view = memoryview(payload)
+    for start in range(0, len(payload), 128 * 1024):  # iter_download 的默认块大小
+        writer.write(view[start:start + 128 * 1024])
+    writer.commit()
+
+
+def _read(reader_cls, path):
+    with reader_cls(path, PASSWORD) as reader:
+        while reader.read(512 * 1024):  # Telethon 上传的最大分片大小
+            pass
+
+
+def _read_parallel(path, workers):
+    with ChunkedDecryptingReader(path, PASSWORD) as reader:
+        with ThreadPoolExecutor(workers) as pool:
+            for _ in pool.map(reader.decrypt_chunk, range(reader.chunk_count)):
+                pass
+
+
+def _random_reads(reader_cls, path, size, count=200):
+    offsets = [int.from_bytes(os.urandom(4), "big") % max(size - 4096, 1) for _ in range(count)]
+    with reader_cls(path, PASSWORD) as reader:
+        for offset in offsets:
+            reader.seek(offset)
+            reader.read(4096)
+
+
+def _pyaescrypt_encrypt(path, payload):
+    with open(path, "wb") as f_out:
+        pyAesCrypt.encryptStream(io.BytesIO(payload), f_out, PASSWORD, bufferSize=BUFFER_SIZE)
+
+
+def _pyaescrypt_decrypt(path):
+    with open(path, "rb") as f_in:
+        pyAesCrypt.decryptStream(f_in, io.BytesIO(), PASSWORD, bufferSize=BUFFER_SIZE)
+
+
+def _report(label, seconds, size_mb=None, count=None):
+    if size_mb is not None:
+        print(f"{label:<42} {seconds:8.3f}s  {size_mb / seconds:8.1f} MB/s")
+    else:
+        print(f"{label:<42} {seconds:8.3f}s  {seconds / count * 1000:8.2f} ms/op")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=64, help="大文件测试的明文大小 (MB)")
+    parser.add_argument("--small-files", type=int, default=100, help="小文件（贴纸）测试的文件数")
+    parser.add_argument("--workers", type=int, default=4, help="并行解密的线程数")
+    args = parser.parse_args()
+
+    payload = os.urandom(args.size_mb * 1024 * 1024)
+    sticker = os.urandom(30 * 1024)
+    _master_key(PASSWORD)  # 每进程一次的主密钥派生不计入单文件开销
+
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy = os.path.join(tmp, "legacy")
+        container = os.path.join(tmp, "container")
+
+        print(f"大文件 ({args.size_mb} MB)")
+        _report("pyAesCrypt encryptStream", _timed(lambda: _pyaescrypt_encrypt(legacy, payload)), args.size_mb)
+        _report("pyAesCrypt decryptStream", _timed(lambda: _pyaescrypt_decrypt(legacy)), args.size_mb)
+        _report("legacy streaming write (EncryptingWriter)", _timed(lambda: _write(EncryptingWriter, legacy, payload)), args.size_mb)
+        _report("legacy streaming read (DecryptingReader)", _timed(lambda: _read(DecryptingReader, legacy)), args.size_mb)
+        _report("container write", _timed(lambda: _write(ChunkedEncryptingWriter, container, payload)), args.size_mb)
+        _report("container read", _timed(lambda: _read(ChunkedDecryptingReader, container)), args.size_mb)
+        _report(f"container parallel read ({args.workers} threads)",
+                _timed(lambda: _read_parallel(container, args.workers)), args.size_mb)
+
+        print("\n随机读取 (200 x 4KB)")
+        _report("legacy", _timed(lambda: _random_reads(DecryptingReader, legacy, len(payload))), count=200)
+        _report("container", _timed(lambda: _random_reads(ChunkedDecryptingReader, container, len(payload))), count=200)
+
+        print(f"\n小文件 ({args.small_files} x 30KB，每个文件写入并读回)")
+        for label, writer_cls, reader_cls in (
+            ("legacy", EncryptingWriter, DecryptingReader),
+            ("container", ChunkedEncryptingWriter, ChunkedDecryptingReader),
+        ):
+            def roundtrip():
+                for i in range(args.small_files):
+                    path = os.path.join(tmp, f"{label}_{i}")
+                    _write(writer_cls, path, sticker)
+                    _read(reader_cls, path)
+            _report(label, _timed(roundtrip), count=args.small_files)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import logging
+import threading
+from collections import OrderedDict, deque
+from dataclasses import replace
+from typing import Deque, Dict, List, Optional
+
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+# 每条消息除文本外的估算开销（字节），用于内存上限统计
+_ENTRY_OVERHEAD = 256
+
+
+def _estimate_size(message: Message) -> int:
+    return _ENTRY_OVERHEAD + len((message.msg_text or "").encode("utf-8")) + len(message.media_path or "")
+
+
+class _ChatBuffer:
+    """单个聊天的环形缓冲：deque 按到达顺序保存消息 ID，dict 保存每条消息的所有版本。"""
+
+    __slots__ = ("order", "versions", "size")
+
+    def __init__(self):
+        self.order: Deque[int] = deque()
+        self.versions: Dict[int, List[Message]] = {}
+        self.size = 0
+
+
+class HotMessageCache:
+    """
+    最近消息的内存热缓存。
+
+    删除事件、回复检查和受限媒体处理大多针对几秒到几分钟前的消息，
+    这些消息在保存时写入缓存，查找时无需访问 SQLite。
+
+    - 每个聊天最多保留 per_chat 条消息（按到达顺序淘汰最旧的）；
+    - 聊天按最近使用排序，总内存超过 max_bytes 时从最久未使用的聊天开始淘汰；
+    - 一条消息的所有版本一起缓存、一起淘汰，因此缓存命中时版本集合是完整的
+      （进程启动前保存的版本除外，见 DatabaseManager.get_message）。
+    """
+
+    def __init__(self, per_chat: int = 200, max_bytes: int = 32 * 1024 * 1024):
+        self.per_chat = max(0, per_chat)
+        self.max_bytes = max(0, max_bytes)
+        self._chats: "OrderedDict[int, _ChatBuffer]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._size = 0
+
+        # 统计信息
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.per_chat > 0 and self.max_bytes > 0
+
+    @property
+    def size(self) -> int:
+        """当前缓存占用的估算字节数。"""
+        return self._size
+
+    def put(self, message: Message):
+        """缓存一条消息（或已有消息的新版本）。"""
+        if not self.enabled:
+            return
+        entry_size = _estimate_size(message)
+        with self._lock:
+            buffer = self._chats.get(message.chat_id)
+            if buffer is None:
+                buffer = self._chats[message.chat_id] = _ChatBuffer()
+            else:
+                self._chats.move_to_end(message.chat_id)
+
+            versions = buffer.versions.get(message.id)
+            if versions is None:
+                buffer.versions[message.id] = [message]
+                buffer.order.append(message.id)
+            elif message in versions:
+                return  # 重复事件
+            else:
+                versions.append(message)
+            buffer.size += entry_size
+            self._size += entry_size
+
+            while len(buffer.order) > self.per_chat:
+                self._evict_oldest(buffer)
+            while self._size > self.max_bytes and self._chats:
+                lru_chat_id, lru_buffer = next(iter(self._chats.items()))
+                self._evict_oldest(lru_buffer)
+                if not lru_buffer.order:
+                    del self._chats[lru_chat_id]
+
+    def set_media_path(self, message: Message, media_path: str):
+        """回填已缓存版本的 media_path（按 edited_time 匹配版本），未缓存时忽略。"""
+        with self._lock:
+            buffer = self._chats.get(message.chat_id)
+            versions = buffer.versions.get(message.id) if buffer else None
+            if not versions:
+                return
+            for i, version in enumerate(versions):
+                if version.edited_time == message.edited_time:
+                    updated = replace(version, media_path=media_path)
+                    delta = _estimate_size(updated) - _estimate_size(version)
+                    versions[i] = updated
+                    buffer.size += delta
+                    self._size += delta
+
+    def _evict_oldest(self, buffer: _ChatBuffer):
+        msg_id = buffer.order.popleft()
+        for version in buffer.versions.pop(msg_id, []):
+            size = _estimate_size(version)
+            buffer.size -= size
+            self._size -= size
+        self.evictions += 1
+
+    def get(self, chat_id: int, message_id: int) -> Optional[List[Message]]:
+        """返回缓存中该消息的所有版本，未命中返回 None。"""
+        with self._lock:
+            buffer = self._chats.get(chat_id)
+            versions = buffer.versions.get(message_id) if buffer else None
+            if versions is None:
+                self.misses += 1
+                return None
+            self._chats.move_to_end(chat_id)
+            self.hits += 1
+            return list(versions)
+
+    def find_by_id(self, message_id: int) -> Optional[List[Message]]:
+        """在所有聊天中按消息 ID 查找（用于缺少 chat_id 的删除事件），最近使用的聊天优先。"""
+        with self._lock:
+            for buffer in reversed(self._chats.values()):
+                versions = buffer.versions.get(message_id)
+                if versions is not None:
+                    self.hits += 1
+                    return list(versions)
+            self.misses += 1
+            return None
+
+    def clear(self):
+        """清空缓存（例如过期清理删除了数据库中的消息之后）。"""
+        with self._lock:
+            self._chats.clear()
+            self._size = 0
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "evictions": self.evictions,
+            "chats": len(self._chats),
+            "bytes": self._size,
+        }
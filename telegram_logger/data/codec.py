@@ -0,0 +1,171 @@
+import difflib
+import json
+import logging
+import sqlite3
+import zlib
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+# messages 表中 edited_time 为 0 表示原始（未编辑）消息
+ORIGINAL_EDITED_TIME = 0
+
+
+def datetime_to_epoch(value: Optional[datetime]) -> int:
+    """将 datetime 编码为整数 Unix 时间戳（秒）。None 编码为 0。
+
+    无时区信息的 datetime 按本地时间处理（与 datetime.timestamp() 一致）。
+    """
+    if value is None:
+        return ORIGINAL_EDITED_TIME
+    return int(value.timestamp())
+
+
+def epoch_to_datetime(value: Optional[int]) -> Optional[datetime]:
+    """将整数 Unix 时间戳解码为 UTC datetime。0 或 None 解码为 None。"""
+    if not value:
+        return None
+    return datetime.fromtimestamp(value, tz=timezone.utc)
+
+
+# --- 消息文本编码 ---
+#
+# messages.text_codec 决定文本的存储方式：
+#   TEXT_PLAIN  文本原样存放在 msg_text；
+#   TEXT_ZLIB   zlib 压缩后存放在 text_blob（超过阈值的长文本）；
+#   TEXT_DELTA  相对基准版本（edited_time = text_base）的差量，压缩后存放在 text_blob。
+# 差量链每 DELTA_KEYFRAME_INTERVAL 个版本插入一个完整版本（关键帧），限制解码时回溯的深度。
+TEXT_PLAIN = 0
+TEXT_ZLIB = 1
+TEXT_DELTA = 2
+
+TEXT_COMPRESS_THRESHOLD = 256  # 字节，短文本压缩收益不足以抵消开销
+DELTA_KEYFRAME_INTERVAL = 16
+
+
+def make_delta(base: str, text: str) -> bytes:
+    """生成从 base 到 text 的差量：[起, 止] 表示复制 base 片段，字符串表示插入的文本。"""
+    # 编辑通常只改动局部：先去掉公共前后缀，只对中间部分做序列比对
+    limit = min(len(base), len(text))
+    prefix = 0
+    while prefix < limit and base[prefix] == text[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and base[-1 - suffix] == text[-1 - suffix]:
+        suffix += 1
+
+    ops: List[Union[List[int], str]] = []
+    if prefix:
+        ops.append([0, prefix])
+    base_mid = base[prefix:len(base) - suffix]
+    text_mid = text[prefix:len(text) - suffix]
+    if base_mid and text_mid:
+        matcher = difflib.SequenceMatcher(None, base_mid, text_mid)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == "equal":
+                ops.append([prefix + i1, prefix + i2])
+            elif tag in ("replace", "insert"):
+                ops.append(text_mid[j1:j2])
+            # delete: 基准中的片段不再出现，无需记录
+    elif text_mid:
+        ops.append(text_mid)
+    if suffix:
+        ops.append([len(base) - suffix, len(base)])
+    return zlib.compress(json.dumps(ops, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+
+def apply_delta(base: str, delta: bytes) -> str:
+    """将 make_delta 生成的差量应用到 base 上，还原目标文本。"""
+    parts = []
+    for op in json.loads(zlib.decompress(delta).decode("utf-8")):
+        parts.append(base[op[0]:op[1]] if isinstance(op, list) else op)
+    return "".join(parts)
+
+
+def encode_text(
+    text: Optional[str], base: Optional[str] = None, depth: int = 0
+) -> Tuple[int, Optional[str], Optional[bytes]]:
+    """
+    为消息文本选择最紧凑的存储方式。
+
+    Args:
+        text: 要存储的文本。
+        base: 上一版本的文本，None 表示没有可用的基准版本。
+        depth: 基准版本距离最近关键帧的差量层数。
+
+    Returns:
+        (text_codec, msg_text, text_blob)
+    """
+    if not text:
+        return TEXT_PLAIN, text, None
+    best = (TEXT_PLAIN, text, None)
+    best_size = len(text.encode("utf-8"))
+    if best_size >= TEXT_COMPRESS_THRESHOLD:
+        compressed = zlib.compress(text.encode("utf-8"))
+        if len(compressed) < best_size:
+            best, best_size = (TEXT_ZLIB, None, compressed), len(compressed)
+    if base and depth < DELTA_KEYFRAME_INTERVAL - 1:
+        delta = make_delta(base, text)
+        if len(delta) < best_size:
+            best = (TEXT_DELTA, None, delta)
+    return best
+
+
+def _row_field(row, key: str, default=None):
+    # 兼容迁移前（没有编码列）的行
+    return row[key] if key in row.keys() else default
+
+
+def load_text(
+    conn: sqlite3.Connection, chat_id: int, message_id: int, edited_time: int, table: str = "messages"
+) -> Tuple[Optional[str], int]:
+    """
+    读取指定版本的文本，沿 text_base 回溯到关键帧后依次应用差量。
+    同一消息的所有版本位于同一张表（分区）中。
+
+    Returns:
+        (文本, 该版本距离关键帧的差量层数)；版本不存在时文本为 None。
+    """
+    chain = []
+    current = edited_time
+    while True:
+        row = conn.execute(
+            f"SELECT msg_text, text_codec, text_blob, text_base FROM {table} "
+            "WHERE chat_id = ? AND id = ? AND edited_time = ?",
+            (chat_id, message_id, current),
+        ).fetchone()
+        if row is None:
+            return None, 0
+        chain.append(row)
+        if row["text_codec"] != TEXT_DELTA or len(chain) > DELTA_KEYFRAME_INTERVAL:
+            break
+        current = row["text_base"]
+
+    keyframe = chain.pop()
+    if keyframe["text_codec"] == TEXT_DELTA:
+        logger.error(f"消息 {chat_id}/{message_id} 的差量链过长或已损坏，无法还原文本。")
+        return None, 0
+    text = decode_text(keyframe["text_codec"], keyframe["msg_text"], keyframe["text_blob"])
+    depth = len(chain)
+    for row in reversed(chain):
+        text = apply_delta(text or "", row["text_blob"])
+    return text, depth
+
+
+def decode_text(codec: int, msg_text: Optional[str], blob: Optional[bytes], base: Optional[str] = None) -> Optional[str]:
+    """按 text_codec 还原文本。TEXT_DELTA 需要提供基准版本文本。"""
+    if codec == TEXT_ZLIB:
+        return zlib.decompress(blob).decode("utf-8")
+    if codec == TEXT_DELTA:
+        return apply_delta(base or "", blob)
+    return msg_text
+
+
+def row_text(conn: sqlite3.Connection, row, table: str = "messages") -> Optional[str]:
+    """还原消息行的文本，差量行会从 conn 的同一张表中读取其基准版本。"""
+    codec = _row_field(row, "text_codec", TEXT_PLAIN)
+    if codec == TEXT_DELTA:
+        base, _ = load_text(conn, row["chat_id"], row["id"], row["text_base"], table)
+        return decode_text(codec, None, row["text_blob"], base)
+    return decode_text(codec, row["msg_text"], _row_field(row, "text_blob"))
@@ -1,30 +1,81 @@
+import asyncio
 import sqlite3
 import os
+import time
 import logging
-import asyncio
 import json
 from pathlib import Path
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Any
-from .models import Message
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional, Any, Tuple, TypeVar
+from .cache import HotMessageCache
+from .entity_cache import EntityCache
+from .codec import datetime_to_epoch, epoch_to_datetime, row_text
+from .ingest import MessageIngestQueue
+from .migrations import has_fulltext_index, run_migrations
+from .models import ExpiryStats, Message
+from .partitions import BASE_TABLE, MessagePartitionRouter, fts_table
+from .persistence_signals import PersistenceSignals
+from .restriction_cache import ChatRestrictionCache
+from .pool import SQLiteConnectionPool
+
+T = TypeVar("T")
 
 logger = logging.getLogger(__name__)
 
 class DatabaseManager:
-    def __init__(self, db_path: str = "db/messages.db"):
+    def __init__(
+        self,
+        db_path: str = "db/messages.db",
+        ingest_batch_size: int = 200,
+        ingest_flush_interval: float = 0.2,
+        reader_connections: int = 4,
+        partition_period: str = "none",
+        hot_cache_per_chat: int = 200,
+        hot_cache_max_bytes: int = 32 * 1024 * 1024,
+        entity_cache_ttl: int = 86400,
+        entity_cache_size: int = 10000,
+    ):
         self.db_path = db_path
-        self.conn = self._init_db()
-        self.conn.row_factory = sqlite3.Row
-
-    def _init_db(self):
-        """Initialize database connection and create tables"""
-        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
-        conn = sqlite3.connect(self.db_path)
-        self._create_tables(conn)
-        return conn
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        # 长连接池：单个写连接 + 多个读连接，均运行在专用执行器线程上。
+        # 新数据库使用增量 auto_vacuum，删除分区后可以归还磁盘空间
+        self.pool = SQLiteConnectionPool(
+            self.db_path, reader_count=reader_connections, auto_vacuum="INCREMENTAL"
+        )
+        self.pool.write_sync(self._create_tables)
+        self.fts_enabled = self.pool.read_sync(has_fulltext_index)
+        if not self.fts_enabled:
+            logger.warning("全文索引不可用，消息搜索将逐行匹配。")
+        # 分区路由：未启用分区时所有消息都在 messages 表中
+        self.partitions = MessagePartitionRouter(partition_period, with_fts=self.fts_enabled)
+        self.pool.read_sync(self.partitions.load)
+        # 消息写入走专用写线程批量提交，见 MessageIngestQueue
+        self.ingest_queue = MessageIngestQueue(
+            execute_write=self.pool.write_sync,
+            batch_size=ingest_batch_size,
+            flush_interval=ingest_flush_interval,
+            index_text=self.fts_enabled,
+            router=self.partitions,
+        )
+        self.ingest_queue.start()
+        # 最近消息的内存热缓存，常见的近期消息查找无需访问 SQLite
+        self.hot_cache = HotMessageCache(per_chat=hot_cache_per_chat, max_bytes=hot_cache_max_bytes)
+        # 用户/群组/频道显示信息缓存，提及渲染通常无需调用 Telegram API
+        self.entity_cache = EntityCache(self.pool, ttl=entity_cache_ttl, max_entries=entity_cache_size)
+        # 消息持久化完成通知，读取刚收到的消息时等待通知而不是轮询
+        self.persistence_signals = PersistenceSignals()
+        # 聊天 noforwards 状态缓存，由事件携带的实体填充，聊天更新时刷新
+        self.chat_restrictions = ChatRestrictionCache()
+        # 去重媒体占用的字节数，启动时统计一次，之后随登记和删除增减（只在写线程上修改）。
+        # 写事务中的变化先累计在 _media_bytes_delta，提交成功后才计入，见 _media_write
+        self._media_bytes_delta = 0
+        self.media_bytes = self.pool.read_sync(
+            lambda conn: conn.execute(f"SELECT COALESCE(SUM({self._BLOB_STORED_BYTES}), 0) FROM media_blobs").fetchone()[0]
+        )
 
     def _create_tables(self, conn):
         """Create database schema"""
+        # 基线（版本 0）结构；之后的结构变更由 migrations.py 按 user_version 依次应用
         conn.execute("""
             CREATE TABLE IF NOT EXISTS messages (
                 id INTEGER,
@@ -40,10 +91,24 @@ class DatabaseManager:
                 PRIMARY KEY (chat_id, id, edited_time)
             )
         """)
+        conn.commit()
+        run_migrations(conn)
+
         conn.execute("""
             CREATE INDEX IF NOT EXISTS idx_msg_created 
             ON messages (created_time DESC)
         """)
+        # 按 (chat_id, id) 的精确查找由主键索引 (chat_id, id, edited_time) 服务；
+        # 此索引用于缺少 chat_id 的查找（例如私聊删除事件）
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_msg_id
+            ON messages (id, created_time, edited_time)
+        """)
+        # 过期清理按 (type, created_time < cutoff) 做范围扫描
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_msg_type_created
+            ON messages (type, created_time)
+        """)
 
         # --- 新增用户机器人配置表 ---
         conn.execute("""
@@ -80,54 +145,253 @@ class DatabaseManager:
         """)
         # --- 新增表结束 ---
 
-        conn.commit()
-
     def save_message(self, message: Message):
-        """Save message to database"""
+        """将消息放入写后批量写入队列，由写线程异步落盘，同时写入热缓存。"""
         try:
-            params = (
-                message.id,
-                message.from_id,
-                message.chat_id,
-                message.msg_type,
-                message.msg_text,
-                message.media_path,
-                int(message.noforwards),
-                int(message.self_destructing),
-                message.created_time,
-                message.edited_time
-            )
-            self.conn.execute(
-                "INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                params
-            )
-            self.conn.commit()
-            logger.debug(f"Message saved: MsgID={message.id} ChatID={message.chat_id}")
-        except sqlite3.IntegrityError:
-            logger.warning(f"Duplicate message ignored: MsgID={message.id} ChatID={message.chat_id}")
-            self.conn.rollback()
-        except sqlite3.Error as e: # More specific catch
-            logger.error(f"保存消息时数据库出错 (MsgID={message.id} ChatID={message.chat_id}): {e}", exc_info=True)
-            self.conn.rollback()
+            self.ingest_queue.put(message)
+            self.hot_cache.put(message)
+            logger.debug(f"Message queued: MsgID={message.id} ChatID={message.chat_id}")
+        except Exception as e:
+            logger.error(f"消息入队时发生意外错误 (MsgID={message.id} ChatID={message.chat_id}): {e}", exc_info=True)
+
+    def set_media_path(self, message: Message, media_path: str):
+        """回填消息的 media_path（媒体在消息入队后由后台下载完成），经写入队列在该消息写入之后执行。"""
+        try:
+            self.ingest_queue.put_media_path(message, media_path)
+            self.hot_cache.set_media_path(message, media_path)
         except Exception as e:
-            logger.error(f"保存消息时发生意外错误 (MsgID={message.id} ChatID={message.chat_id}): {e}", exc_info=True)
-            self.conn.rollback() # Ensure rollback on any exception
+            logger.error(f"回填媒体路径时发生意外错误 (MsgID={message.id} ChatID={message.chat_id}): {e}", exc_info=True)
+
+    def flush_ingest_queue(self, timeout: Optional[float] = 10.0) -> bool:
+        """阻塞直到已入队的消息全部提交，用于关闭前或需要强一致读取的场景。"""
+        flushed = self.ingest_queue.flush(timeout)
+        if not flushed:
+            logger.warning(f"刷新消息写入队列超时 ({timeout} 秒)，剩余约 {self.ingest_queue.depth} 条。")
+        return flushed
+
+    # get_message 支持的版本选择
+    MESSAGE_VERSIONS = ('original', 'latest')
+
+    def get_message(self, chat_id: int, message_id: int, version: str = 'original') -> Optional[Message]:
+        """按 (chat_id, id) 精确检索消息。会阻塞调用线程，事件循环中应使用 get_message_async。
+
+        Args:
+            chat_id: 消息所在聊天 ID。
+            message_id: 消息 ID。
+            version: 'original' 返回原始消息，'latest' 返回最近一次编辑后的版本。
+
+        Returns:
+            Optional[Message]: 找到的消息，未找到或出错时返回 None。
+        """
+        cached, query = self._message_lookup(chat_id, message_id, version)
+        if cached:
+            return cached
+        try:
+            message = self.pool.read_sync(query)
+        except sqlite3.Error as e:
+            logger.error(f"从数据库检索消息 (ChatID={chat_id}, MsgID={message_id}) 时出错: {e}", exc_info=True)
+            return None
+        return self._merge_pending_version(message, chat_id, message_id, version)
+
+    async def get_message_async(
+        self, chat_id: int, message_id: int, version: str = 'original'
+    ) -> Optional[Message]:
+        """get_message 的异步版本，查询在读连接线程上执行，不阻塞事件循环。"""
+        cached, query = self._message_lookup(chat_id, message_id, version)
+        if cached:
+            return cached
+        try:
+            message = await self.pool.read(query)
+        except sqlite3.Error as e:
+            logger.error(f"从数据库检索消息 (ChatID={chat_id}, MsgID={message_id}) 时出错: {e}", exc_info=True)
+            return None
+        return self._merge_pending_version(message, chat_id, message_id, version)
+
+    def _message_lookup(self, chat_id: int, message_id: int, version: str):
+        """返回 (热缓存命中的消息, 数据库查询函数)；缓存命中时无需查询。"""
+        if version not in self.MESSAGE_VERSIONS:
+            raise ValueError(f"无效的消息版本: {version}，可选值: {self.MESSAGE_VERSIONS}")
+        cached = self._cached_versions(self.hot_cache.get(chat_id, message_id), version)
+        if cached:
+            return self._pick_version(cached, version), None
+
+        # 原始消息的 edited_time 为 0，升序时排在最前；降序时最新编辑排在最前
+        order = "ASC" if version == 'original' else "DESC"
+
+        def _sync_get(conn: sqlite3.Connection) -> Optional[Message]:
+            # 命中主键索引 (chat_id, id, edited_time)，无需扫描全表。
+            # 同一消息的所有版本位于同一张表，只查找 ID 范围包含它的分区，从最新的开始，命中即止
+            for table in self.partitions.tables_for_ids([message_id], chat_id):
+                cursor = conn.execute(
+                    f"SELECT * FROM {table} WHERE chat_id = ? AND id = ? ORDER BY edited_time {order} LIMIT 1",
+                    (chat_id, message_id)
+                )
+                row = cursor.fetchone()
+                if row:
+                    return self._row_to_message(row, conn, table)
+            return None
+
+        return None, _sync_get
+
+    def _merge_pending_version(
+        self, message: Optional[Message], chat_id: int, message_id: int, version: str
+    ) -> Optional[Message]:
+        candidates = [message] if message else []
+        # 合并尚未落盘的版本，保证刚保存的消息（或编辑）可以立即读到
+        candidates.extend(self.ingest_queue.find_pending(message_id, chat_id))
+        if not candidates:
+            logger.debug(f"在数据库中未找到消息: ChatID={chat_id}, MsgID={message_id}")
+            return None
+        return self._pick_version(candidates, version)
+
+    @staticmethod
+    def _cached_versions(versions: Optional[List[Message]], version: str) -> Optional[List[Message]]:
+        """
+        判断热缓存中的版本集合能否直接回答查询。
+
+        缓存只包含本进程保存的版本：最新版本总在缓存中，
+        但原始消息可能是进程启动前保存的，此时需回落到数据库。
+        """
+        if not versions:
+            return None
+        if version == 'original' and not any(m.edited_time is None for m in versions):
+            return None
+        return versions
+
+    @staticmethod
+    def _pick_version(candidates: List[Message], version: str) -> Message:
+        """从同一消息的多个版本中选出原始版本或最新版本。"""
+        originals = [m for m in candidates if m.edited_time is None]
+        if version == 'original':
+            return originals[0] if originals else min(candidates, key=lambda m: m.edited_time)
+        edits = [m for m in candidates if m.edited_time is not None]
+        return max(edits, key=lambda m: m.edited_time) if edits else originals[0]
 
     def get_message_by_id(self, message_id: int) -> Optional[Message]:
-        """根据消息 ID 从数据库检索消息。"""
+        """根据消息 ID 从数据库检索消息。会阻塞调用线程，事件循环中应使用 get_message_by_id_async。
+
+        仅用于事件缺少 chat_id 的场景（例如私聊删除事件）；
+        不同聊天可能存在相同的消息 ID，已知 chat_id 时应使用 get_message()。
+        """
+        cached = self._cached_versions(self.hot_cache.find_by_id(message_id), 'original')
+        if cached:
+            return self._pick_version(cached, 'original')
         try:
-            cursor = self.conn.cursor()
-            # 获取与该消息 ID 关联的最早记录（通常是原始消息）
-            cursor.execute("SELECT * FROM messages WHERE id = ? ORDER BY created_time ASC LIMIT 1", (message_id,))
-            row = cursor.fetchone()
-            if row:
-                return self._row_to_message(row)
-            else:
-                logger.debug(f"在数据库中未找到消息 ID: {message_id}")
-                return None
+            message = self.pool.read_sync(self._sync_get_message_by_id(message_id))
+        except sqlite3.Error as e:
+            logger.error(f"从数据库检索消息 ID {message_id} 时出错: {e}", exc_info=True)
+            return None
+        return message or self._pending_original(message_id)
+
+    async def get_message_by_id_async(self, message_id: int) -> Optional[Message]:
+        """get_message_by_id 的异步版本，查询在读连接线程上执行，不阻塞事件循环。"""
+        cached = self._cached_versions(self.hot_cache.find_by_id(message_id), 'original')
+        if cached:
+            return self._pick_version(cached, 'original')
+        try:
+            message = await self.pool.read(self._sync_get_message_by_id(message_id))
         except sqlite3.Error as e:
             logger.error(f"从数据库检索消息 ID {message_id} 时出错: {e}", exc_info=True)
             return None
+        return message or self._pending_original(message_id)
+
+    def _sync_get_message_by_id(self, message_id: int):
+        def _sync_get(conn: sqlite3.Connection) -> Optional[Message]:
+            # 获取与该消息 ID 关联的最早记录（通常是原始消息），由 (id, created_time, edited_time) 索引服务
+            for table in self.partitions.tables_for_ids([message_id]):
+                cursor = conn.execute(
+                    f"SELECT * FROM {table} WHERE id = ? ORDER BY created_time ASC, edited_time ASC LIMIT 1",
+                    (message_id,)
+                )
+                row = cursor.fetchone()
+                if row:
+                    return self._row_to_message(row, conn, table)
+            return None
+
+        return _sync_get
+
+    def _pending_original(self, message_id: int) -> Optional[Message]:
+        # 数据库未命中时检查尚未落盘的消息，保证刚保存的消息可以立即读到
+        pending = self.ingest_queue.find_pending(message_id)
+        if pending:
+            return self._pick_version(pending, 'original')
+        logger.debug(f"在数据库中未找到消息 ID: {message_id}")
+        return None
+
+    # 单条 SQL 中 IN 列表的最大参数数量，避免超过 SQLite 变量上限
+    BULK_LOOKUP_CHUNK = 500
+
+    async def get_messages_bulk(
+        self, chat_id: Optional[int], message_ids: List[int]
+    ) -> Dict[int, Message]:
+        """批量检索多条消息的原始版本，一次索引查询解析整个删除事件。
+
+        Args:
+            chat_id: 消息所在聊天 ID；为 None 时（私聊删除事件）按 id 索引查找。
+            message_ids: 要检索的消息 ID 列表。
+
+        Returns:
+            Dict[int, Message]: 消息 ID 到原始消息的映射，未找到的 ID 不在结果中。
+        """
+        ids = list(dict.fromkeys(message_ids))  # 去重并保持顺序
+        if not ids:
+            return {}
+
+        # 先从热缓存解析，剩余的 ID 再查询数据库
+        found: Dict[int, Message] = {}
+        for msg_id in ids:
+            versions = (
+                self.hot_cache.get(chat_id, msg_id) if chat_id is not None
+                else self.hot_cache.find_by_id(msg_id)
+            )
+            cached = self._cached_versions(versions, 'original')
+            if cached:
+                found[msg_id] = self._pick_version(cached, 'original')
+        ids = [msg_id for msg_id in ids if msg_id not in found]
+        if not ids:
+            return found
+
+        def _sync_get(conn: sqlite3.Connection) -> Dict[int, Message]:
+            found: Dict[int, Message] = {}
+            for table in self.partitions.tables_for_ids(ids, chat_id):
+                # 只在后续（更早的）分区中查找尚未命中的 ID
+                remaining = [msg_id for msg_id in ids if msg_id not in found]
+                if not remaining:
+                    break
+                for start in range(0, len(remaining), self.BULK_LOOKUP_CHUNK):
+                    chunk = remaining[start:start + self.BULK_LOOKUP_CHUNK]
+                    placeholders = ','.join('?' * len(chunk))
+                    if chat_id is not None:
+                        # 主键索引 (chat_id, id, edited_time)：每个 id 的第一行即原始消息
+                        query = (
+                            f"SELECT * FROM {table} WHERE chat_id = ? AND id IN ({placeholders}) "
+                            f"ORDER BY id, edited_time ASC"
+                        )
+                        params = [chat_id, *chunk]
+                    else:
+                        # (id, created_time, edited_time) 索引
+                        query = (
+                            f"SELECT * FROM {table} WHERE id IN ({placeholders}) "
+                            f"ORDER BY id, created_time ASC, edited_time ASC"
+                        )
+                        params = chunk
+                    for row in conn.execute(query, params):
+                        if row['id'] not in found:
+                            found[row['id']] = self._row_to_message(row, conn, table)
+            return found
+
+        try:
+            found.update(await self.pool.read(_sync_get))
+        except sqlite3.Error as e:
+            logger.error(f"批量检索消息时数据库出错 (ChatID={chat_id}, IDs={ids}): {e}", exc_info=True)
+
+        # 补充尚未落盘的消息
+        for msg_id in ids:
+            if msg_id not in found:
+                pending = self.ingest_queue.find_pending(msg_id, chat_id)
+                if pending:
+                    found[msg_id] = self._pick_version(pending, 'original')
+        return found
 
     def get_messages(
         self, 
@@ -136,136 +400,625 @@ class DatabaseManager:
         limit: int = 100
     ) -> List[Message]:
         """Get latest versions of messages by IDs"""
+        def _sync_get(conn: sqlite3.Connection) -> List[Message]:
+            messages = []
+            for table in self.partitions.tables_for_ids(message_ids, chat_id):
+                query = f"""
+                    SELECT * FROM (
+                        SELECT * FROM {table}
+                    WHERE chat_id = ? AND id IN ({','.join('?'*len(message_ids))}) 
+                    ORDER BY edited_time DESC LIMIT ?
+                ) GROUP BY chat_id, id 
+                    ORDER BY created_time ASC
+                """
+                params = [chat_id, *message_ids, limit]
+                messages.extend(self._row_to_message(row, conn, table) for row in conn.execute(query, params))
+            messages.sort(key=lambda m: m.created_time)
+            return messages[:limit]
+
         messages = []
         try:
-            query = f"""
-                SELECT * FROM (
-                    SELECT * FROM messages 
-                WHERE chat_id = ? AND id IN ({','.join('?'*len(message_ids))}) 
-                ORDER BY edited_time DESC LIMIT ?
-            ) GROUP BY chat_id, id 
-                ORDER BY created_time ASC
-            """
-            params = [chat_id, *message_ids, limit]
-            cursor = self.conn.execute(query, params)
-            messages = [self._row_to_message(row) for row in cursor]
+            messages = self.pool.read_sync(_sync_get)
         except sqlite3.Error as e:
             logger.error(f"获取消息列表时数据库出错 (ChatID={chat_id}, IDs={message_ids}): {e}", exc_info=True)
             # Return empty list on error
         return messages
 
-    def delete_expired_messages(
-        self, 
-        persist_times: Dict[str, int]
-    ) -> int:
-        """Delete expired messages by type and their associated media files"""
-        now = datetime.now()
-        conditions = []
-        params = []
-        media_paths_to_delete = set() # 使用集合存储待删除的媒体路径
-        
-        # 1. 收集所有过期消息的媒体路径，并构建删除条件
+    # trigram 分词器只能匹配至少 3 个字符的词
+    FTS_MIN_TERM_LENGTH = 3
+
+    async def search_messages(
+        self,
+        query: str,
+        chat_id: Optional[int] = None,
+        since: Optional[datetime] = None,
+        limit: int = 10,
+        offset: int = 0,
+    ) -> List[Message]:
+        """
+        全文搜索已记录的消息，按创建时间倒序返回；同一消息的多个版本只返回最新的匹配版本。
+
+        查询按空白拆分为多个词，所有词都需匹配（不区分大小写的子串匹配）。
+        所有词都不少于 3 个字符时使用全文索引，否则退回逐行匹配。
+
+        Args:
+            query: 搜索词。
+            chat_id: 只搜索指定聊天，None 表示所有聊天。
+            since: 只搜索此时间之后创建的消息。
+            limit: 每页数量。
+            offset: 跳过的结果数量（分页）。
+        """
+        terms = query.split()
+        if not terms:
+            return []
+        filters = []
+        params: List[Any] = []
+        if chat_id is not None:
+            filters.append("m.chat_id = ?")
+            params.append(chat_id)
+        if since is not None:
+            filters.append("m.created_time >= ?")
+            params.append(datetime_to_epoch(since))
+        use_fts = self.fts_enabled and all(len(t) >= self.FTS_MIN_TERM_LENGTH for t in terms)
+
+        # 各表分别取前 offset + limit 条，合并排序后再分页
+        wanted = offset + limit
+
+        def _search_table_fts(conn: sqlite3.Connection, table: str) -> List[Message]:
+            # 每个词作为一个短语（双引号内的引号需要转义），多个短语之间为 AND
+            match = " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+            fts = fts_table(table)
+            where = " AND ".join([f"{fts} MATCH ?", *filters])
+            rows = conn.execute(
+                f"""
+                SELECT m.*, MAX(m.edited_time) FROM {fts}
+                JOIN {table} m ON m.msg_rowid = {fts}.rowid
+                WHERE {where}
+                GROUP BY m.chat_id, m.id
+                ORDER BY m.created_time DESC, m.id DESC
+                LIMIT ?
+                """,
+                [match, *params, wanted],
+            ).fetchall()
+            return [self._row_to_message(row, conn, table) for row in rows]
+
+        def _search_table_scan(conn: sqlite3.Connection, table: str) -> List[Message]:
+            # 压缩/差量存储的文本无法在 SQL 中匹配，逐行还原后在 Python 中过滤
+            where = " AND ".join(filters) if filters else "1"
+            lowered = [term.lower() for term in terms]
+            results: List[Message] = []
+            seen = set()
+            cursor = conn.execute(
+                f"SELECT m.* FROM {table} m WHERE {where} "
+                f"ORDER BY m.created_time DESC, m.id DESC, m.edited_time DESC",
+                params,
+            )
+            for row in cursor:
+                key = (row['chat_id'], row['id'])
+                if key in seen:
+                    continue
+                message = self._row_to_message(row, conn, table)
+                text = (message.msg_text or "").lower()
+                if not all(term in text for term in lowered):
+                    continue
+                seen.add(key)
+                results.append(message)
+                if len(results) >= wanted:
+                    break
+            return results
+
+        def _sync_search(conn: sqlite3.Connection) -> List[Message]:
+            search_table = _search_table_fts if use_fts else _search_table_scan
+            results: List[Message] = []
+            for table in self.partitions.tables(since=since):
+                results.extend(search_table(conn, table))
+            results.sort(key=lambda m: (m.created_time, m.id), reverse=True)
+            return results[offset:offset + limit]
+
+        try:
+            return await self.pool.read(_sync_search)
+        except sqlite3.Error as e:
+            logger.error(f"搜索消息时数据库出错 (query={query!r}, ChatID={chat_id}): {e}", exc_info=True)
+            return []
+
+    # 去重媒体文件引用计数归零后保留的宽限期（秒），期间再次出现的相同媒体仍可直接复用
+    MEDIA_BLOB_GRACE_SECONDS = 3600
+    # 媒体在磁盘上占用的字节数：打包存储为记录长度，单独保存的文件以明文大小近似
+    _BLOB_STORED_BYTES = "COALESCE(pack_length, size)"
+
+    async def delete_expired_messages(
+        self,
+        persist_times: Dict[str, int],
+        batch_size: int = 1000,
+        pause: float = 0.05,
+    ) -> ExpiryStats:
+        """
+        删除过期消息及其关联的媒体文件。
+
+        分区模式下，所有类型的消息都已过期的分区整表删除；
+        其余过期消息按类型分批删除，每批最多 batch_size 行，在写线程上以独立的短事务执行，
+        由 (type, created_time) 索引服务；媒体文件在工作线程中删除。
+        去重媒体文件被多条消息共享，只有最后一个引用过期（并超过宽限期）后才删除。
+        批次之间让出 pause 秒，避免长时间占用写连接阻塞消息写入。
+        """
+        stats = ExpiryStats()
+        started = time.monotonic()
+        now = datetime.now(timezone.utc)
+        batch_size = max(1, batch_size)
+        type_names = {value: name for name, value in self.MSG_TYPE_MAP.items()}
+
+        cutoffs: Dict[str, datetime] = {}
         for persist_type, days in persist_times.items():
             if persist_type not in self.MSG_TYPE_MAP:
                 logger.warning(f"未知的消息类型: {persist_type}")
                 continue
-            
-            cutoff = now - timedelta(days=days)
+            cutoffs[persist_type] = now - timedelta(days=days)
+
+        # 1. 整表删除完全过期的分区（分区中可能包含任意类型的消息，以保留最久的类型为准）
+        if self.partitions.enabled and cutoffs:
+            for partition in self.partitions.expired(min(cutoffs.values())):
+                try:
+                    counts, media_paths = await self.pool.write(self._sync_drop_partition, partition)
+                except sqlite3.Error as e:
+                    logger.error(f"删除过期分区 {partition.name} 时出错: {e}", exc_info=True)
+                    continue
+                stats.dropped_partitions += 1
+                for type_val, count in counts.items():
+                    name = type_names.get(type_val, str(type_val))
+                    stats.rows_by_type[name] = stats.rows_by_type.get(name, 0) + count
+                    stats.deleted_rows += count
+                if media_paths:
+                    await asyncio.to_thread(self._delete_media_files, media_paths, stats)
+                logger.info(f"已删除过期分区 {partition.name} ({sum(counts.values())} 条消息)")
+            if stats.dropped_partitions:
+                await self.pool.write(self._sync_incremental_vacuum)
+
+        # 2. 逐表按类型分批删除剩余的过期消息
+        for persist_type, cutoff in cutoffs.items():
             type_val = self.MSG_TYPE_MAP[persist_type]
-            
-            # 添加数据库删除条件
-            conditions.append("(type = ? AND created_time < ?)")
-            params.extend([type_val, cutoff])
+            type_rows = 0
+            for table in self.partitions.tables():
+                while True:
+                    try:
+                        deleted, media_paths = await self.pool.write(
+                            self._sync_delete_batch, table, type_val, datetime_to_epoch(cutoff), batch_size
+                        )
+                    except sqlite3.Error as e:
+                        # 回滚由连接池负责，已提交的批次保持有效
+                        logger.error(f"删除过期数据库记录时出错 (类型={persist_type}, 表={table}): {e}", exc_info=True)
+                        break
+                    if not deleted:
+                        break
+
+                    stats.batches += 1
+                    stats.deleted_rows += deleted
+                    type_rows += deleted
+                    if media_paths:
+                        await asyncio.to_thread(self._delete_media_files, media_paths, stats)
+                    logger.debug(
+                        f"过期清理进度: 类型={persist_type} 表={table} 本批 {deleted} 行，"
+                        f"累计 {stats.deleted_rows} 行，{stats.deleted_files} 个文件"
+                    )
+                    if deleted < batch_size:
+                        break
+                    await asyncio.sleep(pause)  # 让出写连接给消息写入
+            if type_rows:
+                stats.rows_by_type[persist_type] = stats.rows_by_type.get(persist_type, 0) + type_rows
+
+        # 3. 删除已无引用、且超过宽限期未被再次使用的去重媒体文件
+        try:
+            unused_paths = await self.pool.write(
+                self._media_write(self._sync_collect_unused_blobs),
+                datetime_to_epoch(now) - self.MEDIA_BLOB_GRACE_SECONDS,
+            )
+        except sqlite3.Error as e:
+            logger.error(f"清理无引用的媒体文件时出错: {e}", exc_info=True)
+            unused_paths = []
+        if unused_paths:
+            await asyncio.to_thread(self._delete_media_files, unused_paths, stats)
+
+        if stats.deleted_rows:
+            # 缓存中可能有刚被删除的消息（例如保留时间很短时）
+            self.hot_cache.clear()
+        stats.elapsed = time.monotonic() - started
+        logger.info(
+            f"清理完成。数据库删除 {stats.deleted_rows} 条记录 ({stats.batches} 批，"
+            f"{stats.dropped_partitions} 个分区)，文件系统删除 {stats.deleted_files} 个文件，"
+            f"缺失 {stats.missing_files} 个，失败 {stats.failed_files} 个，耗时 {stats.elapsed:.2f}s。"
+        )
+        return stats
+
+    def _sync_delete_batch(
+        self, conn: sqlite3.Connection, table: str, type_val: int, cutoff_epoch: int, batch_size: int
+    ) -> tuple:
+        """删除 table 中一批 created_time 早于 cutoff_epoch 的 type_val 类型消息，返回 (行数, 待删除的媒体文件)。"""
+        # 同一消息的各版本 created_time 相同，按 edited_time 降序删除，
+        # 保证批次边界处留下的总是较早的版本（差量的基准版本）
+        rows = conn.execute(
+            f"SELECT * FROM {table} WHERE type = ? AND created_time < ? "
+            "ORDER BY created_time, edited_time DESC LIMIT ?",
+            (type_val, cutoff_epoch, batch_size),
+        ).fetchall()
+        if not rows:
+            return 0, []
+        if self.fts_enabled:
+            # 无内容全文索引删除时需要提供原文，须在删除消息行之前还原
+            fts = fts_table(table)
+            fts_rows = [(row['msg_rowid'], row_text(conn, row, table)) for row in rows]
+            conn.executemany(
+                f"INSERT INTO {fts} ({fts}, rowid, msg_text) VALUES ('delete', ?, ?)",
+                [entry for entry in fts_rows if entry[1]],
+            )
+        conn.executemany(
+            f"DELETE FROM {table} WHERE msg_rowid = ?", [(row['msg_rowid'],) for row in rows]
+        )
+        media_refs: Dict[str, int] = {}
+        for row in rows:
+            if row['media_path']:
+                media_refs[row['media_path']] = media_refs.get(row['media_path'], 0) + 1
+        return len(rows), self._release_media_refs(conn, media_refs)
+
+    # 容量淘汰时媒体的选择顺序：最久未使用优先 / 最大文件优先
+    EVICTION_ORDERS = {
+        "oldest": "last_used ASC",
+        "largest": f"{_BLOB_STORED_BYTES} DESC",
+    }
+
+    async def evict_media_blobs(self, limit: int, order: str = "oldest") -> tuple:
+        """
+        容量不足时淘汰最多 limit 个去重媒体（不论引用计数），返回 (个数, 字节数, 需要删除的单独文件)。
+        引用它们的消息保留文本，media_path 被清除；打包存储的媒体空间由压缩回收。
+        """
+        order_by = self.EVICTION_ORDERS.get(order, self.EVICTION_ORDERS["oldest"])
+
+        def _sync_evict(conn: sqlite3.Connection) -> tuple:
+            rows = conn.execute(
+                f"SELECT path, pack_path, {self._BLOB_STORED_BYTES} FROM media_blobs ORDER BY {order_by} LIMIT ?",
+                (limit,),
+            ).fetchall()
+            return len(rows), sum(row[2] for row in rows), self._remove_media_blobs(conn, rows)
+
+        count, size, paths = await self.pool.write(self._media_write(_sync_evict))
+        if count:
+            # 热缓存中的消息仍带有已清除的 media_path
+            self.hot_cache.clear()
+        return count, size, paths
+
+    async def evict_oldest_messages(self, batch_size: int = 1000) -> tuple:
+        """
+        容量不足且已无媒体可淘汰时，删除最早的一批消息（不论保留期限），返回 (行数, 需要删除的媒体文件)。
+        """
+        def _sync_evict(conn: sqlite3.Connection) -> tuple:
+            # 每个 (表, 类型) 的最早时间由 (type, created_time) 索引直接得到
+            oldest = None
+            for table in self.partitions.tables():
+                for type_val in self.MSG_TYPE_MAP.values():
+                    created = conn.execute(
+                        f"SELECT MIN(created_time) FROM {table} WHERE type = ?", (type_val,)
+                    ).fetchone()[0]
+                    if created is not None and (oldest is None or created < oldest[0]):
+                        oldest = (created, table, type_val)
+            if oldest is None:
+                return 0, []
+            created, table, type_val = oldest
+            # 与最早消息同一秒内的消息一并删除，至少删除一行
+            return self._sync_delete_batch(conn, table, type_val, created + 1, batch_size)
+
+        deleted, media_paths = await self.pool.write(_sync_evict)
+        if deleted:
+            self.hot_cache.clear()
+        return deleted, media_paths
+
+    async def get_database_bytes(self) -> int:
+        """
+        数据库已使用的字节数（不含空闲页）加上 WAL 文件大小，由 PRAGMA 得到，无需遍历目录。
+        删除消息后该值随之下降；文件本身只有在增量 auto_vacuum 归还空闲页后才会缩小。
+        """
+        def _sync_get(conn: sqlite3.Connection) -> int:
+            page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+            free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+            return (page_count - free_pages) * page_size
+
+        db_bytes = await self.pool.read(_sync_get)
+        try:
+            db_bytes += os.path.getsize(self.db_path + "-wal")
+        except OSError:
+            pass
+        return db_bytes
 
-            # 查询需要删除的媒体文件路径
+    async def reclaim_database_space(self):
+        """淘汰消息后归还空闲页（需要启用增量 auto_vacuum）。"""
+        await self.pool.write(self._sync_incremental_vacuum)
+
+    def _sync_drop_partition(self, conn: sqlite3.Connection, partition) -> tuple:
+        """统计分区中的消息并收集媒体路径，然后删除整个分区表。"""
+        counts = {
+            row[0]: row[1]
+            for row in conn.execute(f"SELECT type, COUNT(*) FROM {partition.name} GROUP BY type")
+        }
+        media_refs = {
+            row[0]: row[1]
+            for row in conn.execute(
+                f"SELECT media_path, COUNT(*) FROM {partition.name} WHERE media_path IS NOT NULL GROUP BY media_path"
+            )
+        }
+        self.partitions.drop(conn, partition)
+        return counts, self._release_media_refs(conn, media_refs)
+
+    @staticmethod
+    def _release_media_refs(conn: sqlite3.Connection, media_refs: Dict[str, int]) -> List[str]:
+        """
+        减少被删除消息行引用的去重媒体文件的引用计数，与删除消息在同一事务中执行。
+        返回不受去重表管理的（旧的按消息保存的）文件路径，这些文件可以直接删除；
+        去重文件在引用计数归零并超过宽限期后由 _sync_collect_unused_blobs 删除。
+        """
+        if not media_refs:
+            return []
+        conn.executemany(
+            "UPDATE media_blobs SET refcount = refcount - ? WHERE path = ?",
+            [(count, path) for path, count in media_refs.items()],
+        )
+        paths = list(media_refs)
+        managed = set()
+        for start in range(0, len(paths), DatabaseManager.BULK_LOOKUP_CHUNK):
+            chunk = paths[start:start + DatabaseManager.BULK_LOOKUP_CHUNK]
+            placeholders = ",".join("?" * len(chunk))
+            managed.update(
+                row[0] for row in conn.execute(f"SELECT path FROM media_blobs WHERE path IN ({placeholders})", chunk)
+            )
+        return [path for path in paths if path not in managed]
+
+    def _media_write(self, fn: Callable[..., T]) -> Callable[..., T]:
+        """
+        包装会登记或删除 media_blobs 记录的写回调（在写线程上执行）。
+        回调对媒体字节数的修改累计在 _media_bytes_delta 中，事务提交后才计入 media_bytes；
+        回调或提交失败时事务回滚，累计的变化随之丢弃。
+        """
+        def _run(conn: sqlite3.Connection, *args: Any) -> T:
+            self._media_bytes_delta = 0
             try:
-                cursor = self.conn.execute(
-                    "SELECT media_path FROM messages "
-                    "WHERE type = ? AND created_time < ? AND media_path IS NOT NULL",
-                    (type_val, cutoff)
+                result = fn(conn, *args)
+                conn.commit()
+                self.media_bytes += self._media_bytes_delta
+                return result
+            finally:
+                self._media_bytes_delta = 0
+
+        return _run
+
+    def _sync_collect_unused_blobs(self, conn: sqlite3.Connection, last_used_before: int) -> List[str]:
+        """
+        移除无引用且 last_used 早于给定时间的去重媒体记录，返回需要删除的文件路径。
+        打包存储的媒体没有单独的文件，其占用的空间在打包文件压缩时回收。
+        """
+        rows = conn.execute(
+            f"SELECT path, pack_path, {self._BLOB_STORED_BYTES} FROM media_blobs WHERE refcount <= 0 AND last_used < ?",
+            (last_used_before,),
+        ).fetchall()
+        return self._remove_media_blobs(conn, rows)
+
+    def _remove_media_blobs(self, conn: sqlite3.Connection, rows) -> List[str]:
+        """
+        删除 (path, pack_path, 字节数) 对应的去重记录，返回需要删除的单独文件路径。
+
+        仍引用这些路径的消息行（淘汰或文件丢失时）在同一事务中清除 media_path：去重路径是确定的，
+        保留旧引用会在重新下载到同一路径后错误地减少新记录的引用计数。
+        """
+        if rows:
+            conn.executemany("DELETE FROM media_blob_keys WHERE path = ?", [(row[0],) for row in rows])
+            conn.executemany("DELETE FROM media_blobs WHERE path = ?", [(row[0],) for row in rows])
+            self._media_bytes_delta -= sum(row[2] for row in rows)
+            paths = [row[0] for row in rows]
+            for start in range(0, len(paths), self.BULK_LOOKUP_CHUNK):
+                chunk = paths[start:start + self.BULK_LOOKUP_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                for table in self.partitions.tables():
+                    conn.execute(
+                        f"UPDATE {table} SET media_path = NULL WHERE media_path IN ({placeholders})", chunk
+                    )
+        return [row[0] for row in rows if row[1] is None]
+
+    async def acquire_media_blob(self, media_key: str) -> Optional[str]:
+        """
+        按 Telegram 媒体标识（如 Document.id）查找已保存的去重媒体文件。
+        命中时刷新 last_used，使其在宽限期内不会被清理；文件已丢失时移除记录并返回 None。
+        """
+        def _sync_acquire(conn: sqlite3.Connection) -> Optional[str]:
+            row = conn.execute(
+                "SELECT b.path FROM media_blob_keys k JOIN media_blobs b ON b.path = k.path WHERE k.media_key = ?",
+                (media_key,),
+            ).fetchone()
+            if row is None:
+                return None
+            return self._touch_media_blob(conn, row[0])
+
+        try:
+            return await self.pool.write(self._media_write(_sync_acquire))
+        except sqlite3.Error as e:
+            logger.error(f"查找去重媒体文件时出错 (key={media_key}): {e}", exc_info=True)
+            return None
+
+    async def register_media_blob(
+        self,
+        path: str,
+        content_hash: str,
+        size: int,
+        media_key: Optional[str] = None,
+        pack_location: Optional[Tuple[str, int, int]] = None,
+    ) -> str:
+        """
+        登记新保存的媒体文件。已有相同内容的文件时返回已有文件的路径（调用方应删除新文件），
+        并把 media_key 关联到已有文件；否则登记 path 并返回它。引用计数由消息写入时增加。
+        pack_location 为 (打包文件, 偏移, 长度) 时，path 只是逻辑路径，内容保存在打包文件中。
+        """
+        pack_path, pack_offset, pack_length = pack_location or (None, None, None)
+
+        def _sync_register(conn: sqlite3.Connection) -> str:
+            row = conn.execute("SELECT path FROM media_blobs WHERE content_hash = ?", (content_hash,)).fetchone()
+            existing = self._touch_media_blob(conn, row[0]) if row else None
+            if existing is None:
+                # 同一路径的旧记录（内容不同）将被替换
+                self._remove_media_blobs(conn, conn.execute(
+                    f"SELECT path, pack_path, {self._BLOB_STORED_BYTES} FROM media_blobs WHERE path = ?", (path,)
+                ).fetchall())
+                conn.execute(
+                    "INSERT OR REPLACE INTO media_blobs "
+                    "(path, content_hash, size, refcount, last_used, pack_path, pack_offset, pack_length) "
+                    "VALUES (?, ?, ?, 0, ?, ?, ?, ?)",
+                    (path, content_hash, size, int(time.time()), pack_path, pack_offset, pack_length),
                 )
-                # 将查询到的非空路径添加到集合中
-                for row in cursor:
-                    media_paths_to_delete.add(row['media_path'])
-            except sqlite3.Error as e:
-                logger.error(f"查询过期媒体路径时出错 (类型: {persist_type}): {e}", exc_info=True)
+                self._media_bytes_delta += pack_length if pack_length is not None else size
+                existing = path
+            if media_key:
+                conn.execute(
+                    "INSERT OR REPLACE INTO media_blob_keys (media_key, path) VALUES (?, ?)", (media_key, existing)
+                )
+            return existing
 
+        try:
+            return await self.pool.write(self._media_write(_sync_register))
+        except sqlite3.Error as e:
+            logger.error(f"登记去重媒体文件时出错 ({path}): {e}", exc_info=True)
+            return path
 
-        if not conditions:
-            logger.info("没有有效的过期条件，无需删除。")
-            return 0
+    def _touch_media_blob(self, conn: sqlite3.Connection, path: str) -> Optional[str]:
+        """刷新 last_used 并返回 path；文件（或其所在的打包文件）已不存在时删除其记录并返回 None。"""
+        row = conn.execute(
+            f"SELECT path, pack_path, {self._BLOB_STORED_BYTES} FROM media_blobs WHERE path = ?", (path,)
+        ).fetchone()
+        if not os.path.isfile(row[1] if row and row[1] else path):
+            self._remove_media_blobs(conn, [row] if row else [])
+            conn.execute("DELETE FROM media_blob_keys WHERE path = ?", (path,))
+            return None
+        conn.execute("UPDATE media_blobs SET last_used = ? WHERE path = ?", (int(time.time()), path))
+        return path
 
-        deleted_db_rows = 0
-        deleted_files = 0
+    async def get_media_pack_location(self, path: str) -> Optional[Tuple[str, int, int]]:
+        """打包存储的媒体所在的 (打包文件, 偏移, 长度)，单独保存的文件返回 None。"""
+        def _sync_get(conn: sqlite3.Connection) -> Optional[Tuple[str, int, int]]:
+            row = conn.execute(
+                "SELECT pack_path, pack_offset, pack_length FROM media_blobs "
+                "WHERE path = ? AND pack_path IS NOT NULL",
+                (path,),
+            ).fetchone()
+            return tuple(row) if row else None
 
-        # 2. 删除数据库记录
         try:
-            query = f"DELETE FROM messages WHERE {' OR '.join(conditions)}"
-            with self.conn: # Use context manager for automatic commit/rollback
-                cursor = self.conn.execute(query, params)
-                deleted_db_rows = cursor.rowcount # 获取实际删除的行数
-            logger.info(f"数据库中删除了 {deleted_db_rows} 条过期消息记录。")
+            return await self.pool.read(_sync_get)
         except sqlite3.Error as e:
-            logger.error(f"删除过期数据库记录时出错: {e}", exc_info=True)
-            # Rollback is handled by the context manager exiting on exception
-            return 0 # 返回0表示本次操作未成功删除
-
-        # 3. 清理关联的媒体文件
-        if media_paths_to_delete:
-            media_dir = Path("media").resolve() # 使用绝对路径以提高安全性
-            logger.info(f"开始清理 {len(media_paths_to_delete)} 个关联的媒体文件...")
-            for media_path_str in media_paths_to_delete:
-                try:
-                    media_file = Path(media_path_str).resolve()
-                    # 增强检查：确保文件存在且在 media_dir 目录下
-                    if media_file.exists() and media_file.is_file() and media_dir in media_file.parents:
-                        media_file.unlink()
-                        deleted_files += 1
-                        logger.debug(f"已删除媒体文件: {media_path_str}")
-                    elif not media_file.exists():
-                        logger.warning(f"尝试删除媒体文件但文件不存在: {media_path_str}")
-                    elif media_dir not in media_file.parents:
-                         logger.warning(f"媒体文件路径不在预期的 'media' 目录下，跳过删除: {media_path_str}")
-                    # else: 文件存在但不是文件（例如目录），也跳过
-                except OSError as e:
-                    logger.error(f"删除媒体文件 {media_path_str} 时发生 OS 错误: {str(e)}")
-                except Exception as e:
-                    logger.error(f"删除媒体文件 {media_path_str} 时发生未知错误: {str(e)}", exc_info=True)
-
-        self.conn.commit()
-        logger.info(f"清理完成。数据库删除 {deleted_db_rows} 条记录，文件系统删除 {deleted_files} 个文件。")
-        # 返回总共清理的项目数（数据库记录 + 文件）
-        return deleted_db_rows + deleted_files
-
-    def _row_to_message(self, row) -> Message:
-        """Convert database row to Message object"""
+            logger.error(f"查询媒体打包位置时出错 ({path}): {e}", exc_info=True)
+            return None
+
+    async def get_media_pack_usage(self) -> Dict[str, int]:
+        """每个打包文件中仍被引用的字节数，用于判断是否需要压缩。"""
+        def _sync_get(conn: sqlite3.Connection) -> Dict[str, int]:
+            return dict(conn.execute(
+                "SELECT pack_path, SUM(pack_length) FROM media_blobs WHERE pack_path IS NOT NULL GROUP BY pack_path"
+            ).fetchall())
+
+        return await self.pool.read(_sync_get)
+
+    async def get_packed_blobs(self, pack_path: str) -> List[Tuple[str, int, int]]:
+        """打包文件中的有效记录 (逻辑路径, 偏移, 长度)，按偏移排序。"""
+        def _sync_get(conn: sqlite3.Connection) -> List[Tuple[str, int, int]]:
+            return [
+                tuple(row)
+                for row in conn.execute(
+                    "SELECT path, pack_offset, pack_length FROM media_blobs WHERE pack_path = ? ORDER BY pack_offset",
+                    (pack_path,),
+                )
+            ]
+
+        return await self.pool.read(_sync_get)
+
+    async def move_packed_blob(
+        self, path: str, old_location: Tuple[str, int], new_location: Tuple[str, int]
+    ) -> bool:
+        """
+        压缩时把记录指向新的 (打包文件, 偏移)。只有记录仍位于 old_location 时才更新，
+        期间已被过期清理移除的记录返回 False，复制出的字节成为新文件中的失效空间。
+        """
+        def _sync_move(conn: sqlite3.Connection) -> bool:
+            cursor = conn.execute(
+                "UPDATE media_blobs SET pack_path = ?, pack_offset = ? "
+                "WHERE path = ? AND pack_path = ? AND pack_offset = ?",
+                (*new_location, path, *old_location),
+            )
+            return cursor.rowcount > 0
+
+        return await self.pool.write(_sync_move)
+
+    async def is_media_pack_referenced(self, pack_path: str) -> bool:
+        def _sync_check(conn: sqlite3.Connection) -> bool:
+            return conn.execute(
+                "SELECT 1 FROM media_blobs WHERE pack_path = ? LIMIT 1", (pack_path,)
+            ).fetchone() is not None
+
+        return await self.pool.write(_sync_check)
+
+    @staticmethod
+    def _sync_incremental_vacuum(conn: sqlite3.Connection):
+        """归还删除分区后留下的空闲页。旧数据库未启用 auto_vacuum 时空闲页只会被复用。"""
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:  # INCREMENTAL
+            conn.execute("PRAGMA incremental_vacuum").fetchall()
+        else:
+            logger.debug("数据库未启用增量 auto_vacuum，删除分区释放的空间将被复用，执行 VACUUM 可缩小文件。")
+
+    @staticmethod
+    def _delete_media_files(media_paths: List[str], stats: ExpiryStats):
+        """删除已过期消息关联的媒体文件（在工作线程中执行）。"""
+        media_dir = Path("media").resolve() # 使用绝对路径以提高安全性
+        for media_path_str in media_paths:
+            try:
+                media_file = Path(media_path_str).resolve()
+                # 增强检查：确保文件存在且在 media_dir 目录下
+                if media_dir not in media_file.parents:
+                    logger.warning(f"媒体文件路径不在预期的 'media' 目录下，跳过删除: {media_path_str}")
+                elif not media_file.exists():
+                    stats.missing_files += 1
+                    logger.debug(f"尝试删除媒体文件但文件不存在: {media_path_str}")
+                elif media_file.is_file():
+                    media_file.unlink()
+                    stats.deleted_files += 1
+                    logger.debug(f"已删除媒体文件: {media_path_str}")
+                # else: 文件存在但不是文件（例如目录），跳过
+            except OSError as e:
+                stats.failed_files += 1
+                logger.error(f"删除媒体文件 {media_path_str} 时发生 OS 错误: {str(e)}")
+            except Exception as e:
+                stats.failed_files += 1
+                logger.error(f"删除媒体文件 {media_path_str} 时发生未知错误: {str(e)}", exc_info=True)
+
+    def _row_to_message(self, row, conn: sqlite3.Connection, table: str = BASE_TABLE) -> Message:
+        """Convert database row to Message object
+
+        压缩或差量存储的文本在此透明还原，差量行的基准版本从 conn 的同一张表读取。
+        """
         return Message(
             id=row['id'],
             from_id=row['from_id'],
             chat_id=row['chat_id'],
             msg_type=row['type'],
-            msg_text=row['msg_text'],
+            msg_text=row_text(conn, row, table),
             media_path=row['media_path'],
             noforwards=bool(row['noforwards']),
             self_destructing=bool(row['self_destructing']),
-            created_time=datetime.fromisoformat(row['created_time']),
-            edited_time=datetime.fromisoformat(row['edited_time']) if row['edited_time'] else None
+            created_time=epoch_to_datetime(row['created_time']),
+            edited_time=epoch_to_datetime(row['edited_time'])
         )
 
     async def create_role_alias(self, alias: str, role_type: str, static_content: Optional[str] = None) -> bool:
         """创建角色别名，如果是 static 类型则同时设置内容。"""
-        def _sync_create() -> bool:
+        def _sync_create(conn: sqlite3.Connection) -> bool:
             if role_type not in ('static', 'ai'):
                 logger.error(f"尝试创建角色别名 '{alias}' 时使用了无效的角色类型: {role_type}")
                 # 不在此处 raise ValueError，改为返回 False
                 # raise ValueError("role_type 必须是 'static' 或 'ai'")
                 return False
 
-            conn = None # 初始化 conn
             try:
-                # 在线程内创建新的数据库连接
-                conn = sqlite3.connect(self.db_path, check_same_thread=False)
-                cursor = conn.cursor() # 使用新连接的 cursor
+                cursor = conn.cursor() # 使用写连接的 cursor
 
                 # 检查别名是否已存在 (使用 INSERT OR IGNORE 可以简化，但显式检查更清晰)
                 cursor.execute("SELECT 1 FROM user_bot_role_aliases WHERE alias = ?", (alias,))
@@ -302,26 +1055,19 @@ class DatabaseManager:
 
             except sqlite3.Error as e:
                 logger.error(f"创建或更新角色别名 '{alias}' 时数据库出错: {e}", exc_info=True)
-                if conn:
-                    conn.rollback() # 回滚事务
+                conn.rollback() # 回滚事务
                 return False # 指示失败
             except Exception as e:
                  logger.error(f"创建或更新角色别名 '{alias}' 时发生意外错误: {e}", exc_info=True)
-                 if conn:
-                     conn.rollback()
+                 conn.rollback()
                  return False
-            finally:
-                if conn:
-                    conn.close() # 确保关闭连接
 
-        return await asyncio.to_thread(_sync_create) # 返回布尔结果
+        return await self.pool.write(_sync_create) # 返回布尔结果
 
     async def set_role_description(self, alias: str, description: str) -> bool:
         """设置角色描述。"""
-        def _sync_set() -> bool:
-            conn = None
+        def _sync_set(conn: sqlite3.Connection) -> bool:
             try:
-                conn = sqlite3.connect(self.db_path, check_same_thread=False)
                 cursor = conn.cursor()
                 cursor.execute(
                     """
@@ -334,21 +1080,15 @@ class DatabaseManager:
                 return updated
             except sqlite3.Error as e:
                 logger.error(f"设置角色别名 '{alias}' 描述时数据库错误: {e}", exc_info=True)
-                if conn:
-                    conn.rollback() # Explicit rollback
+                conn.rollback() # Explicit rollback
                 return False
-            finally:
-                if conn:
-                    conn.close()
 
-        return await asyncio.to_thread(_sync_set)
+        return await self.pool.write(_sync_set)
 
     async def set_role_static_content(self, alias: str, content: str) -> bool:
         """更新 static 角色的内容。"""
-        def _sync_set() -> bool:
-            conn = None
+        def _sync_set(conn: sqlite3.Connection) -> bool:
             try:
-                conn = sqlite3.connect(self.db_path, check_same_thread=False)
                 cursor = conn.cursor()
                 # 确保只更新 static 类型的角色
                 cursor.execute(
@@ -363,21 +1103,15 @@ class DatabaseManager:
                 return updated
             except sqlite3.Error as e:
                 logger.error(f"设置角色别名 '{alias}' 静态内容时数据库错误: {e}", exc_info=True)
-                if conn:
-                    conn.rollback()
+                conn.rollback()
                 return False
-            finally:
-                if conn:
-                    conn.close()
 
-        return await asyncio.to_thread(_sync_set)
+        return await self.pool.write(_sync_set)
 
     async def set_role_system_prompt(self, alias: str, prompt: str) -> bool:
         """设置 AI 角色的系统提示。"""
-        def _sync_set() -> bool:
-            conn = None
+        def _sync_set(conn: sqlite3.Connection) -> bool:
             try:
-                conn = sqlite3.connect(self.db_path, check_same_thread=False)
                 cursor = conn.cursor()
                 # 确保只更新 ai 类型的角色
                 cursor.execute(
@@ -392,14 +1126,10 @@ class DatabaseManager:
                 return updated
             except sqlite3.Error as e:
                 logger.error(f"设置角色别名 '{alias}' 系统提示时数据库错误: {e}", exc_info=True)
-                if conn:
-                    conn.rollback()
+                conn.rollback()
                 return False
-            finally:
-                if conn:
-                    conn.close()
 
-        return await asyncio.to_thread(_sync_set)
+        return await self.pool.write(_sync_set)
 
     async def set_role_preset_messages(self, alias: str, presets_json: str) -> bool:
         """设置 AI 角色的预设消息 (传入前需确保 presets_json 是有效的 JSON 字符串)。"""
@@ -409,10 +1139,8 @@ class DatabaseManager:
              logger.error(f"为角色 '{alias}' 设置的预设消息不是有效的 JSON 字符串。")
              raise ValueError("预设消息必须是有效的 JSON 字符串")
 
-        def _sync_set() -> bool:
-            conn = None
+        def _sync_set(conn: sqlite3.Connection) -> bool:
             try:
-                conn = sqlite3.connect(self.db_path, check_same_thread=False)
                 cursor = conn.cursor()
                 # 确保只更新 ai 类型的角色
                 cursor.execute(
@@ -427,21 +1155,15 @@ class DatabaseManager:
                 return updated
             except sqlite3.Error as e:
                 logger.error(f"设置角色别名 '{alias}' 预设消息时数据库错误: {e}", exc_info=True)
-                if conn:
-                    conn.rollback()
+                conn.rollback()
                 return False
-            finally:
-                if conn:
-                    conn.close()
 
-        return await asyncio.to_thread(_sync_set)
+        return await self.pool.write(_sync_set)
 
     async def remove_role_alias(self, alias: str) -> bool:
         """删除角色别名及其配置。"""
-        def _sync_remove() -> bool:
-            conn = None
+        def _sync_remove(conn: sqlite3.Connection) -> bool:
             try:
-                conn = sqlite3.connect(self.db_path, check_same_thread=False)
                 cursor = conn.cursor()
                 cursor.execute("DELETE FROM user_bot_role_aliases WHERE alias = ?", (alias,))
                 deleted = cursor.rowcount > 0
@@ -449,23 +1171,16 @@ class DatabaseManager:
                 return deleted
             except sqlite3.Error as e:
                 logger.error(f"删除角色别名 '{alias}' 时数据库错误: {e}", exc_info=True)
-                if conn:
-                    conn.rollback()
+                conn.rollback()
                 return False
-            finally:
-                if conn:
-                    conn.close()
 
-        return await asyncio.to_thread(_sync_remove)
+        return await self.pool.write(_sync_remove)
 
     async def get_role_aliases(self) -> Dict[str, Dict[str, Any]]:
         """获取所有角色别名及其配置。"""
-        def _sync_get() -> Dict[str, Dict[str, Any]]:
+        def _sync_get(conn: sqlite3.Connection) -> Dict[str, Dict[str, Any]]:
             roles = {}
-            conn = None
             try:
-                conn = sqlite3.connect(self.db_path, check_same_thread=False)
-                conn.row_factory = sqlite3.Row # Set row_factory on the new connection
                 cursor = conn.cursor()
                 cursor.execute("SELECT * FROM user_bot_role_aliases")
                 for row in cursor:
@@ -473,19 +1188,13 @@ class DatabaseManager:
             except sqlite3.Error as e:
                 logger.error(f"获取角色别名列表时数据库错误: {e}", exc_info=True)
                 return {} # Return empty dict on error
-            finally:
-                if conn:
-                    conn.close() # Close the connection
             return roles
-        return await asyncio.to_thread(_sync_get)
+        return await self.pool.read(_sync_get)
 
     async def get_role_details_by_alias(self, alias: str) -> Optional[Dict[str, Any]]:
         """获取指定角色别名的详细配置。"""
-        def _sync_get() -> Optional[Dict[str, Any]]:
-            conn = None
+        def _sync_get(conn: sqlite3.Connection) -> Optional[Dict[str, Any]]:
             try:
-                conn = sqlite3.connect(self.db_path, check_same_thread=False)
-                conn.row_factory = sqlite3.Row
                 cursor = conn.cursor()
                 cursor.execute("SELECT * FROM user_bot_role_aliases WHERE alias = ?", (alias,))
                 row = cursor.fetchone()
@@ -493,53 +1202,55 @@ class DatabaseManager:
             except sqlite3.Error as e:
                 logger.error(f"获取角色 '{alias}' 详情时数据库错误: {e}", exc_info=True)
                 return None # Return None on error
-            finally:
-                if conn:
-                    conn.close()
-        return await asyncio.to_thread(_sync_get)
+        return await self.pool.read(_sync_get)
 
     async def get_messages_before(
         self, chat_id: int, before_message_id: int, limit: int
     ) -> List[Message]:
         """获取指定聊天中某条消息之前的N条消息（按消息ID降序，即时间倒序）。"""
-        def _sync_get() -> List[Message]:
+        def _sync_get(conn: sqlite3.Connection) -> List[Message]:
             messages = []
-            conn = None
             try:
-                conn = sqlite3.connect(self.db_path, check_same_thread=False)
-                conn.row_factory = sqlite3.Row # Set row factory for _row_to_message
-                query = """
-                    SELECT * FROM messages
-                    WHERE chat_id = ? AND id < ?
-                    ORDER BY id DESC
-                    LIMIT ?
-                """
-                params = [chat_id, before_message_id, limit]
-                cursor = conn.execute(query, params) # Use new connection
-                # 按 ID 降序获取，然后反转得到时间正序
-                messages = [self._row_to_message(row) for row in reversed(list(cursor))]
+                for table in self.partitions.tables():
+                    query = f"""
+                        SELECT * FROM {table}
+                        WHERE chat_id = ? AND id < ?
+                        ORDER BY id DESC
+                        LIMIT ?
+                    """
+                    params = [chat_id, before_message_id, limit]
+                    cursor = conn.execute(query, params) # Use pooled reader connection
+                    messages.extend(self._row_to_message(row, conn, table) for row in cursor)
+                # 合并各表结果后按 ID 降序取前 N 条，然后反转得到时间正序
+                messages.sort(key=lambda m: m.id, reverse=True)
+                messages = list(reversed(messages[:limit]))
             except sqlite3.Error as e:
                 logger.error(f"获取 chat_id={chat_id} 中消息 {before_message_id} 之前的消息时出错: {e}", exc_info=True)
                 return [] # Return empty list on error
-            finally:
-                if conn:
-                    conn.close() # Close the connection
             return messages # 返回时间正序列表
-        return await asyncio.to_thread(_sync_get)
+        return await self.pool.read(_sync_get)
 
     def close(self):
         """Close database connection"""
-        self.conn.close()
+        # 先让写线程把剩余消息写完，再关闭连接池
+        self.ingest_queue.close()
+        try:
+            self.entity_cache.flush()
+        except sqlite3.Error as e:
+            logger.warning(f"写入实体缓存失败: {e}")
+        self.pool.close()
+        cache_stats = self.hot_cache.stats()
+        logger.info(
+            f"热缓存统计: 命中 {cache_stats['hits']} 次，未命中 {cache_stats['misses']} 次 "
+            f"(命中率 {cache_stats['hit_rate']:.1%})，淘汰 {cache_stats['evictions']} 条。"
+        )
 
     # --- User Bot Settings Methods ---
     
     async def get_user_bot_settings(self, user_id: int) -> Optional[Dict[str, Any]]:
         """获取指定用户的机器人设置。"""
-        def _sync_get() -> Optional[Dict[str, Any]]:
-            conn = None
+        def _sync_get(conn: sqlite3.Connection) -> Optional[Dict[str, Any]]:
             try:
-                conn = sqlite3.connect(self.db_path, check_same_thread=False)
-                conn.row_factory = sqlite3.Row
                 cursor = conn.cursor()
                 cursor.execute("SELECT * FROM user_bot_settings WHERE user_id = ?", (user_id,))
                 row = cursor.fetchone()
@@ -548,15 +1259,11 @@ class DatabaseManager:
             except sqlite3.Error as e:
                 logger.error(f"获取用户 {user_id} 机器人设置时数据库错误: {e}", exc_info=True)
                 return None # 仅在数据库错误时返回 None
-            finally:
-                if conn:
-                    conn.close()
-        return await asyncio.to_thread(_sync_get)
+        return await self.pool.read(_sync_get)
 
     async def save_user_bot_settings(self, user_id: int, settings: Dict[str, Any]) -> bool:
         """保存或更新用户机器人设置 (使用 INSERT OR REPLACE)。"""
-        def _sync_save() -> bool:
-            conn = None
+        def _sync_save(conn: sqlite3.Connection) -> bool:
             data = (
                 user_id,
                 settings.get('enabled', 0),
@@ -567,7 +1274,6 @@ class DatabaseManager:
                 settings.get('rate_limit_seconds', 60)
             )
             try:
-                conn = sqlite3.connect(self.db_path, check_same_thread=False)
                 conn.execute(
                     """
                     INSERT OR REPLACE INTO user_bot_settings
@@ -581,21 +1287,15 @@ class DatabaseManager:
                 return True # Indicate success
             except sqlite3.Error as e:
                 logger.error(f"保存用户 {user_id} 机器人设置时出错: {e}", exc_info=True)
-                if conn:
-                    conn.rollback()
+                conn.rollback()
                 return False # Indicate failure
-            finally:
-                if conn:
-                    conn.close()
 
-        return await asyncio.to_thread(_sync_save) # Return the boolean result
+        return await self.pool.write(_sync_save) # Return the boolean result
 
     async def add_target_group(self, chat_id: int) -> bool:
         """添加目标群组。"""
-        def _sync_add() -> bool:
-            conn = None
+        def _sync_add(conn: sqlite3.Connection) -> bool:
             try:
-                conn = sqlite3.connect(self.db_path, check_same_thread=False)
                 cursor = conn.cursor()
                 # 使用 INSERT OR IGNORE 避免重复插入时出错
                 cursor.execute("INSERT OR IGNORE INTO user_bot_target_groups (chat_id) VALUES (?)", (chat_id,))
@@ -605,20 +1305,14 @@ class DatabaseManager:
                 return added
             except sqlite3.Error as e:
                 logger.error(f"添加目标群组 {chat_id} 时数据库错误: {e}", exc_info=True)
-                if conn:
-                    conn.rollback()
+                conn.rollback()
                 return False
-            finally:
-                if conn:
-                    conn.close()
-        return await asyncio.to_thread(_sync_add)
+        return await self.pool.write(_sync_add)
 
     async def remove_target_group(self, chat_id: int) -> bool:
         """移除目标群组。"""
-        def _sync_remove() -> bool:
-            conn = None
+        def _sync_remove(conn: sqlite3.Connection) -> bool:
             try:
-                conn = sqlite3.connect(self.db_path, check_same_thread=False)
                 cursor = conn.cursor()
                 cursor.execute("DELETE FROM user_bot_target_groups WHERE chat_id = ?", (chat_id,))
                 deleted = cursor.rowcount > 0
@@ -626,33 +1320,23 @@ class DatabaseManager:
                 return deleted
             except sqlite3.Error as e:
                 logger.error(f"移除目标群组 {chat_id} 时数据库错误: {e}", exc_info=True)
-                if conn:
-                    conn.rollback()
+                conn.rollback()
                 return False
-            finally:
-                if conn:
-                    conn.close()
-        return await asyncio.to_thread(_sync_remove)
+        return await self.pool.write(_sync_remove)
 
     async def get_target_groups(self) -> List[int]:
         """获取所有目标群组 ID。"""
-        def _sync_get() -> List[int]:
+        def _sync_get(conn: sqlite3.Connection) -> List[int]:
             groups = []
-            conn = None
             try:
-                conn = sqlite3.connect(self.db_path, check_same_thread=False)
-                conn.row_factory = sqlite3.Row # Set row factory
                 cursor = conn.cursor()
                 cursor.execute("SELECT chat_id FROM user_bot_target_groups")
                 groups = [row['chat_id'] for row in cursor]
             except sqlite3.Error as e:
                 logger.error(f"获取目标群组列表时数据库错误: {e}", exc_info=True)
                 return [] # Return empty list on error
-            finally:
-                if conn:
-                    conn.close() # Close connection
             return groups
-        return await asyncio.to_thread(_sync_get)
+        return await self.pool.read(_sync_get)
 
     # Message type constants and validation
     MSG_TYPE_MAP = {
@@ -664,10 +1348,8 @@ class DatabaseManager:
 
     async def set_model_alias(self, alias: str, model_id: str) -> bool:
         """设置模型别名。"""
-        def _sync_set() -> bool:
-            conn = None
+        def _sync_set(conn: sqlite3.Connection) -> bool:
             try:
-                conn = sqlite3.connect(self.db_path, check_same_thread=False)
                 cursor = conn.cursor()
                 # 使用 INSERT OR REPLACE 简化逻辑
                 cursor.execute("INSERT OR REPLACE INTO user_bot_model_aliases (alias, model_id) VALUES (?, ?)", (alias, model_id))
@@ -676,20 +1358,14 @@ class DatabaseManager:
                 return True
             except sqlite3.Error as e:
                 logger.error(f"设置模型别名 '{alias}' -> '{model_id}' 时数据库错误: {e}", exc_info=True)
-                if conn:
-                    conn.rollback()
+                conn.rollback()
                 return False
-            finally:
-                if conn:
-                    conn.close()
-        return await asyncio.to_thread(_sync_set)
+        return await self.pool.write(_sync_set)
 
     async def remove_model_alias(self, alias: str) -> bool:
         """移除模型别名。"""
-        def _sync_remove() -> bool:
-            conn = None
+        def _sync_remove(conn: sqlite3.Connection) -> bool:
             try:
-                conn = sqlite3.connect(self.db_path, check_same_thread=False)
                 cursor = conn.cursor()
                 cursor.execute("DELETE FROM user_bot_model_aliases WHERE alias = ?", (alias,))
                 deleted = cursor.rowcount > 0
@@ -697,22 +1373,15 @@ class DatabaseManager:
                 return deleted
             except sqlite3.Error as e:
                 logger.error(f"移除模型别名 '{alias}' 时数据库错误: {e}", exc_info=True)
-                if conn:
-                    conn.rollback()
+                conn.rollback()
                 return False
-            finally:
-                if conn:
-                    conn.close()
-        return await asyncio.to_thread(_sync_remove)
+        return await self.pool.write(_sync_remove)
 
     async def get_model_aliases(self) -> Dict[str, str]:
         """获取所有模型别名。"""
-        def _sync_get() -> Dict[str, str]:
+        def _sync_get(conn: sqlite3.Connection) -> Dict[str, str]:
             aliases = {}
-            conn = None
             try:
-                conn = sqlite3.connect(self.db_path, check_same_thread=False)
-                conn.row_factory = sqlite3.Row # Set row factory
                 cursor = conn.cursor()
                 cursor.execute("SELECT alias, model_id FROM user_bot_model_aliases")
                 for row in cursor:
@@ -720,19 +1389,13 @@ class DatabaseManager:
             except sqlite3.Error as e:
                 logger.error(f"获取模型别名列表时数据库错误: {e}", exc_info=True)
                 return {} # Return empty dict on error
-            finally:
-                if conn:
-                    conn.close() # Close connection
             return aliases
-        return await asyncio.to_thread(_sync_get)
+        return await self.pool.read(_sync_get)
 
     async def get_model_id_by_alias(self, alias: str) -> Optional[str]:
         """通过别名查找模型 ID。"""
-        def _sync_get() -> Optional[str]:
-            conn = None
+        def _sync_get(conn: sqlite3.Connection) -> Optional[str]:
             try:
-                conn = sqlite3.connect(self.db_path, check_same_thread=False)
-                conn.row_factory = sqlite3.Row
                 cursor = conn.cursor()
                 cursor.execute("SELECT model_id FROM user_bot_model_aliases WHERE alias = ?", (alias,))
                 row = cursor.fetchone()
@@ -740,8 +1403,5 @@ class DatabaseManager:
             except sqlite3.Error as e:
                 logger.error(f"通过别名 '{alias}' 查找模型 ID 时数据库错误: {e}", exc_info=True)
                 return None # Return None on error
-            finally:
-                if conn:
-                    conn.close()
-        return await asyncio.to_thread(_sync_get)
+        return await self.pool.read(_sync_get)
 
@@ -0,0 +1,140 @@
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from .models import EntityInfo
+from .pool import SQLiteConnectionPool
+
+logger = logging.getLogger(__name__)
+
+_UPSERT_SQL = (
+    "INSERT INTO entities (id, kind, name, username, updated_at) VALUES (?, ?, ?, ?, ?) "
+    "ON CONFLICT(id) DO UPDATE SET kind = excluded.kind, name = excluded.name, "
+    "username = excluded.username, updated_at = excluded.updated_at"
+)
+
+
+class EntityCache:
+    """
+    实体信息（显示名称、用户名、类型）的 TTL + LRU 缓存，持久化到 entities 表。
+
+    - 内存中最多保留 max_entries 个实体，超出时淘汰最久未使用的；
+    - 超过 ttl 秒未刷新的实体视为过期，lookup 不再返回，调用方应重新获取
+      （获取失败时仍可用 get(..., allow_stale=True) 作为回退）；
+    - 事件自带的实体通过 put 刷新，内容变化或接近过期时才回写数据库，
+      回写在写线程上合并执行，不阻塞调用方。
+    """
+
+    def __init__(self, pool: SQLiteConnectionPool, ttl: int = 86400, max_entries: int = 10000):
+        self.pool = pool
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self._entries: "OrderedDict[int, EntityInfo]" = OrderedDict()
+        self._dirty: Dict[int, EntityInfo] = {}
+        self._flush_pending = False
+        self._lock = threading.Lock()
+        # 当前账号的 ID，create_mention 用它解析 entity_id 为 0 的提及
+        self.self_id: Optional[int] = None
+
+        # 统计信息
+        self.hits = 0
+        self.misses = 0
+
+    def _fresh(self, info: EntityInfo, now: float) -> bool:
+        return now - info.updated_at < self.ttl
+
+    def get(self, entity_id: int, allow_stale: bool = False) -> Optional[EntityInfo]:
+        """只查内存。"""
+        with self._lock:
+            info = self._entries.get(entity_id)
+            if info is None:
+                return None
+            if not allow_stale and not self._fresh(info, time.time()):
+                return None
+            self._entries.move_to_end(entity_id)
+            return info
+
+    async def lookup(self, entity_id: int) -> Optional[EntityInfo]:
+        """查找未过期的实体：先查内存，未命中时查 entities 表。"""
+        info = self.get(entity_id)
+        if info is None and entity_id not in self._entries:
+            try:
+                row = await self.pool.read(
+                    lambda conn: conn.execute(
+                        "SELECT id, kind, name, username, updated_at FROM entities WHERE id = ?", (entity_id,)
+                    ).fetchone()
+                )
+            except sqlite3.Error as e:
+                logger.error(f"读取实体缓存时出错 (ID={entity_id}): {e}", exc_info=True)
+                row = None
+            if row is not None:
+                # 过期的记录也放入内存，供获取失败时回退
+                self._store(EntityInfo(*row))
+                info = self.get(entity_id)
+        if info is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return info
+
+    def put(self, info: EntityInfo):
+        """放入或刷新实体信息；内容变化或已过半个 ttl 时回写数据库。"""
+        now = int(time.time())
+        info = EntityInfo(info.id, info.kind, info.name, info.username, now)
+        with self._lock:
+            old = self._entries.get(info.id)
+            if (
+                old is not None
+                and (old.kind, old.name, old.username) == (info.kind, info.name, info.username)
+                and now - old.updated_at < self.ttl / 2
+            ):
+                self._entries.move_to_end(info.id)
+                return
+            self._store_locked(info)
+            self._dirty[info.id] = info
+            if self._flush_pending:
+                return
+            self._flush_pending = True
+        try:
+            self.pool.submit_write(self._sync_flush)
+        except sqlite3.ProgrammingError:
+            pass  # 连接池已关闭
+
+    def _store(self, info: EntityInfo):
+        with self._lock:
+            self._store_locked(info)
+
+    def _store_locked(self, info: EntityInfo):
+        self._entries[info.id] = info
+        self._entries.move_to_end(info.id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _sync_flush(self, conn: sqlite3.Connection) -> int:
+        """在写线程上写入所有待回写的实体（合并期间的多次刷新只写一次）。"""
+        with self._lock:
+            batch = list(self._dirty.values())
+            self._dirty.clear()
+            self._flush_pending = False
+        if batch:
+            conn.executemany(
+                _UPSERT_SQL, [(i.id, i.kind, i.name, i.username, i.updated_at) for i in batch]
+            )
+        return len(batch)
+
+    def flush(self):
+        """同步写入待回写的实体，关闭数据库前调用。"""
+        if self._dirty:
+            self.pool.write_sync(self._sync_flush)
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,416 @@
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from dataclasses import replace
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .codec import TEXT_DELTA, datetime_to_epoch, encode_text, load_text
+from .models import Message
+from .partitions import BASE_TABLE, MessagePartitionRouter, fts_table
+
+logger = logging.getLogger(__name__)
+
+# 写入消息表的 SQL（{table} 为 messages 或分区表）。使用 INSERT OR IGNORE 让重复消息
+# 在数据库层面被静默跳过，不再依赖 IntegrityError 异常路径。
+INSERT_MESSAGE_SQL = (
+    "INSERT OR IGNORE INTO {table} "
+    "(id, from_id, chat_id, type, msg_text, media_path, noforwards, self_destructing, created_time, edited_time, "
+    "text_codec, text_blob, text_base) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+
+# 每条引用去重媒体文件的消息行计入一次引用（非去重文件不在 media_blobs 中，更新不影响任何行）
+INCREMENT_BLOB_REFS_SQL = "UPDATE media_blobs SET refcount = refcount + ? WHERE path = ?"
+
+# 回填后台下载完成的媒体路径；已有路径的行不覆盖（其引用已计入）
+UPDATE_MEDIA_PATH_SQL = (
+    "UPDATE {table} SET media_path = ? WHERE chat_id = ? AND id = ? AND edited_time = ? AND media_path IS NULL"
+)
+
+# 全文索引的 rowid 即消息表的 msg_rowid，写入明文（消息表中可能是压缩或差量存储）
+INSERT_FTS_SQL = "INSERT INTO {fts} (rowid, msg_text) VALUES (?, ?)"
+
+
+class _FlushMarker:
+    """插入队列中的刷新标记，写线程处理到它时立即提交当前批次并通知等待方。"""
+
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class _MediaPathUpdate:
+    """回填已入队消息的 media_path（媒体在消息行写入之后才下载完成）。"""
+
+    __slots__ = ("message", "media_path")
+
+    def __init__(self, message: Message, media_path: str):
+        self.message = message
+        self.media_path = media_path
+
+
+_STOP = object()  # 写线程退出标记
+
+
+class MessageIngestQueue:
+    """
+    消息写后（write-behind）批量入库队列。
+
+    事件循环只负责把 Message 放入队列，专用写线程负责把队列中的消息
+    按批次（数量上限或时间上限，先到者为准）合并到一个事务中，
+    交给连接池的写连接提交，从而避免每条消息一次 commit/fsync 阻塞事件循环。
+    """
+
+    def __init__(
+        self,
+        execute_write: Callable[..., Any],
+        batch_size: int = 200,
+        flush_interval: float = 0.2,
+        index_text: bool = False,
+        router: Optional[MessagePartitionRouter] = None,
+    ):
+        """
+        Args:
+            execute_write: 在写连接上执行 fn(conn, *args) 的函数，
+                通常为 SQLiteConnectionPool.write_sync。
+            batch_size: 单个事务最多包含的消息数量。
+            flush_interval: 批次从收到第一条消息起最长等待的秒数。
+            index_text: 是否在同一事务中维护全文索引。
+            router: 分区路由，为 None 或未启用分区时所有消息写入 messages 表。
+        """
+        self._execute_write = execute_write
+        self.index_text = index_text
+        self._router = router
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = max(0.0, flush_interval)
+        self._queue: "queue.Queue[object]" = queue.Queue()
+        # 尚未落盘的消息，保证写后立即读取（read-your-writes）仍能命中
+        self._pending: Dict[Tuple[int, int], List[Message]] = {}
+        self._pending_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+
+        # 统计信息
+        self.enqueued_count = 0
+        self.written_count = 0
+        self.ignored_count = 0
+        self.failed_count = 0
+        self.batch_count = 0
+
+    def start(self):
+        """启动写线程。"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="db-ingest-writer", daemon=True)
+        self._thread.start()
+        logger.info(
+            f"消息批量写入线程已启动 (batch_size={self.batch_size}, flush_interval={self.flush_interval}s)"
+        )
+
+    def put(self, message: Message):
+        """将消息放入写入队列，立即返回。"""
+        if self._closed:
+            raise RuntimeError("消息写入队列已关闭，无法继续写入。")
+        key = (message.chat_id, message.id)
+        with self._pending_lock:
+            self._pending.setdefault(key, []).append(message)
+        self.enqueued_count += 1
+        self._queue.put(message)
+
+    def put_media_path(self, message: Message, media_path: str):
+        """
+        回填消息的 media_path。更新与消息写入共用同一队列，因此总在该消息的插入之后执行；
+        消息尚未落盘时同时更新待写入副本，保证读取时能看到新路径。
+        """
+        if self._closed:
+            raise RuntimeError("消息写入队列已关闭，无法继续写入。")
+        key = (message.chat_id, message.id)
+        with self._pending_lock:
+            versions = self._pending.get(key)
+            if versions:
+                self._pending[key] = [
+                    replace(v, media_path=media_path) if v.edited_time == message.edited_time else v
+                    for v in versions
+                ]
+        self._queue.put(_MediaPathUpdate(message, media_path))
+
+    def find_pending(self, message_id: int, chat_id: Optional[int] = None) -> List[Message]:
+        """返回仍在队列中、尚未提交的指定消息的所有版本。"""
+        with self._pending_lock:
+            if chat_id is not None:
+                return list(self._pending.get((chat_id, message_id), []))
+            return [
+                msg
+                for (_, msg_id), versions in self._pending.items()
+                if msg_id == message_id
+                for msg in versions
+            ]
+
+    @property
+    def depth(self) -> int:
+        """当前队列中等待写入的条目数（近似值）。"""
+        return self._queue.qsize()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        阻塞直到调用前入队的所有消息都已提交。
+
+        Returns:
+            bool: 在超时时间内完成返回 True，否则返回 False。
+        """
+        if not self._thread or not self._thread.is_alive():
+            return self._queue.empty()
+        marker = _FlushMarker()
+        self._queue.put(marker)
+        return marker.done.wait(timeout)
+
+    def close(self, timeout: Optional[float] = 10.0):
+        """刷新剩余消息并停止写线程。"""
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread and self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                logger.error(f"消息写入线程在 {timeout} 秒内未能退出，剩余约 {self.depth} 条消息可能未写入。")
+        logger.info(
+            f"消息批量写入队列已关闭。入队 {self.enqueued_count} 条，写入 {self.written_count} 条，"
+            f"重复忽略 {self.ignored_count} 条，失败 {self.failed_count} 条，批次 {self.batch_count} 个。"
+        )
+
+    # --- 写线程 ---
+
+    def _run(self):
+        try:
+            stopping = False
+            while not stopping:
+                try:
+                    item = self._queue.get(timeout=1.0)
+                except queue.Empty:
+                    continue
+
+                batch: List[Message] = []
+                updates: List[_MediaPathUpdate] = []
+                markers: List[_FlushMarker] = []
+                deadline = time.monotonic() + self.flush_interval
+                while True:
+                    if item is _STOP:
+                        stopping = True
+                    elif isinstance(item, _FlushMarker):
+                        markers.append(item)
+                    elif isinstance(item, _MediaPathUpdate):
+                        updates.append(item)
+                    else:
+                        batch.append(item)
+
+                    # 收到停止/刷新标记或批次已满时，不再等待，尽快提交
+                    if stopping or markers or len(batch) + len(updates) >= self.batch_size:
+                        break
+                    remaining = deadline - time.monotonic()
+                    try:
+                        item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+
+                if stopping:
+                    # 退出前排空队列中剩余的消息
+                    while True:
+                        try:
+                            item = self._queue.get_nowait()
+                        except queue.Empty:
+                            break
+                        if isinstance(item, _FlushMarker):
+                            markers.append(item)
+                        elif isinstance(item, _MediaPathUpdate):
+                            updates.append(item)
+                        elif item is not _STOP:
+                            batch.append(item)
+
+                for start in range(0, len(batch), self.batch_size):
+                    chunk = batch[start:start + self.batch_size]
+                    try:
+                        self._execute_write(self._write_batch, chunk)
+                    except Exception as e:
+                        self.failed_count += len(chunk)
+                        self._release_pending(chunk)
+                        logger.error(f"提交 {len(chunk)} 条消息到写连接时出错: {e}", exc_info=True)
+                if updates:
+                    try:
+                        self._execute_write(self._write_media_paths, updates)
+                    except Exception as e:
+                        self.failed_count += len(updates)
+                        logger.error(f"回填 {len(updates)} 条消息的媒体路径时出错: {e}", exc_info=True)
+                for marker in markers:
+                    marker.done.set()
+        except Exception as e:
+            logger.critical(f"消息写入线程发生严重错误: {e}", exc_info=True)
+
+    def _write_batch(self, conn: sqlite3.Connection, batch: List[Message]):
+        """在单个事务中写入一批消息，失败时逐条重试以隔离坏数据。"""
+        if not batch:
+            return
+        tables = [self._table_for(message) for message in batch]
+        if self._router is not None:
+            try:
+                self._router.ensure(conn, set(tables))
+            except sqlite3.Error as e:
+                self.failed_count += len(batch)
+                self._release_pending(batch)
+                logger.error(f"创建消息分区表失败，{len(batch)} 条消息未写入: {e}", exc_info=True)
+                return
+        try:
+            rows = self._encode_batch(conn, batch, tables)
+        except sqlite3.Error as e:
+            # 查找差量基准失败时退回完整存储，保证消息不丢失
+            logger.error(f"编码 {len(batch)} 条消息文本时出错，改为完整存储: {e}", exc_info=True)
+            rows = [self._to_params(message, encode_text(message.msg_text), None) for message in batch]
+        try:
+            with conn:
+                inserted = self._insert_rows(conn, batch, tables, rows)
+            self.written_count += inserted
+            self.ignored_count += len(rows) - inserted
+            self.batch_count += 1
+            logger.debug(f"批量写入 {inserted}/{len(rows)} 条消息 (其余为重复消息)")
+        except sqlite3.Error as e:
+            logger.error(f"批量写入 {len(rows)} 条消息失败，改为逐条写入: {e}", exc_info=True)
+            for message, table, params in zip(batch, tables, rows):
+                try:
+                    with conn:
+                        inserted = self._insert_rows(conn, [message], [table], [params])
+                    if inserted:
+                        self.written_count += 1
+                    else:
+                        self.ignored_count += 1
+                except sqlite3.Error as row_err:
+                    self.failed_count += 1
+                    logger.error(
+                        f"保存消息时数据库出错 (MsgID={message.id} ChatID={message.chat_id}): {row_err}",
+                        exc_info=True,
+                    )
+        finally:
+            self._release_pending(batch)
+
+    def _write_media_paths(self, conn: sqlite3.Connection, updates: List["_MediaPathUpdate"]):
+        """在单个事务中回填 media_path，并为新引用的去重媒体文件增加引用计数。"""
+        media_refs: Dict[str, int] = {}
+        with conn:
+            for update in updates:
+                message = update.message
+                cursor = conn.execute(
+                    UPDATE_MEDIA_PATH_SQL.format(table=self._table_for(message)),
+                    (update.media_path, message.chat_id, message.id, datetime_to_epoch(message.edited_time)),
+                )
+                if cursor.rowcount > 0:
+                    media_refs[update.media_path] = media_refs.get(update.media_path, 0) + 1
+            if media_refs:
+                conn.executemany(INCREMENT_BLOB_REFS_SQL, [(count, path) for path, count in media_refs.items()])
+        logger.debug(f"回填 {sum(media_refs.values())}/{len(updates)} 条消息的媒体路径")
+
+    def _table_for(self, message: Message) -> str:
+        if self._router is None:
+            return BASE_TABLE
+        return self._router.table_for(message.created_time)
+
+    def _insert_rows(
+        self, conn: sqlite3.Connection, batch: List[Message], tables: List[str], rows: List[tuple]
+    ) -> int:
+        """插入消息行，并为实际写入的行同步更新全文索引和媒体引用计数。返回实际写入的行数。"""
+        inserted = 0
+        fts_rows: Dict[str, List[Tuple[int, str]]] = {}
+        media_refs: Dict[str, int] = {}
+        # 分区表 -> {chat_id: (最小 ID, 最大 ID)}
+        id_ranges: Dict[str, Dict[int, Tuple[int, int]]] = {}
+        for message, table, params in zip(batch, tables, rows):
+            cursor = conn.execute(INSERT_MESSAGE_SQL.format(table=table), params)
+            if cursor.rowcount > 0:
+                inserted += 1
+                if table != BASE_TABLE:
+                    ranges = id_ranges.setdefault(table, {})
+                    low, high = ranges.get(message.chat_id, (message.id, message.id))
+                    ranges[message.chat_id] = (min(low, message.id), max(high, message.id))
+                if self.index_text and message.msg_text:
+                    fts_rows.setdefault(table, []).append((cursor.lastrowid, message.msg_text))
+                if message.media_path:
+                    media_refs[message.media_path] = media_refs.get(message.media_path, 0) + 1
+        for table, entries in fts_rows.items():
+            conn.executemany(INSERT_FTS_SQL.format(fts=fts_table(table)), entries)
+        if media_refs:
+            conn.executemany(INCREMENT_BLOB_REFS_SQL, [(count, path) for path, count in media_refs.items()])
+        for table, ranges in id_ranges.items():
+            self._router.record_ids(conn, table, ranges)
+        return inserted
+
+    def _release_pending(self, batch: List[Message]):
+        with self._pending_lock:
+            for message in batch:
+                key = (message.chat_id, message.id)
+                versions = self._pending.get(key)
+                if not versions:
+                    continue
+                # 按主键中的 edited_time 匹配版本（待写入副本的 media_path 可能已被回填）
+                versions[:] = [v for v in versions if v.edited_time != message.edited_time]
+                if not versions:
+                    del self._pending[key]
+
+    def _encode_batch(
+        self, conn: sqlite3.Connection, batch: List[Message], tables: List[str]
+    ) -> List[tuple]:
+        """
+        将一批消息转换为插入参数。编辑版本尽量存储为相对上一版本的差量，
+        上一版本可能已在数据库中，也可能在本批次中较早的位置。
+        同一消息的各版本 created_time 相同，总是位于同一张表中。
+        """
+        # (chat_id, id) -> [(edited_time, 文本, 差量层数)]，仅在本批次内有效
+        batch_versions: Dict[Tuple[int, int], List[Tuple[int, Optional[str], int]]] = {}
+        rows = []
+        for message, table in zip(batch, tables):
+            key = (message.chat_id, message.id)
+            edited_time = datetime_to_epoch(message.edited_time)
+            base_time = None
+            base_text = None
+            depth = 0
+            if edited_time:
+                # 本批次中较早的版本
+                earlier = [v for v in batch_versions.get(key, []) if v[0] < edited_time]
+                if earlier:
+                    base_time, base_text, depth = max(earlier, key=lambda v: v[0])
+                # 数据库中的版本
+                row = conn.execute(
+                    f"SELECT edited_time FROM {table} WHERE chat_id = ? AND id = ? AND edited_time < ? "
+                    "ORDER BY edited_time DESC LIMIT 1",
+                    (message.chat_id, message.id, edited_time),
+                ).fetchone()
+                if row is not None and (base_time is None or row[0] >= base_time):
+                    base_time = row[0]
+                    base_text, depth = load_text(conn, message.chat_id, message.id, base_time, table)
+                    if base_text is None:
+                        base_time = None
+
+            encoded = encode_text(message.msg_text, base_text, depth)
+            new_depth = depth + 1 if encoded[0] == TEXT_DELTA else 0
+            batch_versions.setdefault(key, []).append((edited_time, message.msg_text, new_depth))
+            rows.append(
+                self._to_params(message, encoded, base_time if encoded[0] == TEXT_DELTA else None)
+            )
+        return rows
+
+    @staticmethod
+    def _to_params(message: Message, encoded: tuple, text_base: Optional[int]) -> tuple:
+        text_codec, msg_text, text_blob = encoded
+        return (
+            message.id,
+            message.from_id,
+            message.chat_id,
+            message.msg_type,
+            msg_text,
+            message.media_path,
+            int(message.noforwards),
+            int(message.self_destructing),
+            datetime_to_epoch(message.created_time),
+            datetime_to_epoch(message.edited_time),  # 原始消息编码为 0
+            text_codec,
+            text_blob,
+            text_base,
+        )
@@ -0,0 +1,435 @@
+import logging
+import os
+import sqlite3
+from typing import Callable, Dict, List, Tuple
+
+from .codec import row_text
+from .partitions import (
+    BASE_TABLE,
+    ID_RANGES_TABLE,
+    Partition,
+    create_media_path_index,
+    create_message_table,
+    create_partition_table,
+)
+
+logger = logging.getLogger(__name__)
+
+# 每批复制的行数。每批为一个独立事务，中断后可从上次进度继续
+MIGRATION_BATCH_SIZE = 5000
+
+
+def _get_user_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def _set_user_version(conn: sqlite3.Connection, version: int):
+    # PRAGMA 不支持参数绑定，version 来自本模块的整数常量
+    conn.execute(f"PRAGMA user_version = {int(version)}")
+
+
+def _migrate_integer_timestamps(conn: sqlite3.Connection, batch_size: int):
+    """
+    版本 1：将 messages.created_time / edited_time 由 ISO 字符串改为整数 Unix 时间戳（秒）。
+
+    原始消息的 edited_time 由 NULL 改为 0，使主键 (chat_id, id, edited_time)
+    也能对原始消息去重。数据按 rowid 分批复制到新表并保留原 rowid，
+    复制进度即新表中的最大 rowid，因此中断后重启会从断点继续。
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS messages_v1 (
+            id INTEGER,
+            from_id INTEGER,
+            chat_id INTEGER,
+            type INTEGER,
+            msg_text TEXT,
+            media_path TEXT,
+            noforwards INTEGER DEFAULT 0,
+            self_destructing INTEGER DEFAULT 0,
+            created_time INTEGER NOT NULL,
+            edited_time INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_id, id, edited_time)
+        )
+    """)
+    conn.commit()
+
+    last_rowid = conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM messages_v1").fetchone()[0]
+    copied = 0
+    while True:
+        end_rowid = conn.execute(
+            "SELECT MAX(rowid) FROM (SELECT rowid FROM messages WHERE rowid > ? ORDER BY rowid LIMIT ?)",
+            (last_rowid, batch_size),
+        ).fetchone()[0]
+        if end_rowid is None:
+            break
+        cursor = conn.execute(
+            """
+            INSERT OR IGNORE INTO messages_v1
+                (rowid, id, from_id, chat_id, type, msg_text, media_path,
+                 noforwards, self_destructing, created_time, edited_time)
+            SELECT rowid, id, from_id, chat_id, type, msg_text, media_path,
+                   noforwards, self_destructing,
+                   COALESCE(CAST(strftime('%s', created_time) AS INTEGER), 0),
+                   COALESCE(CAST(strftime('%s', edited_time) AS INTEGER), 0)
+            FROM messages WHERE rowid > ? AND rowid <= ?
+            """,
+            (last_rowid, end_rowid),
+        )
+        conn.commit()
+        copied += max(cursor.rowcount, 0)
+        last_rowid = end_rowid
+        logger.debug(f"迁移 messages 时间戳: 已复制至 rowid {last_rowid}")
+
+    # 替换旧表与更新版本号在同一事务中完成（由 run_migrations 提交）。
+    # 旧表上的索引随表一起删除，由 _create_tables 在新表上重建
+    conn.execute("BEGIN")
+    conn.execute("DROP TABLE messages")
+    conn.execute("ALTER TABLE messages_v1 RENAME TO messages")
+    logger.info(f"messages 表已迁移为整数时间戳，本次复制 {copied} 行。")
+
+
+def _migrate_text_codec(conn: sqlite3.Connection, batch_size: int):
+    """
+    版本 2：为 messages 增加文本编码列，编辑历史可以存储为相对上一版本的差量。
+
+    已有的行均为 TEXT_PLAIN (0)，无需改写；ADD COLUMN 只修改表结构，不复制数据。
+    """
+    conn.execute("BEGIN")
+    conn.execute("ALTER TABLE messages ADD COLUMN text_codec INTEGER NOT NULL DEFAULT 0")
+    conn.execute("ALTER TABLE messages ADD COLUMN text_blob BLOB")
+    # 差量的基准版本 (相同 chat_id, id 下的 edited_time)
+    conn.execute("ALTER TABLE messages ADD COLUMN text_base INTEGER")
+
+
+def has_fulltext_index(conn: sqlite3.Connection) -> bool:
+    """messages_fts 全文索引是否存在（旧版 SQLite 可能不支持 FTS5 trigram）。"""
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'"
+    ).fetchone() is not None
+
+
+def _migrate_fulltext_index(conn: sqlite3.Connection, batch_size: int):
+    """
+    版本 3：建立 messages_fts 全文索引（FTS5 trigram 分词，支持中文子串匹配）。
+
+    索引为无内容表 (content='')，只保存倒排索引，rowid 与 messages 相同；
+    由于 messages 中的文本可能是压缩或差量存储，索引写入的是还原后的明文。
+    已有消息按 rowid 分批回填，中断后从索引中最大的 rowid 继续。
+    """
+    try:
+        conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts "
+            "USING fts5(msg_text, content='', tokenize='trigram')"
+        )
+    except sqlite3.OperationalError as e:
+        logger.warning(f"当前 SQLite 不支持 FTS5 trigram 分词器，全文索引不可用，搜索将退回逐行匹配: {e}")
+        return
+    conn.commit()
+
+    last_rowid = conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM messages_fts").fetchone()[0]
+    indexed = 0
+    while True:
+        rows = conn.execute(
+            "SELECT rowid, * FROM messages WHERE rowid > ? ORDER BY rowid LIMIT ?",
+            (last_rowid, batch_size),
+        ).fetchall()
+        if not rows:
+            break
+        entries = []
+        for row in rows:
+            text = row_text(conn, row)
+            if text:
+                entries.append((row["rowid"], text))
+        conn.executemany("INSERT INTO messages_fts (rowid, msg_text) VALUES (?, ?)", entries)
+        conn.commit()
+        indexed += len(entries)
+        last_rowid = rows[-1]["rowid"]
+        logger.debug(f"回填全文索引: 已处理至 rowid {last_rowid}")
+    logger.info(f"全文索引已建立，本次回填 {indexed} 条消息。")
+
+
+def _migrate_media_blobs(conn: sqlite3.Connection, batch_size: int):
+    """
+    版本 4：媒体去重表。
+
+    media_blobs 每个加密媒体文件一行，content_hash 为明文 SHA-256，
+    refcount 为引用该文件的消息行数（随消息写入和过期删除增减），
+    last_used 为最近一次被引用的时间；media_blob_keys 把 Telegram 的
+    Document.id / Photo.id 映射到文件，命中时无需下载。
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS media_blobs (
+            path TEXT PRIMARY KEY,
+            content_hash TEXT NOT NULL UNIQUE,
+            size INTEGER NOT NULL DEFAULT 0,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            last_used INTEGER NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_media_blobs_unused ON media_blobs (refcount, last_used)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS media_blob_keys (
+            media_key TEXT PRIMARY KEY,
+            path TEXT NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_media_blob_keys_path ON media_blob_keys (path)")
+
+
+def _migrate_media_packs(conn: sqlite3.Connection, batch_size: int):
+    """
+    版本 5：小媒体打包存储。
+
+    小于阈值的媒体不再单独成文件，而是追加到 media/packs/ 下的打包文件中；
+    media_blobs 记录其所在的打包文件、偏移和长度（单独保存的文件这三列为 NULL）。
+    """
+    conn.execute("BEGIN")
+    conn.execute("ALTER TABLE media_blobs ADD COLUMN pack_path TEXT")
+    conn.execute("ALTER TABLE media_blobs ADD COLUMN pack_offset INTEGER")
+    conn.execute("ALTER TABLE media_blobs ADD COLUMN pack_length INTEGER")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_media_blobs_pack ON media_blobs (pack_path)")
+
+
+def _migrate_entities(conn: sqlite3.Connection, batch_size: int):
+    """
+    版本 6：实体信息缓存表。
+
+    保存用户/群组/频道的显示名称和用户名（id 为 Telethon 的 peer id，群组/频道为负数），
+    供提及渲染在重启后仍可直接使用，无需调用 get_entity。
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS entities (
+            id INTEGER PRIMARY KEY,
+            kind TEXT NOT NULL,
+            name TEXT NOT NULL,
+            username TEXT,
+            updated_at INTEGER NOT NULL
+        )
+    """)
+
+
+def _migrate_media_path_index(conn: sqlite3.Connection, batch_size: int):
+    """
+    版本 7：messages 及已有分区表增加 media_path 部分索引。
+
+    淘汰去重媒体时需要清除引用它的消息行的 media_path，否则重新下载到同一路径后，
+    旧消息过期会减少新记录的引用计数并删除仍在使用的文件。
+    """
+    names = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+    for table in [BASE_TABLE] + [name for name in names if Partition.parse(name)]:
+        create_media_path_index(conn, table)
+
+
+# 消息表中除 rowid 外的全部列
+_MESSAGE_COLUMNS = (
+    "id, from_id, chat_id, type, msg_text, media_path, noforwards, self_destructing, "
+    "created_time, edited_time, text_codec, text_blob, text_base"
+)
+
+
+def _migrate_explicit_rowid(conn: sqlite3.Connection, batch_size: int):
+    """
+    版本 8：messages 及已有分区表改为显式的 msg_rowid INTEGER PRIMARY KEY。
+
+    无内容全文索引按 rowid 关联消息行，而复合主键表的隐式 rowid 在 VACUUM 时可能被重新编号，
+    索引会因此指向错误的消息。每张表按 rowid 分批复制到新表并保留原 rowid（全文索引无需重建），
+    原主键 (chat_id, id, edited_time) 改为 UNIQUE 约束。已完成的表会被跳过，中断后从断点继续。
+    """
+    names = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+    for table in [BASE_TABLE] + [name for name in names if Partition.parse(name)]:
+        columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+        if "msg_rowid" in columns:
+            continue
+        rebuilt = f"{table}_v8"
+        create_message_table(conn, rebuilt)
+        conn.commit()
+
+        last_rowid = conn.execute(f"SELECT COALESCE(MAX(msg_rowid), 0) FROM {rebuilt}").fetchone()[0]
+        while True:
+            end_rowid = conn.execute(
+                f"SELECT MAX(rowid) FROM (SELECT rowid FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?)",
+                (last_rowid, batch_size),
+            ).fetchone()[0]
+            if end_rowid is None:
+                break
+            conn.execute(
+                f"INSERT OR IGNORE INTO {rebuilt} (msg_rowid, {_MESSAGE_COLUMNS}) "
+                f"SELECT rowid, {_MESSAGE_COLUMNS} FROM {table} WHERE rowid > ? AND rowid <= ?",
+                (last_rowid, end_rowid),
+            )
+            conn.commit()
+            last_rowid = end_rowid
+            logger.debug(f"迁移 {table} 显式 rowid: 已复制至 rowid {last_rowid}")
+
+        # 旧表上的索引随表一起删除：分区表的索引在此重建，messages 的索引由 _create_tables 重建
+        conn.execute("BEGIN")
+        conn.execute(f"DROP TABLE {table}")
+        conn.execute(f"ALTER TABLE {rebuilt} RENAME TO {table}")
+        if table == BASE_TABLE:
+            create_media_path_index(conn, table)
+        else:
+            create_partition_table(conn, table, with_fts=False)
+        conn.commit()
+        logger.info(f"{table} 已改为显式 rowid 主键。")
+
+
+def _migrate_id_ranges(conn: sqlite3.Connection, batch_size: int):
+    """
+    版本 9：记录每个分区中各聊天的消息 ID 范围。
+
+    没有时间戳的单条查找（按 (chat_id, id) 或只按 id）原本要依次查询全部分区，
+    有了范围后只查询可能包含该 ID 的分区。已有分区的范围由主键索引聚合得到。
+    """
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {ID_RANGES_TABLE} (
+            table_name TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            min_id INTEGER NOT NULL,
+            max_id INTEGER NOT NULL,
+            PRIMARY KEY (table_name, chat_id)
+        )
+    """)
+    names = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+    for table in [name for name in names if Partition.parse(name)]:
+        conn.execute(
+            f"INSERT OR REPLACE INTO {ID_RANGES_TABLE} (table_name, chat_id, min_id, max_id) "
+            f"SELECT ?, chat_id, MIN(id), MAX(id) FROM {table} GROUP BY chat_id",
+            (table,),
+        )
+
+
+# 单条 SQL 中 IN 列表的最大参数数量
+_IN_CHUNK = 500
+
+# 登记旧媒体文件时使用的 content_hash 前缀：这些文件没有计算过内容哈希，不参与内容去重
+LEGACY_MEDIA_HASH_PREFIX = "legacy:"
+
+
+def _migrate_legacy_media(conn: sqlite3.Connection, batch_size: int):
+    """
+    版本 10：把去重之前按消息保存的媒体文件登记到 media_blobs。
+
+    这些文件不在 media_blobs 中，既不计入媒体容量，也不会被容量淘汰。每个仍存在的文件登记一条记录：
+    size 为磁盘上的文件大小，refcount 为引用它的消息行数，last_used 为其中最新消息的创建时间，
+    因此容量淘汰按时间从旧到新选择它们。已丢失的文件不登记。
+    每张消息表按 msg_rowid 分批扫描，进度与登记记录在同一事务中写入 media_legacy_scan，中断后从断点继续。
+    """
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS media_legacy_scan (table_name TEXT PRIMARY KEY, last_rowid INTEGER NOT NULL)"
+    )
+    conn.commit()
+
+    names = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+    registered = 0
+    for table in [BASE_TABLE] + [name for name in names if Partition.parse(name)]:
+        row = conn.execute("SELECT last_rowid FROM media_legacy_scan WHERE table_name = ?", (table,)).fetchone()
+        last_rowid = row[0] if row else 0
+        while True:
+            rows = conn.execute(
+                f"SELECT msg_rowid, media_path, created_time FROM {table} "
+                f"WHERE msg_rowid > ? ORDER BY msg_rowid LIMIT ?",
+                (last_rowid, batch_size),
+            ).fetchall()
+            if not rows:
+                break
+            # 路径 -> [引用行数, 最新创建时间]
+            refs: Dict[str, List[int]] = {}
+            for msg in rows:
+                if msg["media_path"]:
+                    ref = refs.setdefault(msg["media_path"], [0, 0])
+                    ref[0] += 1
+                    ref[1] = max(ref[1], msg["created_time"])
+            # 去重后保存的文件已由消息写入维护引用计数
+            paths = list(refs)
+            managed = set()
+            for start in range(0, len(paths), _IN_CHUNK):
+                chunk = paths[start:start + _IN_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                managed.update(
+                    blob[0] for blob in conn.execute(
+                        f"SELECT path FROM media_blobs WHERE path IN ({placeholders}) "
+                        f"AND content_hash NOT LIKE '{LEGACY_MEDIA_HASH_PREFIX}%'",
+                        chunk,
+                    )
+                )
+            entries = []
+            for path, (count, newest) in refs.items():
+                if path in managed:
+                    continue
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    continue
+                entries.append((path, LEGACY_MEDIA_HASH_PREFIX + path, size, count, newest))
+            # 同一文件可能被之前批次中的消息引用
+            conn.executemany(
+                "INSERT INTO media_blobs (path, content_hash, size, refcount, last_used) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET refcount = refcount + excluded.refcount, "
+                "last_used = MAX(last_used, excluded.last_used)",
+                entries,
+            )
+            last_rowid = rows[-1]["msg_rowid"]
+            conn.execute(
+                "INSERT OR REPLACE INTO media_legacy_scan (table_name, last_rowid) VALUES (?, ?)",
+                (table, last_rowid),
+            )
+            conn.commit()
+            registered += len(entries)
+            logger.debug(f"登记 {table} 中的旧媒体文件: 已处理至 rowid {last_rowid}")
+
+    conn.execute("BEGIN")
+    conn.execute("DROP TABLE media_legacy_scan")
+    logger.info(f"旧媒体文件已登记到 media_blobs，本次登记或更新 {registered} 条记录。")
+
+
+# (目标版本, 描述, 迁移函数)，按版本递增排列
+MIGRATIONS: List[Tuple[int, str, Callable[[sqlite3.Connection, int], None]]] = [
+    (1, "messages 时间戳改为整数 Unix 时间", _migrate_integer_timestamps),
+    (2, "messages 增加文本编码列（压缩/差量存储）", _migrate_text_codec),
+    (3, "建立 messages_fts 全文索引", _migrate_fulltext_index),
+    (4, "增加媒体去重表 media_blobs", _migrate_media_blobs),
+    (5, "media_blobs 增加打包存储位置", _migrate_media_packs),
+    (6, "增加实体信息缓存表 entities", _migrate_entities),
+    (7, "消息表增加 media_path 索引", _migrate_media_path_index),
+    (8, "消息表改为显式 rowid 主键", _migrate_explicit_rowid),
+    (9, "记录分区中的消息 ID 范围", _migrate_id_ranges),
+    (10, "登记去重之前保存的媒体文件", _migrate_legacy_media),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def run_migrations(conn: sqlite3.Connection, batch_size: int = MIGRATION_BATCH_SIZE) -> int:
+    """
+    依次执行尚未应用的迁移，并通过 PRAGMA user_version 记录当前结构版本。
+
+    Returns:
+        int: 迁移完成后的结构版本。
+    """
+    current = _get_user_version(conn)
+    if current > LATEST_VERSION:
+        logger.warning(
+            f"数据库结构版本 {current} 高于程序支持的版本 {LATEST_VERSION}，跳过迁移。"
+        )
+        return current
+
+    # 迁移函数按列名读取行
+    row_factory = conn.row_factory
+    conn.row_factory = sqlite3.Row
+    try:
+        for version, description, migrate in MIGRATIONS:
+            if version <= current:
+                continue
+            logger.info(f"执行数据库迁移 {current} -> {version}: {description}")
+            try:
+                migrate(conn, batch_size)
+                _set_user_version(conn, version)
+                conn.commit()
+            except sqlite3.Error:
+                conn.rollback()
+                logger.critical(f"数据库迁移到版本 {version} 失败", exc_info=True)
+                raise
+            current = version
+    finally:
+        conn.row_factory = row_factory
+    return current
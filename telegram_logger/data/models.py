@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime
 from typing import Optional, List, Dict, Any
 
@@ -20,6 +20,20 @@ class Message:
         return bool(self.media_path)
 
 
+@dataclass(frozen=True)
+class EntityInfo:
+    """用户/群组/频道渲染提及所需的信息。id 为 peer id（群组/频道为负数）。"""
+    id: int
+    kind: str  # 'user'、'bot'、'group' 或 'channel'
+    name: str  # 用户为 "姓 名"，群组/频道为标题
+    username: Optional[str] = None
+    updated_at: int = 0  # Unix 时间戳（秒）
+
+    @property
+    def is_user(self) -> bool:
+        return self.kind in ('user', 'bot')
+
+
 @dataclass(frozen=True)
 class RoleDetails:
     """表示从数据库读取的角色配置的数据类。"""
@@ -29,3 +43,64 @@ class RoleDetails:
     static_content: Optional[str] = None  # 仅用于 static 类型
     system_prompt: Optional[str] = None  # 仅用于 ai 类型
     preset_messages: Optional[str] = None  # 存储原始 JSON 字符串, 仅用于 ai 类型
+
+
+@dataclass
+class ExpiryStats:
+    """一次过期清理的统计信息。"""
+    deleted_rows: int = 0
+    deleted_files: int = 0
+    missing_files: int = 0
+    failed_files: int = 0
+    batches: int = 0
+    dropped_partitions: int = 0
+    elapsed: float = 0.0  # 秒
+    rows_by_type: Dict[str, int] = field(default_factory=dict)
+
+    @property
+    def total(self) -> int:
+        """清理的项目总数（数据库记录 + 文件）。"""
+        return self.deleted_rows + self.deleted_files
+
+
+@dataclass
+class StorageUsage:
+    """媒体和数据库占用的字节数，以及媒体目录所在磁盘的剩余空间。"""
+    media_bytes: int = 0
+    db_bytes: int = 0
+    free_bytes: int = 0
+
+
+@dataclass
+class EvictionReport:
+    """一次容量淘汰的结果。"""
+    reasons: List[str] = field(default_factory=list)  # 触发淘汰的原因，例如 "media_quota"
+    evicted_media: int = 0
+    evicted_media_bytes: int = 0
+    deleted_files: int = 0
+    evicted_messages: int = 0
+    before: Optional[StorageUsage] = None
+    after: Optional[StorageUsage] = None
+
+    @property
+    def total(self) -> int:
+        return self.evicted_media + self.evicted_messages
+
+
+@dataclass
+class StageTiming:
+    """事件流水线单个阶段的累计耗时统计（秒）。"""
+    count: int = 0
+    errors: int = 0
+    total: float = 0.0
+    max: float = 0.0
+
+    def record(self, elapsed: float, failed: bool = False):
+        self.count += 1
+        self.errors += int(failed)
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
@@ -0,0 +1,276 @@
+import logging
+import re
+import sqlite3
+import threading
+from dataclasses import dataclass
+from datetime import datetime, time, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .codec import datetime_to_epoch
+
+logger = logging.getLogger(__name__)
+
+# 未分区的消息表（非分区模式下的唯一消息表，分区模式下保存启用分区前的旧消息）
+BASE_TABLE = "messages"
+
+# 分区周期（天数），0 表示不分区
+PARTITION_PERIODS = {"none": 0, "day": 1, "week": 7}
+
+# 每个分区中各聊天的消息 ID 范围，没有时间戳的单条查找据此跳过不可能包含该消息的分区
+ID_RANGES_TABLE = "message_id_ranges"
+
+# 分区表命名：messages_p<起始日期 YYYYMMDD>_<天数>，例如 messages_p20240101_7
+_PARTITION_RE = re.compile(r"^messages_p(\d{8})_(\d+)$")
+
+
+@dataclass(frozen=True)
+class Partition:
+    """一个按创建时间划分的消息分区表，覆盖 [start, end) 时间段（UTC）。"""
+    start: datetime
+    days: int
+
+    @property
+    def name(self) -> str:
+        return f"messages_p{self.start:%Y%m%d}_{self.days}"
+
+    @property
+    def end(self) -> datetime:
+        return self.start + timedelta(days=self.days)
+
+    @classmethod
+    def parse(cls, name: str) -> Optional["Partition"]:
+        match = _PARTITION_RE.match(name)
+        if not match:
+            return None
+        start = datetime.strptime(match.group(1), "%Y%m%d").replace(tzinfo=timezone.utc)
+        return cls(start=start, days=int(match.group(2)))
+
+
+def fts_table(table: str) -> str:
+    """消息表对应的全文索引表名。"""
+    return f"{table}_fts"
+
+
+def create_media_path_index(conn: sqlite3.Connection, table: str):
+    """按 media_path 的部分索引，淘汰去重媒体时据此找到引用它的消息行。"""
+    conn.execute(
+        f"CREATE INDEX IF NOT EXISTS idx_{table}_media_path ON {table} (media_path) WHERE media_path IS NOT NULL"
+    )
+
+
+def create_message_table(conn: sqlite3.Connection, table: str):
+    """
+    按当前（最新版本）结构创建消息表。
+
+    msg_rowid 是显式的 INTEGER PRIMARY KEY（rowid 的别名），全文索引按它关联消息行；
+    没有显式整数主键的表在 VACUUM 时 rowid 可能被重新编号，无内容全文索引会因此错位。
+    """
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            msg_rowid INTEGER PRIMARY KEY,
+            id INTEGER,
+            from_id INTEGER,
+            chat_id INTEGER,
+            type INTEGER,
+            msg_text TEXT,
+            media_path TEXT,
+            noforwards INTEGER DEFAULT 0,
+            self_destructing INTEGER DEFAULT 0,
+            created_time INTEGER NOT NULL,
+            edited_time INTEGER NOT NULL DEFAULT 0,
+            text_codec INTEGER NOT NULL DEFAULT 0,
+            text_blob BLOB,
+            text_base INTEGER,
+            UNIQUE (chat_id, id, edited_time)
+        )
+    """)
+
+
+def create_partition_table(conn: sqlite3.Connection, table: str, with_fts: bool):
+    """按当前（最新版本）结构创建一个分区表及其索引。"""
+    create_message_table(conn, table)
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_id ON {table} (id, created_time, edited_time)")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_type_created ON {table} (type, created_time)")
+    create_media_path_index(conn, table)
+    if with_fts:
+        conn.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table(table)} "
+            f"USING fts5(msg_text, content='', tokenize='trigram')"
+        )
+
+
+class MessagePartitionRouter:
+    """
+    消息分区路由。
+
+    分区模式下，消息按 created_time 写入按天或按周划分的分区表，
+    同一消息的所有版本 created_time 相同，因此总在同一分区内。
+    读取时按分区从新到旧依次查询，最后查询未分区的 messages 表；
+    过期清理时整表删除，无需逐行 DELETE。
+
+    写入时记录每个分区中各聊天的消息 ID 范围（只扩大不缩小），
+    按 ID 查找时由 tables_for_ids 跳过范围不包含该 ID 的分区，查询的分区数不再随保留天数增长。
+    """
+
+    def __init__(self, period: str = "none", with_fts: bool = False):
+        if period not in PARTITION_PERIODS:
+            raise ValueError(f"无效的分区周期: {period}，可选值: {list(PARTITION_PERIODS)}")
+        self.period = period
+        self.days = PARTITION_PERIODS[period]
+        self.with_fts = with_fts
+        self._partitions: Dict[str, Partition] = {}
+        # 分区表名按时间从新到旧排列，分区增删时更新，查找时无需重新排序
+        self._newest_first: List[str] = []
+        # 分区表 -> {chat_id: (最小 ID, 最大 ID)}，键 None 为该分区中所有聊天合并后的范围
+        self._id_ranges: Dict[str, Dict[Optional[int], Tuple[int, int]]] = {}
+        # chat_id -> 按时间从新到旧的 [(分区表, 最小 ID, 最大 ID)]，由 _id_ranges 派生，供查找时直接遍历
+        self._range_index: Dict[Optional[int], List[Tuple[str, int, int]]] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.days > 0
+
+    def load(self, conn: sqlite3.Connection):
+        """从数据库中发现已有的分区表（包括以其他周期创建的分区）。"""
+        names = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        rows = []
+        if ID_RANGES_TABLE in names:
+            rows = conn.execute(f"SELECT table_name, chat_id, min_id, max_id FROM {ID_RANGES_TABLE}").fetchall()
+        with self._lock:
+            for name in names:
+                partition = Partition.parse(name)
+                if partition:
+                    self._partitions[name] = partition
+            for table, chat_id, min_id, max_id in rows:
+                ranges = self._id_ranges.setdefault(table, {})
+                self._widen(ranges, chat_id, min_id, max_id)
+                self._widen(ranges, None, min_id, max_id)
+            self._reorder()
+        if self._partitions:
+            logger.info(f"已加载 {len(self._partitions)} 个消息分区表")
+
+    def partition_for(self, created_time: datetime) -> Optional[Partition]:
+        """计算消息所属的分区，非分区模式返回 None。"""
+        if not self.enabled:
+            return None
+        if created_time.tzinfo is None:
+            created_time = created_time.astimezone()  # 无时区信息按本地时间处理，与 datetime_to_epoch 一致
+        day = created_time.astimezone(timezone.utc).date()
+        if self.days == 7:
+            day -= timedelta(days=day.weekday())  # 按周分区从周一开始
+        start = datetime.combine(day, time.min, tzinfo=timezone.utc)
+        return Partition(start=start, days=self.days)
+
+    def table_for(self, created_time: datetime) -> str:
+        """消息应写入的表名。"""
+        partition = self.partition_for(created_time)
+        return partition.name if partition else BASE_TABLE
+
+    def ensure(self, conn: sqlite3.Connection, tables: Iterable[str]):
+        """在写连接上创建尚不存在的分区表。需在写入分区之前单独提交，读连接才能看到新表。"""
+        created = []
+        for table in tables:
+            if table == BASE_TABLE or table in self._partitions:
+                continue
+            partition = Partition.parse(table)
+            if partition is None:
+                raise ValueError(f"无效的分区表名: {table}")
+            create_partition_table(conn, table, self.with_fts)
+            created.append(partition)
+        if created:
+            conn.commit()
+            with self._lock:
+                for partition in created:
+                    self._partitions[partition.name] = partition
+                self._reorder()
+            logger.info(f"已创建消息分区表: {[p.name for p in created]}")
+
+    def tables(self, since: Optional[datetime] = None) -> List[str]:
+        """按时间从新到旧列出需要查询的消息表，since 之前结束的分区会被跳过。"""
+        with self._lock:
+            names = list(self._newest_first)
+            if since is not None:
+                since_epoch = datetime_to_epoch(since)
+                names = [name for name in names if datetime_to_epoch(self._partitions[name].end) > since_epoch]
+        return names + [BASE_TABLE]
+
+    def tables_for_ids(self, message_ids: Iterable[int], chat_id: Optional[int] = None) -> List[str]:
+        """
+        按时间从新到旧列出可能包含这些消息 ID 的表。chat_id 为 None 时（私聊删除事件）
+        按分区中所有聊天合并后的范围判断。未分区的 messages 表没有范围记录，总会被查询。
+        """
+        ids = list(message_ids)
+        with self._lock:
+            entries = self._range_index.get(chat_id, [])
+        if len(ids) == 1:
+            msg_id = ids[0]
+            candidates = [name for name, low, high in entries if low <= msg_id <= high]
+        else:
+            candidates = [name for name, low, high in entries if any(low <= msg_id <= high for msg_id in ids)]
+        return candidates + [BASE_TABLE]
+
+    def record_ids(self, conn: sqlite3.Connection, table: str, chat_ranges: Dict[int, Tuple[int, int]]):
+        """
+        在写入消息的同一事务中扩大分区的 ID 范围。内存中的范围立即扩大：
+        事务回滚时范围只是偏大，查找多查一个分区，不会漏查。
+        """
+        if table == BASE_TABLE or not chat_ranges:
+            return
+        conn.executemany(
+            f"INSERT INTO {ID_RANGES_TABLE} (table_name, chat_id, min_id, max_id) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(table_name, chat_id) DO UPDATE SET "
+            "min_id = MIN(min_id, excluded.min_id), max_id = MAX(max_id, excluded.max_id)",
+            [(table, chat_id, min_id, max_id) for chat_id, (min_id, max_id) in chat_ranges.items()],
+        )
+        with self._lock:
+            self._merge_ranges(table, chat_ranges)
+
+    def _reorder(self):
+        """分区增删后重新排列分区表名并重建 ID 范围索引（调用方持有锁）。"""
+        self._newest_first = [
+            p.name for p in sorted(self._partitions.values(), key=lambda p: p.start, reverse=True)
+        ]
+        chat_ids = {chat_id for ranges in self._id_ranges.values() for chat_id in ranges}
+        self._range_index = {}
+        self._reindex(chat_ids)
+
+    def _reindex(self, chat_ids: Iterable[Optional[int]]):
+        for chat_id in chat_ids:
+            entries = []
+            for name in self._newest_first:
+                id_range = self._id_ranges.get(name, {}).get(chat_id)
+                if id_range:
+                    entries.append((name, *id_range))
+            self._range_index[chat_id] = entries
+
+    def _merge_ranges(self, table: str, chat_ranges: Dict[int, Tuple[int, int]]):
+        """合并 ID 范围并更新受影响聊天的索引（调用方持有锁）。"""
+        ranges = self._id_ranges.setdefault(table, {})
+        for chat_id, (min_id, max_id) in chat_ranges.items():
+            self._widen(ranges, chat_id, min_id, max_id)
+            self._widen(ranges, None, min_id, max_id)
+        self._reindex([*chat_ranges, None])
+
+    @staticmethod
+    def _widen(ranges: Dict[Optional[int], Tuple[int, int]], key: Optional[int], min_id: int, max_id: int):
+        current = ranges.get(key)
+        ranges[key] = (min(min_id, current[0]), max(max_id, current[1])) if current else (min_id, max_id)
+
+    def expired(self, cutoff: datetime) -> List[Partition]:
+        """返回结束时间不晚于 cutoff 的分区（其中所有消息都早于 cutoff）。"""
+        with self._lock:
+            return sorted(
+                (p for p in self._partitions.values() if p.end <= cutoff),
+                key=lambda p: p.start,
+            )
+
+    def drop(self, conn: sqlite3.Connection, partition: Partition):
+        """删除整个分区表及其全文索引。先从路由中移除，避免新的读取落到已删除的表。"""
+        with self._lock:
+            self._partitions.pop(partition.name, None)
+            self._id_ranges.pop(partition.name, None)
+            self._reorder()
+        conn.execute(f"DELETE FROM {ID_RANGES_TABLE} WHERE table_name = ?", (partition.name,))
+        conn.execute(f"DROP TABLE IF EXISTS {fts_table(partition.name)}")
+        conn.execute(f"DROP TABLE IF EXISTS {partition.name}")
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+Key = Tuple[int, int]
+
+
+class _Entry:
+    __slots__ = ("row", "media", "updated_at")
+
+    def __init__(self):
+        self.row = asyncio.Event()
+        self.media = asyncio.Event()
+        self.updated_at = time.monotonic()
+
+
+class PersistenceSignals:
+    """
+    消息持久化完成通知，键为 (chat_id, msg_id)。
+
+    PersistenceHandler 开始处理消息时调用 begin，消息行入队（此后即可读到）时调用 finish_row，
+    媒体保存完成（或失败、被丢弃）时调用 finish_media；OutputHandler 等消费者用 wait
+    带超时等待，而不是固定间隔轮询数据库。失败同样视为完成，等待方随即重新查询并自行回退。
+
+    只在事件循环线程中使用。已完成的条目保留 ttl 秒，总数超过 max_entries 时淘汰最早的。
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 300.0):
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self._entries: "OrderedDict[Key, _Entry]" = OrderedDict()
+
+        # 统计信息
+        self.waits = 0
+        self.timeouts = 0
+
+    def _entry(self, key: Key) -> _Entry:
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = _Entry()
+            self._prune()
+        return entry
+
+    def _prune(self):
+        now = time.monotonic()
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            finished = entry.row.is_set() and entry.media.is_set()
+            if len(self._entries) <= self.max_entries and not (finished and now - entry.updated_at > self.ttl):
+                break
+            self._entries.popitem(last=False)
+
+    def begin(self, chat_id: int, msg_id: int):
+        """开始持久化一个消息版本（新消息或编辑），之前已完成的通知重新变为未完成。"""
+        key = (chat_id, msg_id)
+        entry = self._entries.get(key)
+        if entry is not None and entry.row.is_set():
+            # 等待方持有的是旧版本的事件，已经完成，不受影响
+            del self._entries[key]
+        entry = self._entry(key)
+        entry.updated_at = time.monotonic()
+        self._entries.move_to_end(key)
+
+    def finish_row(self, chat_id: int, msg_id: int, media_pending: bool = False):
+        """消息行已可读取；media_pending 为 False 时媒体同时视为完成。"""
+        entry = self._entry((chat_id, msg_id))
+        entry.row.set()
+        if not media_pending:
+            entry.media.set()
+        entry.updated_at = time.monotonic()
+
+    def finish_media(self, chat_id: int, msg_id: int):
+        """媒体已保存（或保存失败）。"""
+        entry = self._entry((chat_id, msg_id))
+        entry.row.set()
+        entry.media.set()
+        entry.updated_at = time.monotonic()
+
+    def is_pending(self, chat_id: int, msg_id: int, media: bool = False) -> bool:
+        """消息是否正在持久化（已 begin 但尚未完成）。"""
+        entry = self._entries.get((chat_id, msg_id))
+        if entry is None:
+            return False
+        return not (entry.media if media else entry.row).is_set()
+
+    async def wait(self, chat_id: int, msg_id: int, timeout: Optional[float], media: bool = False) -> bool:
+        """
+        等待消息行（media 为 True 时等待媒体）持久化完成。
+        未被跟踪的消息（从未 begin 或已被淘汰）不会有完成通知，立即返回 False，也不创建条目。
+
+        Returns:
+            bool: 是否在超时前完成。
+        """
+        entry = self._entries.get((chat_id, msg_id))
+        if entry is None:
+            return False
+        event = entry.media if media else entry.row
+        if event.is_set():
+            return True
+        self.waits += 1
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            logger.debug(f"等待消息持久化超时 ({timeout} 秒): ChatID={chat_id}, MsgID={msg_id}, media={media}")
+            return False
@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, List, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# 所有连接共用的性能相关 PRAGMA
+_COMMON_PRAGMAS = (
+    "PRAGMA synchronous = NORMAL",  # WAL 模式下 NORMAL 足够安全，且避免每次提交都 fsync
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",  # 约 16MB 页缓存
+    "PRAGMA mmap_size = 134217728",  # 128MB 内存映射读
+)
+
+
+class SQLiteConnectionPool:
+    """
+    单写多读的长连接 SQLite 连接池。
+
+    - 写连接只有一个，固定在单线程的写执行器上，所有写操作在此串行执行；
+    - 读连接每个读线程一个（线程本地），在读执行器上并发执行；
+    - 数据库使用 WAL 日志模式，读操作不会阻塞写入，写入也不会阻塞读取。
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        reader_count: int = 4,
+        busy_timeout_ms: int = 5000,
+        auto_vacuum: Optional[str] = None,
+    ):
+        """
+        Args:
+            auto_vacuum: 新建数据库时使用的 auto_vacuum 模式（如 'INCREMENTAL'）。
+                只对尚未建表的新数据库生效，已有数据库需 VACUUM 后才能切换。
+        """
+        self.db_path = db_path
+        self.auto_vacuum = auto_vacuum
+        self.reader_count = max(1, reader_count)
+        self.busy_timeout_ms = busy_timeout_ms
+        self._writer_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._reader_executor = ThreadPoolExecutor(max_workers=self.reader_count, thread_name_prefix="db-reader")
+        self._local = threading.local()
+        self._readers: List[sqlite3.Connection] = []
+        self._readers_lock = threading.Lock()
+        self._closed = False
+        # 写连接在写线程上创建，之后只在该线程使用
+        self._writer: sqlite3.Connection = self._writer_executor.submit(self._open, False).result()
+        logger.info(f"SQLite 连接池已初始化: {db_path} (1 个写连接, 最多 {self.reader_count} 个读连接, WAL)")
+
+    def _open(self, readonly: bool) -> sqlite3.Connection:
+        """创建并配置一个连接。"""
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout_ms / 1000,
+            check_same_thread=False,
+        )
+        conn.row_factory = sqlite3.Row
+        if not readonly:
+            if self.auto_vacuum:
+                # 必须在切换 WAL 之前设置，否则新数据库文件已初始化，设置不再生效
+                conn.execute(f"PRAGMA auto_vacuum = {self.auto_vacuum}")
+            # journal_mode 是持久化设置，由写连接负责切换
+            mode = conn.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+            if str(mode).lower() != "wal":
+                logger.warning(f"无法将数据库切换为 WAL 模式，当前模式: {mode}")
+        conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout_ms)}")
+        for pragma in _COMMON_PRAGMAS:
+            conn.execute(pragma)
+        if readonly:
+            conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    def _reader(self) -> sqlite3.Connection:
+        """获取当前读线程的连接，不存在时创建。"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._open(True)
+            self._local.conn = conn
+            with self._readers_lock:
+                self._readers.append(conn)
+        return conn
+
+    # --- 在执行器线程中运行的包装函数 ---
+
+    def _run_write(self, fn: Callable[..., T], *args: Any) -> T:
+        conn = self._writer
+        try:
+            result = fn(conn, *args)
+            conn.commit()
+            return result
+        except BaseException:
+            conn.rollback()
+            raise
+
+    def _run_read(self, fn: Callable[..., T], *args: Any) -> T:
+        conn = self._reader()
+        try:
+            return fn(conn, *args)
+        finally:
+            # 结束可能残留的读事务，避免长期持有旧快照阻止 WAL checkpoint
+            if conn.in_transaction:
+                conn.rollback()
+
+    # --- 公共 API ---
+
+    async def write(self, fn: Callable[..., T], *args: Any) -> T:
+        """在写线程上执行 fn(conn, *args)，成功时提交，异常时回滚。"""
+        self._check_open()
+        return await asyncio.wrap_future(self._writer_executor.submit(self._run_write, fn, *args))
+
+    async def read(self, fn: Callable[..., T], *args: Any) -> T:
+        """在读线程上执行 fn(conn, *args)。"""
+        self._check_open()
+        return await asyncio.wrap_future(self._reader_executor.submit(self._run_read, fn, *args))
+
+    def write_sync(self, fn: Callable[..., T], *args: Any, timeout: Optional[float] = None) -> T:
+        """write() 的同步版本，供非协程代码（如写入队列线程）使用。"""
+        self._check_open()
+        return self._writer_executor.submit(self._run_write, fn, *args).result(timeout)
+
+    def read_sync(self, fn: Callable[..., T], *args: Any, timeout: Optional[float] = None) -> T:
+        """read() 的同步版本。"""
+        self._check_open()
+        return self._reader_executor.submit(self._run_read, fn, *args).result(timeout)
+
+    def submit_write(self, fn: Callable[..., T], *args: Any) -> Future:
+        """提交写操作但不等待结果，用于缓存回写等可合并、可延迟的写入。"""
+        self._check_open()
+        return self._writer_executor.submit(self._run_write, fn, *args)
+
+    def _check_open(self):
+        if self._closed:
+            raise sqlite3.ProgrammingError("连接池已关闭")
+
+    def close(self):
+        """等待进行中的任务结束并关闭所有连接。"""
+        if self._closed:
+            return
+        self._closed = True
+        self._reader_executor.shutdown(wait=True)
+        with self._readers_lock:
+            for conn in self._readers:
+                try:
+                    conn.close()
+                except sqlite3.Error:
+                    pass
+            self._readers.clear()
+        # 写连接在写线程上关闭，关闭前做一次 checkpoint 缩减 WAL 文件
+        def _close_writer():
+            try:
+                self._writer.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            except sqlite3.Error as e:
+                logger.warning(f"关闭前执行 WAL checkpoint 失败: {e}")
+            self._writer.close()
+
+        self._writer_executor.submit(_close_writer).result()
+        self._writer_executor.shutdown(wait=True)
+        logger.info("SQLite 连接池已关闭")
@@ -0,0 +1,81 @@
+import logging
+import threading
+from typing import Dict, Optional
+
+from telethon import utils
+from telethon.tl.types import Channel, Chat, PeerChannel, PeerChat, UpdateChannel, UpdateChat
+
+logger = logging.getLogger(__name__)
+
+
+class ChatRestrictionCache:
+    """
+    聊天级别转发限制（noforwards）的内存缓存，键为带标记的聊天 ID。
+
+    - 由 Telethon 随更新下发的 Chat/Channel 实体填充（observe），不额外调用 API；
+    - 收到 UpdateChannel/UpdateChat（聊天设置变化）时用更新携带的实体刷新，
+      没有携带实体时使缓存失效，下次观察到实体时再填充；
+    - is_restricted 是同步的，未知时返回 None，由调用方决定是否获取聊天实体。
+    """
+
+    # 需要监听的聊天更新类型
+    UPDATE_TYPES = (UpdateChannel, UpdateChat)
+
+    def __init__(self):
+        self._restricted: Dict[int, bool] = {}
+        self._lock = threading.Lock()
+
+        # 统计信息
+        self.hits = 0
+        self.misses = 0
+
+    def observe(self, *entities):
+        """记录实体的 noforwards 状态，忽略用户和 min 实体（不含完整的标志位）。"""
+        for entity in entities:
+            if not isinstance(entity, (Chat, Channel)) or getattr(entity, "min", False):
+                continue
+            chat_id = utils.get_peer_id(entity)
+            restricted = bool(getattr(entity, "noforwards", False))
+            with self._lock:
+                previous = self._restricted.get(chat_id)
+                self._restricted[chat_id] = restricted
+            if previous is not None and previous != restricted:
+                logger.info(f"聊天 {chat_id} 的转发限制已变更: noforwards={restricted}")
+
+    def is_restricted(self, chat_id: Optional[int]) -> Optional[bool]:
+        """返回聊天是否禁止转发；未缓存时返回 None。"""
+        with self._lock:
+            restricted = self._restricted.get(chat_id)
+        if restricted is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return restricted
+
+    def invalidate(self, chat_id: int):
+        with self._lock:
+            self._restricted.pop(chat_id, None)
+
+    def handle_update(self, update):
+        """处理 UpdateChannel/UpdateChat：优先用更新携带的实体刷新，否则使缓存失效。"""
+        if isinstance(update, UpdateChannel):
+            chat_id = utils.get_peer_id(PeerChannel(update.channel_id))
+        elif isinstance(update, UpdateChat):
+            chat_id = utils.get_peer_id(PeerChat(update.chat_id))
+        else:
+            return
+        entity = getattr(update, "_entities", {}).get(chat_id)
+        if isinstance(entity, (Chat, Channel)) and not getattr(entity, "min", False):
+            self.observe(entity)
+        else:
+            logger.debug(f"聊天 {chat_id} 的设置已更新，清除转发限制缓存")
+            self.invalidate(chat_id)
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._restricted),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -3,9 +3,10 @@ import logging
 from typing import Dict, Any, Optional, Union, List
 from telethon import events
 from telethon.events import common as EventCommon
-from telethon.tl.types import PeerUser, PeerChannel, PeerChat
 from telegram_logger.data.database import DatabaseManager
-from telegram_logger.data.models import Message
+from telegram_logger.data.models import EntityInfo, Message
+from telegram_logger.utils.mentions import EntityResolver
+from .event_context import EventContext, get_sender_id
 
 logger = logging.getLogger(__name__)
 
@@ -60,13 +61,16 @@ class BaseHandler(abc.ABC):
             logger.warning(f"无法在 init() 中初始化处理器 {self.__class__.__name__}：客户端为 None")
 
     @abc.abstractmethod
-    async def process(self, event: EventCommon) -> Optional[Union[Message, List[Message]]]:
+    async def process(
+        self, event: EventCommon, context: Optional[EventContext] = None
+    ) -> Optional[Union[Message, List[Message]]]:
         """处理事件。
 
         此方法必须由子类实现。
 
         Args:
             event: Telegram 事件对象。
+            context: 事件流水线共享的上下文（可选），其中的派生信息只计算一次。
 
         Returns:
             Optional[Union[Message, List[Message]]]: 处理后的消息对象（或列表）或 None。
@@ -81,6 +85,18 @@ class BaseHandler(abc.ABC):
         """
         self.db.save_message(message)
 
+    async def resolve_entities(self, entity_ids) -> Dict[int, EntityInfo]:
+        """批量解析实体信息：去重、查缓存，其余的用一次 get_entity 获取。
+
+        Args:
+            entity_ids: 需要解析的实体 ID（可重复，0 表示当前账号）。
+
+        Returns:
+            Dict[int, EntityInfo]: 解析成功的实体信息，无法解析的 ID 不在其中。
+        """
+        cache = self.db.entity_cache if self.db else None
+        return await EntityResolver(self.client, cache).resolve(entity_ids)
+
     def _get_sender_id(self, message) -> int:
         """从消息中获取发送者 ID。
 
@@ -90,30 +106,12 @@ class BaseHandler(abc.ABC):
         Returns:
             int: 发送者 ID。
         """
-        from_id = 0
-
-        # 处理发出的消息
-        if hasattr(message, 'out') and message.out:
-            return self._my_id if self._my_id else 0
-
-        # 处理不同的 peer 类型
-        if hasattr(message, 'peer_id'):
-            if isinstance(message.peer_id, PeerUser):
-                from_id = message.peer_id.user_id
-            elif isinstance(message.peer_id, PeerChannel):
-                from_id = message.peer_id.channel_id
-            elif isinstance(message.peer_id, PeerChat):
-                from_id = message.peer_id.chat_id
-
-        # 尝试从消息的 from_id 属性获取
-        if hasattr(message, 'from_id'):
-            if hasattr(message.from_id, 'user_id'):
-                from_id = message.from_id.user_id
-            elif hasattr(message.from_id, 'channel_id'):
-                from_id = message.from_id.channel_id
-                
-        return from_id
-    
+        return get_sender_id(message, self._my_id)
+
+    def _context(self, event, context: Optional[EventContext]) -> EventContext:
+        """返回流水线传入的上下文；直接调用 process 时为该事件新建一个。"""
+        return context if context is not None else EventContext(event, self.db, self._my_id)
+
     def set_client(self, client):
         """设置 Telethon 客户端实例。"""
         self.client = client
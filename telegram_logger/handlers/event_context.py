@@ -0,0 +1,167 @@
+import logging
+from functools import cached_property
+from typing import Dict, Optional
+
+import telethon.errors
+from telethon import events
+from telethon.tl.types import PeerChannel, PeerChat, PeerUser
+
+from telegram_logger.data.database import DatabaseManager
+from telegram_logger.data.models import Message
+
+logger = logging.getLogger(__name__)
+
+# 事件类型
+KIND_NEW = "new"
+KIND_EDITED = "edited"
+KIND_DELETED = "deleted"
+
+_UNSET = object()
+
+
+def get_sender_id(message, my_id: Optional[int] = None) -> int:
+    """从消息中获取发送者 ID，自己发出的消息返回 my_id（未知时为 0）。"""
+    from_id = 0
+
+    # 处理发出的消息
+    if hasattr(message, 'out') and message.out:
+        return my_id if my_id else 0
+
+    # 处理不同的 peer 类型
+    if hasattr(message, 'peer_id'):
+        if isinstance(message.peer_id, PeerUser):
+            from_id = message.peer_id.user_id
+        elif isinstance(message.peer_id, PeerChannel):
+            from_id = message.peer_id.channel_id
+        elif isinstance(message.peer_id, PeerChat):
+            from_id = message.peer_id.chat_id
+
+    # 尝试从消息的 from_id 属性获取
+    if hasattr(message, 'from_id'):
+        if hasattr(message.from_id, 'user_id'):
+            from_id = message.from_id.user_id
+        elif hasattr(message.from_id, 'channel_id'):
+            from_id = message.from_id.channel_id
+
+    return from_id
+
+
+class EventContext:
+    """
+    一次更新在流水线各阶段之间共享的上下文。
+
+    发送者 ID、发送者实体、消息类型、转发限制等派生信息在首次访问时计算并缓存，
+    同一更新的 persist、output、auto_reply 阶段不会重复计算或重复调用 API。
+    persist 阶段保存的 Message 对象放在 persisted 中供后续阶段使用。
+    """
+
+    def __init__(self, event, db: Optional[DatabaseManager] = None, my_id: Optional[int] = None):
+        self.event = event
+        self.db = db
+        self.my_id = my_id
+        self.persisted: Optional[Message] = None
+        # 各阶段耗时（秒），由 EventPipeline 填写
+        self.timings: Dict[str, float] = {}
+        self._sender = _UNSET
+        self._msg_type: Optional[int] = None
+        self._restricted: Optional[bool] = None
+
+    @cached_property
+    def kind(self) -> str:
+        # MessageEdited.Event 是 NewMessage.Event 的子类，需先判断
+        if isinstance(self.event, events.MessageEdited.Event):
+            return KIND_EDITED
+        if isinstance(self.event, events.MessageDeleted.Event):
+            return KIND_DELETED
+        return KIND_NEW
+
+    @property
+    def message(self):
+        """事件携带的 Telethon 消息；删除事件没有消息。"""
+        return None if self.kind == KIND_DELETED else getattr(self.event, "message", None)
+
+    @property
+    def chat_id(self) -> Optional[int]:
+        return getattr(self.event, "chat_id", None)
+
+    @property
+    def chat(self):
+        """随更新下发的聊天实体，不调用 API；未下发时为 None。"""
+        message = self.message
+        chat = getattr(message, "chat", None) if message is not None else None
+        return chat if chat is not None else getattr(self.event, "chat", None)
+
+    @cached_property
+    def sender_id(self) -> int:
+        return get_sender_id(self.message, self.my_id) if self.message is not None else 0
+
+    async def get_sender(self):
+        """发送者实体，只获取一次（通常随更新下发，无需 API 调用）。"""
+        if self._sender is _UNSET:
+            message = self.message
+            self._sender = await message.get_sender() if message is not None else None
+        return self._sender
+
+    async def get_msg_type(self) -> int:
+        """数据库中的消息类型（bot/user/group/channel），无法确定时为 0。"""
+        if self._msg_type is None:
+            message = self.message
+            sender = await self.get_sender()
+            msg_type = 0 # 默认为未知或不支持的类型
+            if getattr(sender, 'bot', False) if sender else False:
+                msg_type = DatabaseManager.MSG_TYPE_MAP['bot']
+            elif message.is_private:
+                msg_type = DatabaseManager.MSG_TYPE_MAP['user']
+            elif message.is_group:
+                msg_type = DatabaseManager.MSG_TYPE_MAP['group']
+            elif message.is_channel:
+                msg_type = DatabaseManager.MSG_TYPE_MAP['channel']
+            else:
+                logger.warning(f"无法确定消息类型 (消息 ID: {message.id}, ChatID: {message.chat_id})")
+            self._msg_type = msg_type
+        return self._msg_type
+
+    async def is_restricted(self) -> bool:
+        """消息本身或其所在聊天是否禁止转发。聊天状态先查转发限制缓存，未知时才获取聊天实体。"""
+        if self._restricted is None:
+            message = self.message
+            # 1. 检查消息本身的 noforwards 标志
+            message_restricted = bool(getattr(message, "noforwards", False))
+            # 2. 检查聊天级别的限制
+            chat_restricted = False if message.is_private else await self._is_chat_restricted()
+            self._restricted = message_restricted or chat_restricted
+            logger.debug(
+                f"消息 {message.id}: message_restricted={message_restricted}, "
+                f"chat_restricted={chat_restricted}, final is_restricted={self._restricted}"
+            )
+        return self._restricted
+
+    async def _is_chat_restricted(self) -> bool:
+        message = self.message
+        restrictions = self.db.chat_restrictions if self.db else None
+        if restrictions is not None:
+            restrictions.observe(self.chat)
+            cached = restrictions.is_restricted(message.chat_id)
+            if cached is not None:
+                return cached
+        try:
+            # 注意: message.get_chat() 可能需要额外的 API 调用
+            # 在某些情况下（例如来自匿名管理员的消息），get_chat 可能返回 None
+            chat = await message.get_chat()
+            if restrictions is not None:
+                restrictions.observe(chat)
+            if chat and getattr(chat, 'noforwards', False): # 检查聊天本身的 noforwards 属性
+                logger.debug(f"消息 {message.id} 所在的聊天 {getattr(chat, 'id', '未知')} 设置了 noforwards 限制。")
+                return True
+        except AttributeError as ae:
+            # 处理 message.get_chat() 可能不存在的情况 (虽然不太可能)
+            logger.warning(f"无法调用 message.get_chat() 获取消息 {message.id} 的聊天信息: {ae}")
+        except telethon.errors.rpcerrorlist.ChannelPrivateError:
+            # Bot 不在该频道/群组，无法获取信息，视为受限
+            logger.warning(f"无法获取消息 {message.id} 的聊天信息 (ChannelPrivateError)，假定聊天受限。")
+            return True
+        except Exception as chat_err:
+            # 获取聊天信息时发生其他错误，记录警告，但默认不视为受限（避免误判）
+            # 下载时仍然会因权限失败
+            logger.warning(f"获取消息 {message.id} 的聊天信息以检查限制时发生未知错误: {chat_err}")
+        return False
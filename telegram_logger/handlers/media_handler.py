@@ -5,7 +5,7 @@ from contextlib import contextmanager, asynccontextmanager
 from telethon.tl.types import Message as TelethonMessage
 # Import necessary functions from utils.media
 from telegram_logger.utils.media import (
-    retrieve_media_as_file,
+    retrieve_restricted_media,
     _get_filename,
     MAX_IN_MEMORY_FILE_SIZE, # 需要导入限制大小
 )
@@ -13,8 +13,9 @@ from telegram_logger.utils.media import (
 logger = logging.getLogger(__name__)
 
 class RestrictedMediaHandler:
-    def __init__(self, client):
+    def __init__(self, client, db=None):
         self.client = client
+        self.db = db  # 用于定位打包存储的媒体
         logger.info("RestrictedMediaHandler initialized.")
 
     @asynccontextmanager
@@ -22,21 +23,15 @@ class RestrictedMediaHandler:
         """
         从给定的已持久化路径解密并提供媒体文件句柄。
         现在只负责解密，不再下载或保存。
+        文件按需分块解密（在加解密线程池中执行），上传大文件时内存占用恒定。
         """
         media_file = None
-        # retrieve_media_as_file 返回一个同步上下文管理器
-        # 我们需要在异步上下文中使用它
-        cm = retrieve_media_as_file(media_path, is_restricted=True)
         try:
-            media_file = cm.__enter__() # 手动进入同步上下文
-            if not media_file:
-                raise ValueError(f"Failed to retrieve/decrypt media from {media_path}")
-
-            # 文件名应该由 retrieve_media_as_file 尝试设置
-            filename = getattr(media_file, 'name', os.path.basename(media_path))
-            logger.info(f"Yielding decrypted file handle from path: {filename}")
-            yield media_file # 产生文件句柄
-
+            async with retrieve_restricted_media(media_path, self.db) as media_file:
+                filename = getattr(media_file, 'name', os.path.basename(media_path))
+                logger.info(f"Yielding decrypted file handle from path: {filename}")
+                yield media_file # 产生文件句柄
+            logger.info(f"Finished processing media from path: {filename}")
         except FileNotFoundError:
              logger.error(f"Media file not found at path: {media_path}")
              raise # 文件不存在，直接抛出异常
@@ -44,14 +39,6 @@ class RestrictedMediaHandler:
             logger.error(f"Error preparing media from path {media_path}: {e}", exc_info=True)
             raise # 重新抛出异常，让调用者知道失败了
         finally:
-            # 手动退出同步上下文
-            if 'cm' in locals(): # 确保 cm 已定义
-                try:
-                    cm.__exit__(None, None, None) # 清理同步上下文（例如关闭文件）
-                    if media_file:
-                         logger.info(f"Finished processing media from path: {getattr(media_file, 'name', 'unknown')}")
-                except Exception as exit_e:
-                     logger.error(f"Error exiting retrieve_media_as_file context for {media_path}: {exit_e}")
             if not media_file:
                  logger.warning(f"Media preparation from path context finished, but no media file was yielded successfully.")
 
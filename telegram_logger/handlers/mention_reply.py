@@ -12,6 +12,7 @@ from telethon import (
 from telethon.tl.types import Message as TelethonMessage
 
 from .base_handler import BaseHandler
+from .event_context import KIND_NEW, EventContext
 from telegram_logger.data.database import DatabaseManager
 from telegram_logger.data.models import Message
 from telegram_logger.services.user_bot_state import UserBotStateService
@@ -110,7 +111,9 @@ class MentionReplyHandler(BaseHandler):
             if is_reply and replied_to_msg_id:  # my_id 保证存在
                 try:
                     # 尝试从数据库获取被回复消息
-                    replied_message_db = self.db.get_message_by_id(replied_to_msg_id)
+                    replied_message_db = await self.db.get_message_async(
+                        event.chat_id, replied_to_msg_id
+                    )
                     if replied_message_db and replied_message_db.from_id == my_id:
                         is_reply_to_me = True
                         logger.debug(
@@ -394,10 +397,14 @@ class MentionReplyHandler(BaseHandler):
             # 确保处理流程安全终止
         return
 
-    async def process(self, event: events.common.EventCommon) -> Optional[Message]:
+    async def process(
+        self, event: events.common.EventCommon, context: Optional[EventContext] = None
+    ) -> Optional[Message]:
         """
-        覆盖 BaseHandler 的抽象方法。
-        对于 MentionReplyHandler，主要逻辑在 handle_event 中，由 main.py 中的事件处理器直接调用。
+        事件流水线的 auto_reply 阶段：只处理收到的新消息（不含编辑、删除和自己发出的消息），
+        主要逻辑在 handle_event 中。
         """
-        # logger.debug("MentionReplyHandler.process 被调用，但无操作。")
+        context = self._context(event, context)
+        if context.kind == KIND_NEW and not event.out:
+            await self.handle_event(event)
         return None
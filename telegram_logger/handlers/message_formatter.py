@@ -6,7 +6,7 @@ from telethon.tl.types import (
     DocumentAttributeSticker,
     MessageMediaDocument,
 )
-from telegram_logger.utils.mentions import create_mention
+from telegram_logger.utils.mentions import EntityResolver, render_mention
 from telegram_logger.utils.media import (
     _get_filename,
 )
@@ -15,8 +15,9 @@ logger = logging.getLogger(__name__)
 
 
 class MessageFormatter:
-    def __init__(self, client):
+    def __init__(self, client, entity_cache=None):
         self.client = client
+        self.entity_cache = entity_cache  # 提及渲染优先查本地实体缓存
         logger.info("MessageFormatter 已初始化。")  # <- 可选：更新日志消息
 
     async def format_message(self, event: events.NewMessage.Event) -> str:
@@ -24,10 +25,11 @@ class MessageFormatter:
         from_id = self._get_sender_id(
             event.message
         )  # 假设 _get_sender_id 可访问或已传入
-        mention_sender = await create_mention(self.client, from_id)
-        mention_chat = await create_mention(
-            self.client, event.chat_id, event.message.id
+        resolved = await EntityResolver(self.client, self.entity_cache).resolve(
+            [from_id, event.chat_id]
         )
+        mention_sender = render_mention(resolved, from_id)
+        mention_chat = render_mention(resolved, event.chat_id, event.message.id)
         timestamp = event.message.date.strftime("%Y-%m-%d %H:%M:%S UTC")
 
         # 第 1 部分：来源信息
@@ -23,11 +23,12 @@ from telethon.tl.types import (
 )
 
 from ..data.database import DatabaseManager
-from ..data.models import Message # 确保导入 Message
+from ..data.models import EntityInfo, Message # 确保导入 Message
 # from ..utils.media import retrieve_media_as_file # retrieve_media_as_file 在 media_handler 中使用
 from ..utils.media import MAX_IN_MEMORY_FILE_SIZE
-from ..utils.mentions import create_mention
+from ..utils.mentions import render_mention
 from .base_handler import BaseHandler
+from .event_context import EventContext
 from contextlib import asynccontextmanager, contextmanager # 导入上下文管理器类型检查
 from .log_sender import LogSender
 from .media_handler import RestrictedMediaHandler
@@ -54,6 +55,7 @@ class OutputHandler(BaseHandler):
         deletion_rate_limit_window: int = 10,  # 单位：秒
         deletion_pause_duration: int = 5,  # 单位：秒
         my_id: Optional[int] = None, # 添加 my_id 参数
+        persistence_wait_timeout: float = 5.0,  # 单位：秒
         **kwargs: Dict[str, Any],
     ):
         """初始化 OutputHandler。"""
@@ -67,6 +69,9 @@ class OutputHandler(BaseHandler):
         self.deletion_pause_duration = timedelta(seconds=deletion_pause_duration)
         self._deletion_timestamps: Deque[datetime] = deque()
         self._rate_limit_paused_until: Optional[datetime] = None
+        # 读取刚收到的消息时等待持久化完成通知的最长时间
+        self.persistence_wait_timeout = persistence_wait_timeout
+
 
         # 辅助类的占位符，将在 set_client 中初始化
         self.log_sender: Optional[LogSender] = None
@@ -91,15 +96,17 @@ class OutputHandler(BaseHandler):
                 return
 
             self.log_sender = LogSender(self.client, self.log_chat_id)
-            self.formatter = MessageFormatter(self.client)
-            self.restricted_media_handler = RestrictedMediaHandler(self.client)
+            self.formatter = MessageFormatter(self.client, self.db.entity_cache)
+            self.restricted_media_handler = RestrictedMediaHandler(self.client, self.db)
             logger.info(
                 "OutputHandler 的辅助类 (LogSender, MessageFormatter, RestrictedMediaHandler) 已初始化。"
             )
         else:
             logger.warning("无法初始化 OutputHandler 辅助类：客户端为 None。")
 
-    async def process(self, event: events.common.EventCommon) -> Optional[Message]:
+    async def process(
+        self, event: events.common.EventCommon, context: Optional[EventContext] = None
+    ) -> Optional[Message]:
         """
         处理传入的 Telegram 事件。
         根据事件类型调用相应的内部处理方法。
@@ -114,14 +121,15 @@ class OutputHandler(BaseHandler):
             logger.error("OutputHandler 无法处理事件：客户端或辅助类尚未初始化。")
             return None
 
+        context = self._context(event, context)
         try:
             # 这里的顺序不能改变，因为telethon的实现中，MessageEdited 是集成自NewMessage，如果改变了顺序，会导致无法触发修改和删除的事件
             if isinstance(event, events.MessageEdited.Event):
-                await self._process_edited_message(event)
+                await self._process_edited_message(event, context)
             elif isinstance(event, events.MessageDeleted.Event):
                 await self._process_deleted_message(event)
             elif isinstance(event, events.NewMessage.Event):
-                await self._process_new_message(event)
+                await self._process_new_message(event, context)
             else:
                 # 这个日志现在更有意义，因为它确认了前面的 isinstance 都没匹配上
                 logger.debug(
@@ -146,9 +154,9 @@ class OutputHandler(BaseHandler):
 
     # --- 内部处理方法 ---
 
-    async def _process_new_message(self, event: events.NewMessage.Event):
+    async def _process_new_message(self, event: events.NewMessage.Event, context: EventContext):
         """处理新消息事件。"""
-        if not self._should_forward(event):
+        if not self._should_forward(event, context):
             logger.debug(f"新消息 {event.message.id} 不满足转发条件，已忽略。")
             return  # 不符合转发规则
 
@@ -156,12 +164,12 @@ class OutputHandler(BaseHandler):
         # 使用 OutputHandler 内部的格式化方法
         formatted_text = await self._format_output_message("新消息", event.message)
 
-        await self._send_message_with_media(formatted_text, event.message)
+        await self._send_message_with_media(formatted_text, event.message, context)
 
-    async def _process_edited_message(self, event: events.MessageEdited.Event):
+    async def _process_edited_message(self, event: events.MessageEdited.Event, context: EventContext):
         """处理消息编辑事件。"""
         # 编辑事件也应用相同的转发规则
-        if not self._should_forward(event):
+        if not self._should_forward(event, context):
             logger.debug(f"编辑消息 {event.message.id} 不满足转发条件，已忽略。")
             return
 
@@ -197,16 +205,24 @@ class OutputHandler(BaseHandler):
 
         logger.info(f"处理删除消息: ChatID={chat_id}, MsgIDs={deleted_ids}")
 
+        # 一次批量查询解析整个删除事件，正在持久化的消息等待完成通知
+        found_messages = await self._get_messages_when_persisted(
+            deleted_ids, chat_id
+        )
+
+        # 整个删除事件涉及的发送者和聊天一次批量解析
+        entity_ids = [chat_id] if chat_id else []
+        for message in found_messages.values():
+            entity_ids.extend((message.from_id, message.chat_id))
+        resolved = await self.resolve_entities(entity_ids) if self.client else {}
+
         for msg_id in deleted_ids:
-            # 从数据库检索原始消息，带重试逻辑
-            original_message = await self._get_message_from_db_with_retry(
-                msg_id, chat_id
-            )
+            original_message = found_messages.get(msg_id)
 
             if original_message:
                 # 如果找到原始消息，格式化并发送日志
                 formatted_text = await self._format_output_message(
-                    "删除消息", original_message, is_deleted=True
+                    "删除消息", original_message, is_deleted=True, resolved=resolved
                 )
 
                 # 决定是否在删除日志中包含原始媒体。
@@ -227,14 +243,12 @@ class OutputHandler(BaseHandler):
                 )
                 mention = f"消息 ID `{msg_id}`"
                 if chat_id and self.client:
-                    try:
-                        # 尝试创建聊天提及以提供上下文
-                        chat_mention = await create_mention(
-                            self.client, chat_id, msg_id
-                        )  # 使用 msg_id 尝试生成链接
+                    if chat_id in resolved:
+                        # 使用 msg_id 尝试生成链接，为删除日志提供上下文
+                        chat_mention = render_mention(resolved, chat_id, msg_id)
                         mention = f"{chat_mention} 中的消息 ID `{msg_id}`"
-                    except Exception as e:
-                        logger.warning(f"为删除日志创建聊天 {chat_id} 提及失败: {e}")
+                    else:
+                        logger.warning(f"为删除日志创建聊天 {chat_id} 提及失败")
                         mention = f"聊天 `{chat_id}` 中的消息 ID `{msg_id}`"
 
                 formatted_text = f"🗑️ **删除消息 (内容未知)**\n\n{mention} 已被删除，但无法从数据库中检索到原始内容。"
@@ -248,7 +262,9 @@ class OutputHandler(BaseHandler):
     # --- 过滤与规则 ---
 
     def _should_forward(
-        self, event: Union[events.NewMessage.Event, events.MessageEdited.Event]
+        self,
+        event: Union[events.NewMessage.Event, events.MessageEdited.Event],
+        context: EventContext,
     ) -> bool:
         """检查新消息或编辑消息是否应根据规则转发到日志频道。"""
         message = event.message
@@ -258,7 +274,7 @@ class OutputHandler(BaseHandler):
             )
             return False
 
-        sender_id = self._get_sender_id(message)  # 使用基类方法获取发送者 ID
+        sender_id = context.sender_id
         chat_id = message.chat_id
 
         # 规则 1: 检查是否在忽略列表中
@@ -341,47 +357,36 @@ class OutputHandler(BaseHandler):
 
     # --- 数据库交互 ---
 
-    async def _get_message_from_db_with_retry(
-        self, message_id: int, chat_id: Optional[int] = None
+    async def _get_message_when_persisted(
+        self, message_id: int, chat_id: Optional[int] = None, with_media: bool = False
     ) -> Optional[Message]:
         """
-        从数据库检索消息，包含短暂重试以处理潜在的持久化延迟。
-        如果提供了 chat_id，会进行验证。
+        从数据库检索消息。消息（with_media 为 True 时包括其媒体）正在持久化时，
+        等待 PersistenceHandler 的完成通知（最多 persistence_wait_timeout 秒）后再查一次；
+        不在持久化中的消息直接返回当前查询结果。
+        提供 chat_id 时按 (chat_id, id) 精确查找；否则退回到仅按 id 的查找。
         """
-        retry_delay = 0.5  # 重试前的等待时间（秒）
-        message = None
         try:
-            # 第一次尝试
-            message = self.db.get_message_by_id(message_id)
-            if message and (chat_id is None or message.chat_id == chat_id):
+            message = await self._lookup_message(message_id, chat_id)
+            if message and (message.media_path or not with_media):
+                return message
+            if chat_id is None or not self.db.persistence_signals.is_pending(
+                chat_id, message_id, media=with_media
+            ):
                 return message
-            elif message:  # 找到了但 chat_id 不匹配
-                logger.warning(
-                    f"数据库中找到消息 {message_id}，但其 chat_id ({message.chat_id}) 与事件 ({chat_id}) 不匹配。"
-                )
-                return None  # 视为未找到
 
-            # 如果第一次未找到，等待后重试
             logger.debug(
-                f"消息 {message_id} 在数据库中首次未找到，将在 {retry_delay} 秒后重试。"
+                f"消息 {message_id} {'的媒体' if message else ''}尚未持久化，等待完成通知 "
+                f"(最多 {self.persistence_wait_timeout} 秒)。"
             )
-            await asyncio.sleep(retry_delay)
-            message = self.db.get_message_by_id(message_id)
-
-            if message and (chat_id is None or message.chat_id == chat_id):
-                logger.info(f"消息 {message_id} 在重试后于数据库中找到。")
-                return message
-            elif message:  # 重试后找到但 chat_id 不匹配
-                logger.warning(
-                    f"数据库中重试找到消息 {message_id}，但其 chat_id ({message.chat_id}) 与事件 ({chat_id}) 不匹配。"
-                )
-                return None  # 视为未找到
-            else:
+            if not await self.db.persistence_signals.wait(
+                chat_id, message_id, self.persistence_wait_timeout, media=with_media
+            ):
                 # 注意：这里改为 warning，因为消息可能确实不存在或已被清理
                 logger.warning(
-                    f"消息 {message_id} 在重试后仍未在数据库中找到或 chat_id 不匹配。"
+                    f"等待消息 {message_id} (ChatID: {chat_id}) 持久化超时，使用当前查询结果。"
                 )
-                return None
+            return await self._lookup_message(message_id, chat_id) or message
 
         except Exception as e:
             logger.error(
@@ -389,6 +394,50 @@ class OutputHandler(BaseHandler):
             )
             return None
 
+    async def _get_messages_when_persisted(
+        self, message_ids: List[int], chat_id: Optional[int] = None
+    ) -> Dict[int, Message]:
+        """
+        批量从数据库检索消息。只有正在持久化的未命中消息才等待完成通知，
+        从未收到过的消息（例如启动前发送的）不会等待。
+        """
+        try:
+            found = await self.db.get_messages_bulk(chat_id, message_ids)
+            missing = [msg_id for msg_id in message_ids if msg_id not in found]
+            signals = self.db.persistence_signals
+            pending = [
+                msg_id for msg_id in missing
+                if chat_id is not None and signals.is_pending(chat_id, msg_id)
+            ]
+            if pending:
+                logger.debug(
+                    f"{len(pending)}/{len(message_ids)} 条消息正在持久化，等待完成通知。"
+                )
+                await asyncio.gather(*(
+                    signals.wait(chat_id, msg_id, self.persistence_wait_timeout)
+                    for msg_id in pending
+                ))
+                found.update(await self.db.get_messages_bulk(chat_id, pending))
+            still_missing = len(message_ids) - len(found)
+            if still_missing:
+                logger.warning(
+                    f"{still_missing} 条消息 (ChatID: {chat_id}) 未在数据库中找到。"
+                )
+            return found
+        except Exception as e:
+            logger.error(
+                f"从数据库批量检索消息 {message_ids} 时发生错误: {e}", exc_info=True
+            )
+            return {}
+
+    async def _lookup_message(
+        self, message_id: int, chat_id: Optional[int] = None
+    ) -> Optional[Message]:
+        """按 (chat_id, id) 查找原始消息；chat_id 未知时使用 id 索引查找。"""
+        if chat_id is not None:
+            return await self.db.get_message_async(chat_id, message_id)
+        return await self.db.get_message_by_id_async(message_id)
+
     # --- 速率限制 ---
 
     async def _apply_deletion_rate_limit(self) -> bool:
@@ -454,8 +503,12 @@ class OutputHandler(BaseHandler):
         event_type: str,  # "新消息", "编辑消息", "删除消息"
         message_data: Union[TelethonMessage, Message],
         is_deleted: bool = False,
+        resolved: Optional[Dict[int, EntityInfo]] = None,
     ) -> str:
-        """为发送到日志频道的消息格式化文本内容。"""
+        """为发送到日志频道的消息格式化文本内容。
+
+        resolved 为已批量解析的实体信息；未提供时在这里一次解析发送者和聊天。
+        """
         # 断言确保 client 已设置
         if not self.client:
             logger.error("Client 未设置，无法格式化消息。")
@@ -482,12 +535,15 @@ class OutputHandler(BaseHandler):
                 edit_date = getattr(message_data, "edit_date", None)
                 reply_to_msg_id = message_data.reply_to_msg_id
 
-                # 异步获取提及信息
-                sender_mention = await create_mention(self.client, sender_id, msg_id)
-                if chat_id and not message_data.is_private:
-                    chat_mention = await create_mention(
-                        self.client, chat_id, msg_id
-                    )  # 使用 msg_id 尝试生成链接
+                # 发送者和聊天一次批量解析
+                with_chat = chat_id and not message_data.is_private
+                if resolved is None:
+                    resolved = await self.resolve_entities(
+                        [sender_id, chat_id] if with_chat else [sender_id]
+                    )
+                sender_mention = render_mention(resolved, sender_id, msg_id)
+                if with_chat:
+                    chat_mention = render_mention(resolved, chat_id, msg_id)  # 使用 msg_id 尝试生成链接
 
             elif isinstance(message_data, Message):
                 # 处理从数据库检索的 Message 数据对象
@@ -500,11 +556,15 @@ class OutputHandler(BaseHandler):
                 edit_date = message_data.edited_time  # 使用 edited_time
                 reply_to_msg_id = None  # Message 对象中没有此信息
 
-                # 异步获取提及信息
-                sender_mention = await create_mention(self.client, sender_id, msg_id)
                 # 检查 chat_id 是否存在且不等于 sender_id (基本判断是否为非私聊群组/频道)
-                if chat_id and chat_id != sender_id:
-                    chat_mention = await create_mention(self.client, chat_id, msg_id)
+                with_chat = chat_id and chat_id != sender_id
+                if resolved is None:
+                    resolved = await self.resolve_entities(
+                        [sender_id, chat_id] if with_chat else [sender_id]
+                    )
+                sender_mention = render_mention(resolved, sender_id, msg_id)
+                if with_chat:
+                    chat_mention = render_mention(resolved, chat_id, msg_id)
 
             else:
                 logger.error(f"无法格式化消息：无效的数据类型 {type(message_data)}")
@@ -593,7 +653,9 @@ class OutputHandler(BaseHandler):
             )
             return f"❌ 格式化消息时出错 (ID: {error_msg_id})。"
 
-    async def _send_message_with_media(self, text: str, message: TelethonMessage):
+    async def _send_message_with_media(
+        self, text: str, message: TelethonMessage, context: EventContext
+    ):
         """处理带媒体的消息发送，优先使用持久化数据，按需下载作为后备。"""
         if not self.log_sender or not self.restricted_media_handler or not self.client:
             logger.error("OutputHandler 辅助类未完全初始化，无法发送带媒体的消息。")
@@ -623,45 +685,18 @@ class OutputHandler(BaseHandler):
                 for attr in getattr(message.media, "attributes", [])
             )
 
-            # 1. 检查消息本身的 noforwards 标志
-            message_restricted = getattr(message, "noforwards", False)
-
-            # 2. 检查聊天级别的限制 (需要异步获取)
-            chat_restricted = False
-            try:
-                # 尝试获取发送消息的聊天实体
-                # 注意: message.get_chat() 可能需要额外的 API 调用
-                # 在某些情况下（例如来自匿名管理员的消息），get_chat 可能返回 None
-                chat = await message.get_chat()
-                if chat and getattr(chat, 'noforwards', False): # 检查聊天本身的 noforwards 属性
-                    logger.debug(f"消息 {message.id} 所在的聊天 {getattr(chat, 'id', '未知')} 设置了 noforwards 限制。")
-                    chat_restricted = True
-
-            except AttributeError as ae:
-                 # 处理 message.get_chat() 可能不存在的情况 (虽然不太可能)
-                 logger.warning(f"无法调用 message.get_chat() 获取消息 {message.id} 的聊天信息: {ae}")
-            except telethon.errors.rpcerrorlist.ChannelPrivateError:
-                 # Bot 不在该频道/群组，无法获取信息，视为受限
-                 logger.warning(f"无法获取消息 {message.id} 的聊天信息 (ChannelPrivateError)，假定聊天受限。")
-                 chat_restricted = True
-            except Exception as chat_err:
-                # 获取聊天信息时发生其他错误，记录警告，但默认不视为受限（避免误判）
-                # 下载时仍然会因权限失败
-                logger.warning(f"获取消息 {message.id} 的聊天信息以检查限制时发生未知错误: {chat_err}")
-                # chat_restricted = False # 保持 False
-
-            # 最终判断：消息本身或其所在聊天受限，都视为受限媒体
-            is_restricted = message_restricted or chat_restricted
-
-            logger.debug(f"消息 {message.id}: message_restricted={message_restricted}, chat_restricted={chat_restricted}, final is_restricted={is_restricted}")
+            # 消息或其所在聊天受限，都视为受限媒体（聊天状态由上下文查缓存，通常无需 API 调用）
+            is_restricted = await context.is_restricted()
 
             # --- 尝试从数据库获取持久化信息 (仅对贴纸和受限媒体) ---
             db_message: Optional[Message] = None
             media_path_from_db: Optional[str] = None
             if is_sticker or is_restricted:
                 logger.debug(f"尝试从数据库获取消息 {message.id} 的媒体路径...")
-                # 使用带重试的方法获取数据库记录
-                db_message = await self._get_message_from_db_with_retry(message.id, message.chat_id)
+                # 媒体可能仍在后台下载，等待持久化完成通知后再读取
+                db_message = await self._get_message_when_persisted(
+                    message.id, message.chat_id, with_media=True
+                )
                 if db_message and db_message.media_path:
                     media_path_from_db = db_message.media_path
                     logger.info(f"成功从数据库获取到消息 {message.id} 的媒体路径: {media_path_from_db}")
@@ -676,13 +711,11 @@ class OutputHandler(BaseHandler):
                 send_method = "client" # 贴纸通常用 client.send_file
                 try:
                     if media_path_from_db:
-                        # 优先使用数据库路径 (贴纸通常未加密)
+                        # 优先使用数据库路径。保存的媒体均已加密，小贴纸通常在打包文件中（路径是逻辑路径），
+                        # 由 prepare_media_from_path 通过数据库定位并流式解密
                         logger.debug(f"尝试使用数据库路径 {media_path_from_db} 发送贴纸 {message.id}")
-                        # retrieve_media_as_file 返回同步上下文
-                        # 需要从 utils.media 导入 retrieve_media_as_file
-                        from ..utils.media import retrieve_media_as_file
-                        media_context = retrieve_media_as_file(media_path_from_db, is_restricted=False)
-                        async with self.manage_sync_context(media_context) as media_file_to_send:
+                        media_context = self.restricted_media_handler.prepare_media_from_path(media_path_from_db)
+                        async with media_context as media_file_to_send:
                              if media_file_to_send:
                                  await self.client.send_file(
                                      self.log_chat_id,
@@ -1,5 +1,5 @@
 import logging
-from typing import Optional, Union, cast, Set, Dict, Any
+from typing import TYPE_CHECKING, Optional, Union, cast, Set, Dict, Any
 
 from telethon import events
 from telethon.tl.types import Message as TelethonMessage
@@ -8,6 +8,10 @@ from ..data.database import DatabaseManager
 from ..data.models import Message
 from ..utils.media import save_media_as_file
 from .base_handler import BaseHandler
+from .event_context import EventContext
+
+if TYPE_CHECKING:
+    from ..services.media_downloader import MediaDownloadService
 
 logger = logging.getLogger(__name__)
 
@@ -24,6 +28,7 @@ class PersistenceHandler(BaseHandler):
         log_chat_id: int,
         ignored_ids: Set[int],
         my_id: Optional[int] = None, # 添加 my_id 参数
+        media_downloader: Optional["MediaDownloadService"] = None,
         **kwargs: Dict[str, Any]
     ):
         """
@@ -34,27 +39,46 @@ class PersistenceHandler(BaseHandler):
             log_chat_id: 日志频道 ID (基类可能需要)。
             ignored_ids: 要忽略的用户/频道 ID 集合 (基类可能需要)。
             my_id: 用户自己的 Telegram ID (可选, 基类需要)。
+            media_downloader: 后台媒体下载服务 (可选)。提供时消息先写入数据库，
+                媒体下载完成后再回填 media_path；否则在保存消息前内联下载。
             **kwargs: 其他传递给基类的参数。
         """
         super().__init__(client=None, db=db, log_chat_id=log_chat_id, ignored_ids=ignored_ids, my_id=my_id, **kwargs) # 传递 my_id
+        self.media_downloader = media_downloader
         my_id_status = f"my_id={my_id}" if my_id is not None else "my_id 未提供 (将由 init 获取)"
         logger.info(f"PersistenceHandler 初始化完毕。{my_id_status}")
 
-    async def process(self, event: events.common.EventCommon) -> Optional[Message]:
+    async def process(
+        self, event: events.common.EventCommon, context: Optional[EventContext] = None
+    ) -> Optional[Message]:
         """
         处理传入的 Telegram 事件，仅持久化 NewMessage 和 MessageEdited 事件。
+        保存的 Message 对象同时记录到 context.persisted 中。
         """
+        context = self._context(event, context)
         try:
             if isinstance(event, (events.NewMessage.Event, events.MessageEdited.Event)):
                 logger.debug(f"PersistenceHandler 正在处理事件: {type(event).__name__}")
-                message_obj = await self._create_message_object(event)
-                if message_obj:
-                    await self.save_message(message_obj)
-                    logger.info(f"消息已保存到数据库: ChatID={message_obj.chat_id}, MsgID={message_obj.id}")
-                    return message_obj
-                else:
-                    logger.warning(f"无法为事件 {type(event).__name__} (ID: {event.message.id}) 创建消息对象。")
-                    return None
+                signals = self.db.persistence_signals
+                chat_id, msg_id = event.message.chat_id or 0, event.message.id
+                signals.begin(chat_id, msg_id)
+                media_pending = False
+                try:
+                    message_obj = await self._create_message_object(event, context)
+                    if message_obj:
+                        await self.save_message(message_obj)
+                        context.persisted = message_obj
+                        logger.info(f"消息已提交到数据库写入队列: ChatID={message_obj.chat_id}, MsgID={message_obj.id}")
+                        if self.media_downloader and event.message.media:
+                            # 消息行已入队，媒体交给后台按优先级下载，完成后回填 media_path
+                            media_pending = await self.media_downloader.enqueue(message_obj, event.message)
+                        return message_obj
+                    else:
+                        logger.warning(f"无法为事件 {type(event).__name__} (ID: {event.message.id}) 创建消息对象。")
+                        return None
+                finally:
+                    # 失败也通知完成，等待方不必等到超时；后台下载的媒体由 MediaDownloadService 通知
+                    signals.finish_row(chat_id, msg_id, media_pending=media_pending)
             else:
                 # 对于其他事件类型（如 MessageDeleted），此处理器不执行任何操作
                 logger.debug(f"PersistenceHandler 忽略事件: {type(event).__name__}")
@@ -67,7 +91,9 @@ class PersistenceHandler(BaseHandler):
 
 
     async def _create_message_object(
-        self, event: Union[events.NewMessage.Event, events.MessageEdited.Event]
+        self,
+        event: Union[events.NewMessage.Event, events.MessageEdited.Event],
+        context: EventContext,
     ) -> Optional[Message]:
         """
         根据 NewMessage 或 MessageEdited 事件创建 Message 数据对象。
@@ -85,35 +111,18 @@ class PersistenceHandler(BaseHandler):
             # 但 save_media_as_file 会失败
 
         chat_id = message.chat_id
-        from_id = self._get_sender_id(message) # 使用基类的方法获取发送者ID
-
-        # 确定聊天类型
-        sender_entity = await message.get_sender() # 获取发送者实体以检查是否为机器人
-        is_bot = getattr(sender_entity, 'bot', False) if sender_entity else False
-        is_private = message.is_private
-        is_group = message.is_group
-        is_channel = message.is_channel
-
-        # 计算 msg_type
-        msg_type = 0 # 默认为未知或不支持的类型
-        if is_bot:
-            msg_type = DatabaseManager.MSG_TYPE_MAP['bot']
-        elif is_private:
-            msg_type = DatabaseManager.MSG_TYPE_MAP['user']
-        elif is_group:
-            msg_type = DatabaseManager.MSG_TYPE_MAP['group']
-        elif is_channel:
-            msg_type = DatabaseManager.MSG_TYPE_MAP['channel']
-        else:
-            logger.warning(f"无法确定消息类型 (消息 ID: {message.id}, ChatID: {chat_id})")
+        from_id = context.sender_id
+
+        # 消息类型由上下文计算（需要发送者实体判断是否为机器人），各阶段共享
+        msg_type = await context.get_msg_type()
 
         # 处理媒体
         media_path = None
-        if message.media:
+        if message.media and not self.media_downloader:
             try:
                 # 确保 client 已设置
                 if self.client:
-                    media_path = await save_media_as_file(self.client, message)
+                    media_path = await save_media_as_file(self.client, message, db=self.db)
                     logger.debug(f"媒体已保存: {media_path} (消息 ID: {message.id})")
                 else:
                     logger.error(f"无法保存媒体，因为 client 未设置 (消息 ID: {message.id})")
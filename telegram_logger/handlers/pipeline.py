@@ -0,0 +1,163 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from telethon import events, utils
+from telethon.tl.types import PeerChannel
+
+from telegram_logger.data.database import DatabaseManager
+from telegram_logger.data.models import StageTiming
+from telegram_logger.data.restriction_cache import ChatRestrictionCache
+from telegram_logger.utils.mentions import remember_entities
+from .event_context import KIND_DELETED, EventContext
+
+if TYPE_CHECKING:
+    from telegram_logger.services.event_queue import ShardedEventQueue
+
+logger = logging.getLogger(__name__)
+
+# 阶段函数: (event, context) -> 任意返回值
+Stage = Callable[[object, EventContext], Awaitable[object]]
+
+STAGE_CAPTURE = "capture"
+
+
+class EventPipeline:
+    """
+    单次分发的事件流水线。
+
+    每种事件类型（NewMessage、MessageEdited、MessageDeleted）只注册一个 Telethon 处理器，
+    每个更新只构建一次 EventContext，然后依次运行各阶段：
+    capture（用更新自带的实体刷新实体缓存和转发限制缓存）→ 通过 add_stage 按顺序添加的阶段
+    （persist → output → auto_reply）。某个阶段出错不影响后续阶段。
+    每个阶段的耗时累计到 stats() 中，单个阶段超过 slow_stage_threshold 秒时记录警告。
+    """
+
+    # 为不带 chat_id 的删除事件选择分片时，记住最近入队的私聊/普通群组消息 ID → chat_id 的数量
+    RECENT_IDS_CAPACITY = 10000
+
+    def __init__(self, db: DatabaseManager, my_id: Optional[int] = None, slow_stage_threshold: float = 5.0):
+        self.db = db
+        self.my_id = my_id
+        self.slow_stage_threshold = slow_stage_threshold
+        self._stages: List[Tuple[str, Stage]] = [(STAGE_CAPTURE, self._capture)]
+        self._timings: Dict[str, StageTiming] = {STAGE_CAPTURE: StageTiming()}
+        self._recent_chats: "OrderedDict[int, int]" = OrderedDict()
+
+    def add_stage(self, name: str, stage: Stage):
+        """在末尾添加一个阶段；启动后添加的阶段从下一个更新开始生效。"""
+        if name in self._timings:
+            raise ValueError(f"流水线阶段 {name} 已存在")
+        self._stages.append((name, stage))
+        self._timings[name] = StageTiming()
+        logger.info(f"事件流水线已添加阶段: {name}")
+
+    @property
+    def stage_names(self) -> List[str]:
+        return [name for name, _ in self._stages]
+
+    def register(self, client, queue: Optional["ShardedEventQueue"] = None):
+        """
+        为每种事件类型注册一个分发处理器，并监听聊天设置变化。
+
+        提供 queue 时更新回调只把事件按 queue_key 放入分片队列，由队列的工作协程调用 dispatch；
+        queue 的处理函数应为本流水线的 dispatch。
+        """
+        if queue is not None:
+            async def handler(event):
+                await queue.put(await self.queue_key(event), event)
+        else:
+            handler = self.dispatch
+        for builder in (events.NewMessage(), events.MessageEdited(), events.MessageDeleted()):
+            client.add_event_handler(handler, builder)
+        client.add_event_handler(
+            self._on_chat_update, events.Raw(types=list(ChatRestrictionCache.UPDATE_TYPES))
+        )
+        logger.info(f"事件流水线已注册: {' → '.join(self.stage_names)}")
+
+    async def queue_key(self, event) -> Optional[int]:
+        """
+        事件在分片队列中的键（所在聊天的 chat_id）。
+
+        私聊和普通群组的删除事件不带 chat_id：先在最近入队的消息中查找被删除消息所在的聊天，
+        再通过热缓存和数据库 id 索引查找，使删除事件与该聊天的新消息/编辑事件在同一分片内按顺序处理。
+        无法确定聊天时返回 None。
+        """
+        chat_id = getattr(event, "chat_id", None)
+        if isinstance(event, events.MessageDeleted.Event):
+            if chat_id is None:
+                chat_id = await self._resolve_deleted_chat(event.deleted_ids or [])
+            return chat_id
+        message = getattr(event, "message", None)
+        if chat_id is not None and message is not None and not _is_channel(chat_id):
+            # 私聊和普通群组的消息 ID 在账号内唯一，可以据此找回删除事件的聊天
+            self._recent_chats[message.id] = chat_id
+            self._recent_chats.move_to_end(message.id)
+            if len(self._recent_chats) > self.RECENT_IDS_CAPACITY:
+                self._recent_chats.popitem(last=False)
+        return chat_id
+
+    async def _resolve_deleted_chat(self, deleted_ids: Iterable[int]) -> Optional[int]:
+        ids = list(deleted_ids)
+        for msg_id in ids:
+            chat_id = self._recent_chats.get(msg_id)
+            if chat_id is not None:
+                return chat_id
+        try:
+            found = await self.db.get_messages_bulk(None, ids)
+        except Exception as e:
+            logger.warning(f"查找删除事件所在聊天时出错 (IDs={ids}): {e}")
+            return None
+        # 频道消息 ID 与私聊消息 ID 可能重复，只采用私聊/普通群组的结果
+        for message in found.values():
+            if not _is_channel(message.chat_id):
+                return message.chat_id
+        return None
+
+    async def dispatch(self, event) -> EventContext:
+        context = EventContext(event, self.db, self.my_id)
+        for name, stage in list(self._stages):
+            failed = False
+            start = time.perf_counter()
+            try:
+                await stage(event, context)
+            except Exception:
+                failed = True
+                logger.exception(f"事件流水线阶段 {name} 处理 {type(event).__name__} 时出错")
+            elapsed = time.perf_counter() - start
+            context.timings[name] = elapsed
+            self._timings[name].record(elapsed, failed)
+            if elapsed > self.slow_stage_threshold:
+                logger.warning(
+                    f"事件流水线阶段 {name} 耗时 {elapsed:.2f} 秒 "
+                    f"(ChatID={context.chat_id}, 事件={type(event).__name__})"
+                )
+        logger.debug(
+            "事件流水线耗时: " + ", ".join(f"{n}={t * 1000:.1f}ms" for n, t in context.timings.items())
+        )
+        return context
+
+    async def _capture(self, event, context: EventContext):
+        """用更新自带的实体刷新实体缓存和转发限制缓存；发送者实体在这里获取一次，后续阶段共享。"""
+        self.db.chat_restrictions.observe(context.chat)
+        if context.kind != KIND_DELETED and context.message is not None:
+            remember_entities(self.db.entity_cache, await context.get_sender(), context.chat)
+
+    async def _on_chat_update(self, update):
+        self.db.chat_restrictions.handle_update(update)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {
+            name: {
+                "count": timing.count,
+                "errors": timing.errors,
+                "mean_ms": timing.mean * 1000,
+                "max_ms": timing.max * 1000,
+            }
+            for name, timing in self._timings.items()
+        }
+
+
+def _is_channel(chat_id: int) -> bool:
+    return utils.resolve_id(chat_id)[1] is PeerChannel
@@ -1,7 +1,8 @@
 import logging
 import shlex
 import json
-from typing import Set, Dict, Any, Optional
+from datetime import datetime, timedelta, timezone
+from typing import Set, Dict, Any, List, Optional, Tuple
 from telethon import events, TelegramClient, errors
 from telethon.tl import types # 新增导入
 from telethon.tl.types import Message as TelethonMessage
@@ -37,6 +38,109 @@ class UserBotCommandHandler(BaseHandler):
             logger.error("UserBotCommandHandler 初始化时未提供 my_id，可能导致后续操作失败！")
 
 
+    SEARCH_PAGE_SIZE = 10
+    SEARCH_USAGE = "`.search <搜索词> [聊天ID|all] [起始时间] [--page N]`"
+
+    @staticmethod
+    def _parse_search_args(args: List[str]) -> Tuple[str, Optional[int], Optional[datetime], int]:
+        """
+        解析 `.search` 的参数：搜索词、可选的聊天 ID（all 表示所有聊天）、
+        可选的起始时间（YYYY-MM-DD 或 7d / 12h 形式的相对时间）以及 --page 页码。
+
+        Raises:
+            ValueError: 参数格式无效，异常信息可直接展示给用户。
+        """
+        positional = []
+        page = 1
+        i = 0
+        while i < len(args):
+            if args[i] == "--page":
+                if i + 1 >= len(args):
+                    raise ValueError("`--page` 需要一个页码。")
+                try:
+                    page = int(args[i + 1])
+                except ValueError:
+                    raise ValueError(f"无效的页码 '{args[i + 1]}'。")
+                if page < 1:
+                    raise ValueError("页码必须大于 0。")
+                i += 2
+                continue
+            positional.append(args[i])
+            i += 1
+
+        if not positional or len(positional) > 3:
+            raise ValueError("参数数量不正确。")
+        query = positional[0].strip()
+        if not query:
+            raise ValueError("搜索词不能为空。")
+
+        chat_id = None
+        if len(positional) >= 2 and positional[1].lower() != "all":
+            try:
+                chat_id = int(positional[1])
+            except ValueError:
+                raise ValueError(f"无效的聊天 ID '{positional[1]}'。")
+
+        since = None
+        if len(positional) == 3:
+            value = positional[2].lower()
+            try:
+                if value[-1:] in ("d", "h") and value[:-1].isdigit():
+                    amount = int(value[:-1])
+                    delta = timedelta(days=amount) if value.endswith("d") else timedelta(hours=amount)
+                    since = datetime.now(timezone.utc) - delta
+                else:
+                    since = datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+            except ValueError:
+                raise ValueError(f"无效的起始时间 '{positional[2]}'，支持 2024-01-31、7d、12h。")
+        return query, chat_id, since, page
+
+    def _format_search_results(
+        self, query: str, results: List[Message], args: List[str], page: int, has_more: bool
+    ) -> str:
+        """将搜索结果格式化为回复文本，每条结果附带匹配位置附近的片段。"""
+        if not results:
+            if page > 1:
+                return f"ℹ️ 搜索 '{query}' 的第 {page} 页没有更多结果。"
+            return f"ℹ️ 没有找到包含 '{query}' 的消息。"
+
+        first_term = query.split()[0].lower()
+        lines = [f"🔍 **搜索结果** '{query}' (第 {page} 页)："]
+        start_index = (page - 1) * self.SEARCH_PAGE_SIZE
+        for index, message in enumerate(results, start=start_index + 1):
+            text = (message.msg_text or "").replace("\n", " ")
+            pos = max(text.lower().find(first_term), 0)
+            begin = max(pos - 30, 0)
+            snippet = text[begin:pos + 60]
+            if begin > 0:
+                snippet = "..." + snippet
+            if pos + 60 < len(text):
+                snippet += "..."
+            timestamp = (message.edited_time or message.created_time).strftime("%Y-%m-%d %H:%M")
+            edited = " (已编辑)" if message.edited_time else ""
+            lines.append(
+                f"{index}. `{timestamp}`{edited} 聊天 `{message.chat_id}` 消息 `{message.id}`\n   {snippet}"
+            )
+        if has_more:
+            next_args = [shlex.quote(a) for a in self._strip_page_arg(args)]
+            lines.append(f"\n下一页: `.search {' '.join(next_args)} --page {page + 1}`")
+        return "\n".join(lines)
+
+    @staticmethod
+    def _strip_page_arg(args: List[str]) -> List[str]:
+        """移除参数中的 --page N。"""
+        stripped = []
+        skip = False
+        for arg in args:
+            if skip:
+                skip = False
+                continue
+            if arg == "--page":
+                skip = True
+                continue
+            stripped.append(arg)
+        return stripped
+
     async def _safe_respond(self, event: events.NewMessage.Event, message: str):
         """安全地发送回复消息，处理可能的 Telethon 错误。"""
         try:
@@ -179,21 +283,16 @@ class UserBotCommandHandler(BaseHandler):
                 if target_group_ids:
                     # 只获取前几个群组的名称以避免消息过长
                     max_groups_to_show = 3
-                    count = 0
-                    for group_id in target_group_ids:
-                        if count >= max_groups_to_show:
-                            group_names.append("...")
-                            break
-                        try:
-                            entity = await self.client.get_entity(group_id)
-                            if isinstance(entity, (types.Chat, types.Channel)):
-                                group_names.append(f"'{entity.title}'")
-                            else:
-                                group_names.append(f"ID:{group_id}")
-                        except Exception:
-                            logger.warning(f"获取群组 {group_id} 信息时出错", exc_info=True)
+                    shown_ids = list(target_group_ids)[:max_groups_to_show]
+                    resolved = await self.resolve_entities(shown_ids)
+                    for group_id in shown_ids:
+                        info = resolved.get(group_id)
+                        if info and not info.is_user:
+                            group_names.append(f"'{info.name}'")
+                        else:
                             group_names.append(f"ID:{group_id}")
-                        count += 1
+                    if len(target_group_ids) > max_groups_to_show:
+                        group_names.append("...")
                 groups_display = f"[{', '.join(group_names)}]" if group_names else "无"
 
 
@@ -743,22 +842,18 @@ class UserBotCommandHandler(BaseHandler):
                     response_lines = ["🎯 **当前目标群组列表**："]
                     # 按 ID 排序（可选，但更一致）
                     sorted_group_ids = sorted(list(target_group_ids))
+                    # 所有群组一次批量解析，失败原因已由解析器记录
+                    resolved = await self.resolve_entities(sorted_group_ids)
 
                     for chat_id in sorted_group_ids:
-                        group_name = f"ID: {chat_id}" # 默认显示 ID
-                        try:
-                            entity = await self.client.get_entity(chat_id)
-                            if isinstance(entity, (types.Chat, types.Channel)):
-                                group_name = f"'{entity.title}' ({chat_id})"
-                            else:
-                                group_name = f"未知类型实体 ({chat_id})"
-                        except (ValueError, errors.RPCError) as e:
-                            logger.warning(f"获取目标群组 {chat_id} 信息时出错: {e}")
+                        info = resolved.get(chat_id)
+                        if info is None:
                             group_name = f"无法访问的群组 ({chat_id})"
-                        except Exception as e:
-                            logger.error(f"获取目标群组 {chat_id} 信息时发生意外错误: {e}", exc_info=True)
-                            group_name = f"获取信息出错 ({chat_id})"
-                        
+                        elif info.is_user:
+                            group_name = f"未知类型实体 ({chat_id})"
+                        else:
+                            group_name = f"'{info.name}' ({chat_id})"
+
                         response_lines.append(f"- {group_name}")
 
                     await self._safe_respond(event, "\n".join(response_lines))
@@ -788,6 +883,30 @@ class UserBotCommandHandler(BaseHandler):
                     logger.error(f"设置频率限制为 {seconds} 秒失败。")
                     await self._safe_respond(event, f"❌ 设置频率限制失败（可能是数据库错误）。")
 
+            elif command == "search":
+                if not args:
+                    await self._safe_respond(event, f"错误：`.search` 指令需要搜索词。\n用法: {self.SEARCH_USAGE}")
+                    return
+                try:
+                    query, chat_id, since, page = self._parse_search_args(args)
+                except ValueError as e:
+                    await self._safe_respond(event, f"错误：{e}\n用法: {self.SEARCH_USAGE}")
+                    return
+
+                # 多取一条用于判断是否还有下一页
+                results = await self.db.search_messages(
+                    query,
+                    chat_id=chat_id,
+                    since=since,
+                    limit=self.SEARCH_PAGE_SIZE + 1,
+                    offset=(page - 1) * self.SEARCH_PAGE_SIZE,
+                )
+                has_more = len(results) > self.SEARCH_PAGE_SIZE
+                await self._safe_respond(
+                    event,
+                    self._format_search_results(query, results[:self.SEARCH_PAGE_SIZE], args, page, has_more),
+                )
+
             elif command == "help":
                 if args:
                     await self._safe_respond(event, "错误：`.help` 指令不需要参数。")
@@ -830,6 +949,9 @@ class UserBotCommandHandler(BaseHandler):
 **频率限制:**
 🔹 `.setlimit <秒数>` - 设置在同一群组内触发自动回复的最小间隔。
 
+**消息搜索:**
+🔹 `.search <搜索词> [聊天ID|all] [起始时间] [--page N]` - 全文搜索已记录的消息。起始时间支持 `2024-01-31`、`7d`、`12h`。
+
 **帮助:**
 🔹 `.help` - 显示此帮助信息。
 """
@@ -854,7 +976,7 @@ class UserBotCommandHandler(BaseHandler):
         # --- 指令执行逻辑结束 ---
 
     # process 方法保持不变
-    async def process(self, event: events.common.EventCommon) -> Optional[Message]:
+    async def process(self, event: events.common.EventCommon, context=None) -> Optional[Message]:
         """
         覆盖 BaseHandler 的抽象方法。
         """
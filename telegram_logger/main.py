@@ -98,12 +98,57 @@ PERSIST_TIME_IN_DAYS_BOT = int(os.getenv("PERSIST_TIME_IN_DAYS_BOT", "1"))
 DELETION_RATE_LIMIT_THRESHOLD = int(os.getenv("DELETION_RATE_LIMIT_THRESHOLD", "5"))
 DELETION_RATE_LIMIT_WINDOW = int(os.getenv("DELETION_RATE_LIMIT_WINDOW", "60"))
 DELETION_PAUSE_DURATION = int(os.getenv("DELETION_PAUSE_DURATION", "300"))
+# 等待消息持久化完成通知的最长时间（秒）
+PERSISTENCE_WAIT_TIMEOUT = float(os.getenv("PERSISTENCE_WAIT_TIMEOUT", "5"))
+# 事件流水线单个阶段超过该耗时（秒）时记录警告
+PIPELINE_SLOW_STAGE_SECONDS = float(os.getenv("PIPELINE_SLOW_STAGE_SECONDS", "5"))
+# 按聊天分片的事件队列：工作协程数（0 表示在更新回调中直接处理）、总容量与溢出策略
+EVENT_QUEUE_WORKERS = int(os.getenv("EVENT_QUEUE_WORKERS", "4"))
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", "1000"))
+EVENT_QUEUE_OVERFLOW = os.getenv("EVENT_QUEUE_OVERFLOW", "block").lower()
+
+# 消息批量写入配置
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "200"))
+INGEST_FLUSH_INTERVAL = float(os.getenv("INGEST_FLUSH_INTERVAL", "0.2"))
+DB_READER_CONNECTIONS = int(os.getenv("DB_READER_CONNECTIONS", "4"))
+# 消息分区周期: none（不分区）、day 或 week
+DB_PARTITION_PERIOD = os.getenv("DB_PARTITION_PERIOD", "none").lower()
+# 最近消息内存热缓存
+HOT_CACHE_PER_CHAT = int(os.getenv("HOT_CACHE_PER_CHAT", "200"))
+HOT_CACHE_MAX_MB = int(os.getenv("HOT_CACHE_MAX_MB", "32"))
+# 提及渲染用的实体信息缓存
+ENTITY_CACHE_TTL = int(os.getenv("ENTITY_CACHE_TTL", "86400"))
+ENTITY_CACHE_SIZE = int(os.getenv("ENTITY_CACHE_SIZE", "10000"))
+
+# 过期清理配置
+CLEANUP_BATCH_SIZE = int(os.getenv("CLEANUP_BATCH_SIZE", "1000"))
+CLEANUP_BATCH_PAUSE = float(os.getenv("CLEANUP_BATCH_PAUSE", "0.05"))
+
+# 存储容量配额（字节，0 表示不限制）与淘汰策略
+STORAGE_MEDIA_QUOTA = int(os.getenv("STORAGE_MEDIA_QUOTA", "0"))
+STORAGE_DB_QUOTA = int(os.getenv("STORAGE_DB_QUOTA", "0"))
+STORAGE_MIN_FREE = int(os.getenv("STORAGE_MIN_FREE", str(5 * 1024 ** 3)))
+STORAGE_LOW_WATER = float(os.getenv("STORAGE_LOW_WATER", "0.9"))
+STORAGE_EVICTION_ORDER = os.getenv("STORAGE_EVICTION_ORDER", "oldest").lower()
+STORAGE_CHECK_INTERVAL = float(os.getenv("STORAGE_CHECK_INTERVAL", "300"))
+
+# 后台媒体下载工作池
+MEDIA_DOWNLOAD_WORKERS = int(os.getenv("MEDIA_DOWNLOAD_WORKERS", "3"))
+MEDIA_DOWNLOAD_QUEUE_SIZE = int(os.getenv("MEDIA_DOWNLOAD_QUEUE_SIZE", "1000"))
+
+# 旧格式媒体文件后台转换
+MEDIA_CONVERT_LEGACY = os.getenv("MEDIA_CONVERT_LEGACY", "True") == "True"
+MEDIA_CONVERT_PAUSE = float(os.getenv("MEDIA_CONVERT_PAUSE", "0.5"))
 
 # 导入 telethon 事件
 from telethon import events
 
 from telegram_logger.services.client import TelegramClientService
 from telegram_logger.services.cleanup import CleanupService
+from telegram_logger.services.storage_quota import StorageQuota
+from telegram_logger.services.media_converter import MediaConverterService
+from telegram_logger.services.media_downloader import MediaDownloadService
+from telegram_logger.services.event_queue import ShardedEventQueue
 
 # 导入 UserBot 服务
 from telegram_logger.services.user_bot_state import UserBotStateService
@@ -118,8 +163,11 @@ from telegram_logger.handlers import (
     OutputHandler,
     BaseHandler,  # 确保 BaseHandler 也被导入，如果需要类型检查
 )
+from telegram_logger.handlers.pipeline import EventPipeline
 from telegram_logger.data.database import DatabaseManager
 from telegram_logger.utils.logging import configure_logging
+from telegram_logger.utils.crypto_executor import crypto_executor
+from telegram_logger.utils.media_pack import media_pack_store
 
 
 async def main():
@@ -128,7 +176,16 @@ async def main():
     logging.info("Starting Telegram Logger service...")
 
     # Initialize core components
-    db = DatabaseManager()
+    db = DatabaseManager(
+        ingest_batch_size=INGEST_BATCH_SIZE,
+        ingest_flush_interval=INGEST_FLUSH_INTERVAL,
+        reader_connections=DB_READER_CONNECTIONS,
+        partition_period=DB_PARTITION_PERIOD,
+        hot_cache_per_chat=HOT_CACHE_PER_CHAT,
+        hot_cache_max_bytes=HOT_CACHE_MAX_MB * 1024 * 1024,
+        entity_cache_ttl=ENTITY_CACHE_TTL,
+        entity_cache_size=ENTITY_CACHE_SIZE,
+    )
 
     # Create handlers
     persist_times = {
@@ -138,10 +195,17 @@ async def main():
         "bot": PERSIST_TIME_IN_DAYS_BOT,
     }
 
+    media_downloader = MediaDownloadService(
+        db,
+        workers=MEDIA_DOWNLOAD_WORKERS,
+        max_queue=MEDIA_DOWNLOAD_QUEUE_SIZE,
+    )
+
     persistence_handler = PersistenceHandler(
         db=db,
         log_chat_id=LOG_CHAT_ID,
         ignored_ids=IGNORED_IDS,
+        media_downloader=media_downloader,
         # my_id 不在此处传递，将通过 init() 获取
     )
     output_handler = OutputHandler(
@@ -154,24 +218,62 @@ async def main():
         deletion_rate_limit_threshold=DELETION_RATE_LIMIT_THRESHOLD,
         deletion_rate_limit_window=DELETION_RATE_LIMIT_WINDOW,
         deletion_pause_duration=DELETION_PAUSE_DURATION,
+        persistence_wait_timeout=PERSISTENCE_WAIT_TIMEOUT,
     )
     handlers = [persistence_handler, output_handler]
 
+    # 事件流水线: capture → persist → output → auto_reply（auto_reply 在 UserBot 初始化后添加）
+    pipeline = EventPipeline(db, slow_stage_threshold=PIPELINE_SLOW_STAGE_SECONDS)
+    pipeline.add_stage("persist", persistence_handler.process)
+    pipeline.add_stage("output", output_handler.process)
+    # 更新回调只负责入队，同一聊天的事件按顺序处理，不同聊天并行
+    event_queue = (
+        ShardedEventQueue(
+            pipeline.dispatch,
+            workers=EVENT_QUEUE_WORKERS,
+            capacity=EVENT_QUEUE_SIZE,
+            overflow=EVENT_QUEUE_OVERFLOW,
+        )
+        if EVENT_QUEUE_WORKERS > 0
+        else None
+    )
+
     # Initialize services
     client_service = TelegramClientService(
         session_name=SESSION_NAME,
         api_id=API_ID,
         api_hash=API_HASH,
-        handlers=handlers,
+        pipeline=pipeline,
         log_chat_id=LOG_CHAT_ID,
+        event_queue=event_queue,
     )
 
-    cleanup_service = CleanupService(db, persist_times)
+    cleanup_service = CleanupService(
+        db,
+        persist_times,
+        batch_size=CLEANUP_BATCH_SIZE,
+        batch_pause=CLEANUP_BATCH_PAUSE,
+        pack_store=media_pack_store,
+        quota=StorageQuota(
+            db,
+            media_quota_bytes=STORAGE_MEDIA_QUOTA,
+            db_quota_bytes=STORAGE_DB_QUOTA,
+            min_free_bytes=STORAGE_MIN_FREE,
+            low_water=STORAGE_LOW_WATER,
+            order=STORAGE_EVICTION_ORDER,
+        ),
+        quota_check_interval=STORAGE_CHECK_INTERVAL,
+    )
+    media_converter = MediaConverterService(pause=MEDIA_CONVERT_PAUSE)
 
     # Run services
     try:
         logging.info("Starting all services...")
+        if event_queue:
+            await event_queue.start()
         user_id = await client_service.initialize()  # 获取 user_id
+        # 尽早启动媒体下载，避免初始化期间到达的消息媒体被忽略
+        await media_downloader.start(client_service.client)
 
         # --- UserBot 功能初始化 ---
         logger.info("正在初始化 UserBot 功能...")
@@ -228,13 +330,8 @@ async def main():
             )
             logger.info("UserBot 命令处理器已注册。")
 
-            # 注册处理提及/回复的方法
-            # 注意：使用 incoming=True 可能会捕获所有收到的消息，包括来自其他设备/会话的自己的消息
-            # 如果只想处理来自他人的消息，可能需要更复杂的过滤或在 handler 内部检查 event.out is False
-            client_service.client.add_event_handler(
-                mention_reply_handler.handle_event,  # Handler 实例的方法
-                events.NewMessage(incoming=True),  # 监听所有收到的新消息，内部再过滤
-            )
+            # 提及/回复处理作为事件流水线的最后一个阶段，只处理收到的新消息
+            pipeline.add_stage("auto_reply", mention_reply_handler.process)
             logger.info("UserBot 提及/回复处理器已注册。")
         except Exception as e:
             logger.critical(f"注册 UserBot 事件处理器时发生错误: {e}", exc_info=True)
@@ -244,6 +341,8 @@ async def main():
         # --- UserBot 功能初始化结束 ---
 
         await cleanup_service.start()
+        if MEDIA_CONVERT_LEGACY:
+            await media_converter.start()
 
         # Inject initialized client into core handlers (PersistenceHandler, OutputHandler)
         # UserBot handlers receive the client via __init__
@@ -271,10 +370,25 @@ async def main():
         logging.info("Received shutdown signal...")
     finally:
         logging.info("Shutting down services...")
+        if "event_queue" in locals() and event_queue:
+            # 先处理完已入队的事件，它们仍需要下载服务和数据库
+            await event_queue.stop()
         if "cleanup_service" in locals() and cleanup_service._task:
             await cleanup_service.stop()
-        if "db" in locals() and db.conn:
+        if "media_converter" in locals():
+            await media_converter.stop()
+        if "media_downloader" in locals():
+            await media_downloader.stop()
+        if "pipeline" in locals():
+            logging.info(f"Event pipeline stage timings: {pipeline.stats()}")
+        if "db" in locals():
+            # 关闭前刷新写入队列，确保已接收的消息全部落盘
+            logging.info("Flushing pending message writes...")
+            await asyncio.to_thread(db.flush_ingest_queue)
             db.close()
+        crypto_executor.shutdown()
+        if media_pack_store is not None:
+            media_pack_store.close()
         logging.info("All services stopped")
 
 
@@ -1,17 +1,38 @@
 import asyncio
 import logging
-import shutil
+import os
 import sqlite3
-from pathlib import Path
-from typing import Dict
+import time
+from functools import partial
+from typing import Dict, Optional
 from telegram_logger.data.database import DatabaseManager
+from telegram_logger.data.models import EvictionReport
+from telegram_logger.services.storage_quota import StorageQuota
+from telegram_logger.utils.media_pack import MEDIA_PACK_COMPACT_RATIO, MediaPackStore
 
 logger = logging.getLogger(__name__)
 
 class CleanupService:
-    def __init__(self, db: DatabaseManager, persist_times: Dict[str, int]):
+    def __init__(
+        self,
+        db: DatabaseManager,
+        persist_times: Dict[str, int],
+        batch_size: int = 1000,
+        batch_pause: float = 0.05,
+        pack_store: Optional[MediaPackStore] = None,
+        pack_compact_ratio: float = MEDIA_PACK_COMPACT_RATIO,
+        quota: Optional[StorageQuota] = None,
+        quota_check_interval: float = 300,
+    ):
         self.db = db
         self.persist_times = persist_times
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.pack_store = pack_store
+        self.pack_compact_ratio = pack_compact_ratio
+        # 容量配额在两次过期清理之间每 quota_check_interval 秒检查一次，未提供时不检查
+        self.quota = quota
+        self.quota_check_interval = quota_check_interval
         self._task = None
         self._running = False
 
@@ -38,15 +59,29 @@ class CleanupService:
         try:
             while self._running:
                 try:
-                    # 添加存储空间检查
-                    if self._is_disk_space_low():
-                        logger.warning("存储空间不足，强制清理...")
-                    
-                    deleted_count = self.db.delete_expired_messages(self.persist_times)
-                    if deleted_count > 0:
-                        logger.info(f"已清理 {deleted_count} 条过期记录和关联文件")
-                    
-                    await asyncio.sleep(3600)  # 每小时运行一次
+                    # 分批在写线程上删除，不阻塞事件循环
+                    stats = await self.db.delete_expired_messages(
+                        self.persist_times,
+                        batch_size=self.batch_size,
+                        pause=self.batch_pause,
+                    )
+                    if stats.total > 0:
+                        logger.info(
+                            f"已清理 {stats.deleted_rows} 条过期记录和 {stats.deleted_files} 个关联文件 "
+                            f"(按类型: {stats.rows_by_type}, {stats.batches} 批, 耗时 {stats.elapsed:.2f}s)"
+                        )
+
+                    if self.pack_store is not None:
+                        await self.compact_media_packs()
+
+                    # 每小时运行一次过期清理，期间定期检查容量配额
+                    next_cleanup = time.monotonic() + 3600
+                    while True:
+                        await self.enforce_quota()
+                        remaining = next_cleanup - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        await asyncio.sleep(min(self.quota_check_interval, remaining))
                 except sqlite3.Error as e:
                     logger.error(f"数据库错误: {str(e)}")
                     await asyncio.sleep(300)  # 数据库错误等待5分钟
@@ -61,24 +96,45 @@ class CleanupService:
         except Exception as e:
             logger.critical(f"清理服务发生严重错误: {str(e)}", exc_info=True)
 
-    def _is_disk_space_low(self) -> bool:
-        """检查媒体目录所在磁盘空间是否不足(小于5GB)"""
-        try:
-            media_path = Path("media")
-            if not media_path.exists():
-                # 如果媒体目录不存在，认为空间充足（或无法判断）
-                return False
-                
-            usage = shutil.disk_usage(media_path)
-            # 检查可用空间是否小于 5GB
-            is_low = usage.free < 5 * 1024 * 1024 * 1024
-            if is_low:
-                logger.warning(f"检测到磁盘空间不足。可用空间: {usage.free / (1024**3):.2f} GB")
-            return is_low
-        except FileNotFoundError:
-            logger.warning(f"检查磁盘空间时未找到路径: {media_path}")
-            return False
-        except Exception:
-            # 捕获其他潜在错误，如权限问题
-            logger.warning("无法检测磁盘空间", exc_info=True)
-            return False
+    async def compact_media_packs(self, force: bool = False) -> int:
+        """
+        压缩失效空间占比达到 pack_compact_ratio 的打包文件：把仍被引用的记录
+        追加到当前打包文件并更新其位置，然后删除旧文件。返回删除的打包文件数。
+        force 为 True 时（磁盘空间不足）压缩所有含失效空间的已写满打包文件。
+        """
+        store = self.pack_store
+        usage = await self.db.get_media_pack_usage()
+        removed = 0
+        for pack_path in await asyncio.to_thread(store.sealed_packs):
+            try:
+                size = os.path.getsize(pack_path)
+            except FileNotFoundError:
+                continue
+            live = usage.get(pack_path, 0)
+            if size and (size <= live if force else (size - live) / size < self.pack_compact_ratio):
+                continue
+
+            moved = 0
+            for path, offset, length in await self.db.get_packed_blobs(pack_path):
+                data = await asyncio.to_thread(store.read, pack_path, offset, length)
+                new_location = await asyncio.to_thread(store.append, data)
+                if await self.db.move_packed_blob(path, (pack_path, offset), new_location):
+                    moved += 1
+                await asyncio.sleep(0)  # 大量小记录时让出事件循环
+            # 压缩期间不会有新记录写入已写满的打包文件
+            if not await self.db.is_media_pack_referenced(pack_path):
+                if await asyncio.to_thread(store.remove, pack_path):
+                    removed += 1
+                    logger.info(f"已压缩媒体打包文件 {pack_path}: 迁移 {moved} 条记录，释放 {size - live} 字节")
+        return removed
+
+    async def enforce_quota(self) -> Optional[EvictionReport]:
+        """容量超出配额或磁盘空间不足时淘汰媒体和最早的消息，并回收打包文件中被淘汰的空间。"""
+        if self.quota is None:
+            return None
+        # 剩余空间不足时立即压缩受影响的打包文件，被淘汰的打包媒体才真正归还空间
+        reclaim_packs = partial(self.compact_media_packs, force=True) if self.pack_store is not None else None
+        report = await self.quota.enforce(reclaim_packs)
+        if report.evicted_media and self.pack_store is not None:
+            await self.compact_media_packs()
+        return report
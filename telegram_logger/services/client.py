@@ -1,9 +1,10 @@
 import time
 from telethon import TelegramClient, events, errors as telethon_errors
 import sys # 确保 sys 已导入，因为后面用到了 sys.exit
-from typing import List
+from typing import Optional
 import logging
-from telegram_logger.handlers.base_handler import BaseHandler
+from telegram_logger.handlers.pipeline import EventPipeline
+from telegram_logger.services.event_queue import ShardedEventQueue
 
 logger = logging.getLogger(__name__)
 
@@ -13,11 +14,13 @@ class TelegramClientService:
         session_name: str,
         api_id: int,
         api_hash: str,
-        handlers: List[BaseHandler],
-        log_chat_id: int
+        pipeline: EventPipeline,
+        log_chat_id: int,
+        event_queue: Optional[ShardedEventQueue] = None,
     ):
         self.client = TelegramClient(session_name, api_id, api_hash)
-        self.handlers = handlers
+        self.pipeline = pipeline
+        self.event_queue = event_queue
         self.log_chat_id = log_chat_id
         self._is_initialized = False
         self._start_time = time.time()
@@ -51,6 +54,7 @@ class TelegramClientService:
 
             my_id = me.id
             logger.info(f"客户端初始化成功。用户 ID: {my_id}")
+            self.pipeline.my_id = my_id
 
             # 注册事件处理器 (移动到获取 my_id 之后，确保 client 正常)
             self._register_handlers()
@@ -73,57 +77,17 @@ class TelegramClientService:
             sys.exit(1) # 未知严重错误，无法继续
 
     def _register_handlers(self):
-        """根据新的统一接口方案注册事件处理器。"""
+        """注册事件流水线：每种事件类型一个 Telethon 处理器，由流水线按阶段分发。"""
         if not self.client or not self.client.is_connected():
             logger.error("客户端尚未初始化或未连接，无法注册处理器。")
             return
 
-        logger.info("开始注册事件处理器 (统一接口方案)...")
-
-        # 遍历所有注入的处理器实例
-        for handler in self.handlers:
-            # 检查处理器是否是 BaseHandler 的实例
-            if isinstance(handler, BaseHandler):
-                handler_name = type(handler).__name__
-                logger.info(f"为处理器 '{handler_name}' 注册通用事件监听器...")
-
-                # 注册 NewMessage 事件，不带过滤器，指向 handler.process
-                try:
-                    self.client.add_event_handler(
-                        handler.process,
-                        events.NewMessage() # 通用事件，无过滤器
-                    )
-                    logger.debug(f"  - 已为 '{handler_name}' 注册 NewMessage 事件 -> process()")
-                except Exception as e:
-                    logger.error(f"为 '{handler_name}' 注册 NewMessage 事件失败: {e}", exc_info=True)
-
-                # 注册 MessageEdited 事件，不带过滤器，指向 handler.process
-                try:
-                    self.client.add_event_handler(
-                        handler.process,
-                        events.MessageEdited() # 通用事件，无过滤器
-                    )
-                    logger.debug(f"  - 已为 '{handler_name}' 注册 MessageEdited 事件 -> process()")
-                except Exception as e:
-                    logger.error(f"为 '{handler_name}' 注册 MessageEdited 事件失败: {e}", exc_info=True)
-
-                # 注册 MessageDeleted 事件，不带过滤器，指向 handler.process
-                try:
-                    self.client.add_event_handler(
-                        handler.process,
-                        events.MessageDeleted() # 通用事件，无过滤器
-                    )
-                    logger.debug(f"  - 已为 '{handler_name}' 注册 MessageDeleted 事件 -> process()")
-                except Exception as e:
-                    logger.error(f"为 '{handler_name}' 注册 MessageDeleted 事件失败: {e}", exc_info=True)
-
-            else:
-                # 如果处理器不是 BaseHandler 的子类，则记录警告
-                logger.warning(
-                    f"处理器 {type(handler).__name__} 不是 BaseHandler 的实例，"
-                    f"无法按统一接口方案注册事件。"
-                )
-
+        logger.info("开始注册事件流水线...")
+        try:
+            self.pipeline.register(self.client, queue=self.event_queue)
+        except Exception as e:
+            logger.error(f"注册事件流水线失败: {e}", exc_info=True)
+            return
         logger.info("所有处理器事件注册完成。")
 
     async def health_check(self) -> dict:
@@ -136,6 +100,7 @@ class TelegramClientService:
                 - logged_in (bool): 是否完成登录
                 - uptime (float): 运行时间(秒)
                 - last_error (str): 最后错误信息(如果有)
+                - event_queue (dict): 事件队列深度、排队等待时间等统计(启用时)
         """
         try:
             me = await self.client.get_me() if self._is_initialized else None
@@ -145,7 +110,8 @@ class TelegramClientService:
                 'logged_in': self._is_initialized,
                 'user_id': me.id if me else None,
                 'uptime': (time.time() - self._start_time) if hasattr(self, '_start_time') else 0,
-                'last_error': getattr(self, '_last_error', None)
+                'last_error': getattr(self, '_last_error', None),
+                'event_queue': self.event_queue.stats() if self.event_queue else None,
             }
         except Exception as e:
             self._last_error = str(e)
@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 队列已满时的处理策略
+OVERFLOW_BLOCK = "block"  # 等待空位，背压传递到 Telethon 更新循环
+OVERFLOW_DROP_NEWEST = "drop_newest"  # 丢弃新到的事件
+OVERFLOW_DROP_OLDEST = "drop_oldest"  # 丢弃该分片中最早的事件，为新事件腾出位置
+OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP_NEWEST, OVERFLOW_DROP_OLDEST)
+
+
+class ShardedEventQueue:
+    """
+    Telethon 更新循环与事件处理之间的分片工作队列。
+
+    事件按键（chat_id）分配到 workers 个分片之一，每个分片由一个工作协程按入队顺序处理：
+    同一聊天的事件保持顺序，不同聊天的事件并行，某个聊天的慢发送或慢下载只阻塞它所在的分片。
+    键为 None 的事件（无法确定聊天的删除事件）单独放在分片 0，
+    有 chat_id 的事件分散到其余分片（只有一个工作协程时全部在分片 0）。
+    队列总容量为 capacity（平均分给各分片），分片已满时按 overflow 策略处理。
+    stats() 提供队列深度和事件排队等待时间。
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[Any], Awaitable[Any]],
+        workers: int = 4,
+        capacity: int = 1000,
+        overflow: str = OVERFLOW_BLOCK,
+    ):
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.shard_capacity = max(1, capacity // self.workers)
+        if overflow not in OVERFLOW_POLICIES:
+            logger.warning(f"未知的事件队列溢出策略 {overflow!r}，使用 {OVERFLOW_BLOCK}")
+            overflow = OVERFLOW_BLOCK
+        self.overflow = overflow
+        self._shards: List[asyncio.Queue] = []
+        self._tasks: List[asyncio.Task] = []
+        self._running = False
+
+        # 统计信息
+        self.enqueued_count = 0
+        self.processed_count = 0
+        self.failed_count = 0
+        self.dropped_count = 0
+        self.max_depth = 0
+        self._waited = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    @property
+    def depth(self) -> int:
+        return sum(shard.qsize() for shard in self._shards)
+
+    def shard_for(self, key: Optional[int]) -> int:
+        if key is None or self.workers == 1:
+            return 0
+        return 1 + hash(key) % (self.workers - 1)
+
+    async def start(self):
+        """启动各分片的工作协程"""
+        if self._running:
+            return
+        self._shards = [asyncio.Queue(self.shard_capacity) for _ in range(self.workers)]
+        self._running = True
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logger.info(
+            f"事件队列已启动 (workers={self.workers}, 每分片容量={self.shard_capacity}, 溢出策略={self.overflow})"
+        )
+
+    async def stop(self, timeout: float = 10.0):
+        """
+        停止工作协程；先在 timeout 秒内处理完已入队的事件，超时后放弃剩余事件。
+        处理期间到达的事件仍然入队（排在已有事件之后），处理完后才改为直接处理。
+        """
+        if not self._running:
+            return
+        try:
+            await asyncio.wait_for(asyncio.gather(*(shard.join() for shard in self._shards)), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"事件队列未能在 {timeout} 秒内处理完，放弃剩余 {self.depth} 个事件")
+        self._running = False
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        logger.info(f"事件队列已停止。统计: {self.stats()}")
+
+    async def put(self, key: Optional[int], item: Any) -> bool:
+        """
+        放入一个事件。分片已满时按溢出策略等待或丢弃。
+
+        Returns:
+            bool: 事件是否已入队（未运行时直接处理，返回 True）。
+        """
+        if not self._running:
+            # 队列未启动或已停止时不排队，保证事件不会丢失
+            await self.handler(item)
+            return True
+        shard = self._shards[self.shard_for(key)]
+        entry = (time.monotonic(), item)
+        try:
+            shard.put_nowait(entry)
+        except asyncio.QueueFull:
+            if self.overflow == OVERFLOW_DROP_NEWEST:
+                self._drop(key, item)
+                return False
+            if self.overflow == OVERFLOW_DROP_OLDEST:
+                _, oldest = shard.get_nowait()
+                shard.task_done()
+                self._drop(key, oldest)
+                shard.put_nowait(entry)
+            else:
+                await shard.put(entry)
+        self.enqueued_count += 1
+        self.max_depth = max(self.max_depth, self.depth)
+        return True
+
+    def _drop(self, key: Optional[int], item: Any):
+        self.dropped_count += 1
+        logger.warning(
+            f"事件队列分片 {self.shard_for(key)} 已满 ({self.shard_capacity})，"
+            f"丢弃 {type(item).__name__} (ChatID={key})"
+        )
+
+    async def _worker(self, index: int):
+        shard = self._shards[index]
+        while True:
+            enqueued_at, item = await shard.get()
+            wait = time.monotonic() - enqueued_at
+            self._waited += 1
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+            try:
+                await self.handler(item)
+                self.processed_count += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed_count += 1
+                logger.error(f"事件队列分片 {index} 处理 {type(item).__name__} 时出错: {e}", exc_info=True)
+            finally:
+                shard.task_done()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "shard_depths": [shard.qsize() for shard in self._shards],
+            "enqueued": self.enqueued_count,
+            "processed": self.processed_count,
+            "failed": self.failed_count,
+            "dropped": self.dropped_count,
+            "mean_wait_ms": self._wait_total / self._waited * 1000 if self._waited else 0.0,
+            "max_wait_ms": self._wait_max * 1000,
+        }
@@ -0,0 +1,88 @@
+import asyncio
+import logging
+import os
+from pathlib import Path
+
+from telegram_logger.utils.crypto_executor import CryptoExecutor, crypto_executor
+from telegram_logger.utils.file_encrypt import PARTIAL_SUFFIX, convert_legacy_file, is_legacy_format
+
+logger = logging.getLogger(__name__)
+
+
+class MediaConverterService:
+    """
+    后台把旧的 AES Crypt 格式媒体文件逐个转换为分块容器格式。
+
+    转换在加解密线程池中执行，每个文件之间暂停 pause 秒；文件路径不变，
+    读取端按文件头自动识别格式，因此转换过程中旧文件仍可正常读取。
+    """
+
+    def __init__(
+        self,
+        media_dir: str = "media",
+        pause: float = 0.5,
+        executor: CryptoExecutor = None,
+    ):
+        self.media_dir = Path(media_dir)
+        self.pause = pause
+        self.executor = executor or crypto_executor
+        self._task = None
+        self._running = False
+
+    async def start(self):
+        """启动转换服务"""
+        if not self._running:
+            self._running = True
+            self._task = asyncio.create_task(self._run_conversion())
+            logger.info("媒体格式转换服务已启动")
+
+    async def stop(self):
+        """停止转换服务"""
+        if self._running:
+            self._running = False
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            logger.info("媒体格式转换服务已停止")
+
+    def _legacy_files(self):
+        if not self.media_dir.is_dir():
+            return []
+        files = []
+        for entry in os.scandir(self.media_dir):
+            if not entry.is_file() or entry.name.endswith(PARTIAL_SUFFIX):
+                continue
+            try:
+                if is_legacy_format(entry.path):
+                    files.append(entry.path)
+            except OSError:
+                continue  # 文件可能已被清理服务删除
+        return files
+
+    async def _run_conversion(self):
+        """转换所有旧格式文件，完成后退出。"""
+        converted = failed = 0
+        try:
+            files = await asyncio.to_thread(self._legacy_files)
+            if not files:
+                return
+            logger.info(f"发现 {len(files)} 个旧格式媒体文件，开始后台转换")
+            for path in files:
+                if not self._running:
+                    break
+                try:
+                    if await self.executor.run("convert", convert_legacy_file, path):
+                        converted += 1
+                except FileNotFoundError:
+                    pass  # 转换前已被清理
+                except Exception as e:
+                    failed += 1
+                    logger.error(f"转换媒体文件 {path} 失败: {e}")
+                await asyncio.sleep(self.pause)
+            logger.info(f"媒体格式转换完成: 成功 {converted} 个, 失败 {failed} 个")
+        except asyncio.CancelledError:
+            logger.info(f"媒体格式转换被中断: 已转换 {converted} 个, 失败 {failed} 个")
+        except Exception as e:
+            logger.critical(f"媒体格式转换服务发生严重错误: {str(e)}", exc_info=True)
@@ -0,0 +1,134 @@
+import asyncio
+import itertools
+import logging
+from typing import Optional
+
+from telethon.tl.types import Message as TelethonMessage
+
+from telegram_logger.data.database import DatabaseManager
+from telegram_logger.data.models import Message
+from telegram_logger.utils.media import save_media_as_file
+
+logger = logging.getLogger(__name__)
+
+# 下载优先级，数值越小越先下载
+PRIORITY_SELF_DESTRUCTING = 0  # 自毁消息，错过就无法再获取
+PRIORITY_NOFORWARDS = 1  # 禁止转发的受限媒体
+PRIORITY_PRIVATE = 2  # 私聊和机器人消息
+PRIORITY_GROUP = 3  # 普通群组/频道媒体
+
+# 队列已满时这些优先级的任务等待入队，其余任务被丢弃
+_MUST_KEEP_PRIORITIES = (PRIORITY_SELF_DESTRUCTING, PRIORITY_NOFORWARDS)
+
+
+class MediaDownloadService:
+    """
+    后台媒体下载工作池。
+
+    PersistenceHandler 先把消息行（media_path 为空）写入数据库，再把媒体下载任务放入
+    有界优先级队列；workers 个工作协程按优先级取出任务下载并加密保存，
+    完成后通过 DatabaseManager.set_media_path 回填该消息行的 media_path，
+    并通过 DatabaseManager.persistence_signals 通知等待该媒体的处理器（失败时同样通知）。
+    """
+
+    def __init__(self, db: DatabaseManager, workers: int = 3, max_queue: int = 1000):
+        self.db = db
+        self.workers = max(1, workers)
+        self.max_queue = max(1, max_queue)
+        self.client = None
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._tasks = []
+        self._seq = itertools.count()  # 同优先级按入队顺序
+        self._running = False
+
+        # 统计信息
+        self.enqueued_count = 0
+        self.completed_count = 0
+        self.failed_count = 0
+        self.dropped_count = 0
+
+    @staticmethod
+    def priority_for(message: Message) -> int:
+        """根据消息属性计算下载优先级。"""
+        if message.self_destructing:
+            return PRIORITY_SELF_DESTRUCTING
+        if message.noforwards:
+            return PRIORITY_NOFORWARDS
+        if message.msg_type in (DatabaseManager.MSG_TYPE_MAP['user'], DatabaseManager.MSG_TYPE_MAP['bot']):
+            return PRIORITY_PRIVATE
+        return PRIORITY_GROUP
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    async def start(self, client):
+        """启动下载工作协程"""
+        if self._running:
+            return
+        self.client = client
+        self._queue = asyncio.PriorityQueue(self.max_queue)
+        self._running = True
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logger.info(f"媒体下载服务已启动 (workers={self.workers}, max_queue={self.max_queue})")
+
+    async def stop(self):
+        """停止下载工作协程，队列中未开始的任务被放弃"""
+        if not self._running:
+            return
+        self._running = False
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        logger.info(
+            f"媒体下载服务已停止。入队 {self.enqueued_count} 个，完成 {self.completed_count} 个，"
+            f"失败 {self.failed_count} 个，丢弃 {self.dropped_count} 个，未处理 {self.depth} 个。"
+        )
+
+    async def enqueue(self, message: Message, telethon_message: TelethonMessage) -> bool:
+        """
+        放入一个下载任务。队列已满时，自毁和禁止转发的媒体等待空位，其余任务直接丢弃。
+
+        Returns:
+            bool: 任务是否已入队。
+        """
+        if not self._running:
+            logger.warning(f"媒体下载服务未运行，忽略消息 {message.id} 的媒体")
+            return False
+        priority = self.priority_for(message)
+        item = (priority, next(self._seq), message, telethon_message)
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            if priority not in _MUST_KEEP_PRIORITIES:
+                self.dropped_count += 1
+                logger.warning(
+                    f"媒体下载队列已满 ({self.max_queue})，丢弃消息 {message.id} (ChatID={message.chat_id}) 的媒体"
+                )
+                return False
+            await self._queue.put(item)
+        self.enqueued_count += 1
+        logger.debug(f"媒体下载任务已入队: MsgID={message.id} 优先级={priority} 队列长度={self.depth}")
+        return True
+
+    async def _worker(self, index: int):
+        while True:
+            priority, _, message, telethon_message = await self._queue.get()
+            try:
+                media_path = await save_media_as_file(self.client, telethon_message, db=self.db)
+                if media_path:
+                    self.db.set_media_path(message, media_path)
+                self.completed_count += 1
+                logger.debug(f"媒体下载完成: MsgID={message.id} 优先级={priority} -> {media_path}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed_count += 1
+                logger.error(
+                    f"下载媒体失败 (MsgID={message.id} ChatID={message.chat_id} worker={index}): {e}",
+                    exc_info=True,
+                )
+            finally:
+                self.db.persistence_signals.finish_media(message.chat_id, message.id)
+                self._queue.task_done()
@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import os
+import shutil
+from typing import Any, Awaitable, Callable, List, Optional
+
+from telegram_logger.data.database import DatabaseManager
+from telegram_logger.data.models import EvictionReport, ExpiryStats, StorageUsage
+
+logger = logging.getLogger(__name__)
+
+# 淘汰原因
+REASON_MEDIA_QUOTA = "media_quota"
+REASON_DB_QUOTA = "db_quota"
+REASON_DISK_FREE = "disk_free"
+
+
+class StorageQuota:
+    """
+    媒体与数据库的容量配额。
+
+    媒体字节数由 DatabaseManager.media_bytes 随媒体登记和删除增量维护，数据库字节数由 PRAGMA 得到，
+    剩余空间来自 shutil.disk_usage，一次检查不需要遍历媒体目录。
+    任一配额超出或剩余空间低于 min_free_bytes 时开始淘汰：先淘汰媒体（按 order 选择最久未使用或最大的），
+    媒体已无可淘汰或数据库超出配额时再删除最早的消息，直到回到低水位（配额的 low_water 倍）。
+    配额为 0 表示不限制。
+    打包存储的媒体被淘汰后，空间要等打包文件压缩后才归还；剩余空间只按实际测得的值计算，
+    剩余空间不足时由 enforce 的 reclaim_packs 立即压缩受影响的打包文件。
+    """
+
+    def __init__(
+        self,
+        db: DatabaseManager,
+        media_dir: str = "media",
+        media_quota_bytes: int = 0,
+        db_quota_bytes: int = 0,
+        min_free_bytes: int = 5 * 1024 ** 3,
+        low_water: float = 0.9,
+        order: str = "oldest",
+        batch_size: int = 100,
+    ):
+        self.db = db
+        self.media_dir = media_dir
+        self.media_quota_bytes = media_quota_bytes
+        self.db_quota_bytes = db_quota_bytes
+        self.min_free_bytes = min_free_bytes
+        self.low_water = min(max(low_water, 0.1), 1.0)
+        if order not in DatabaseManager.EVICTION_ORDERS:
+            logger.warning(f"未知的媒体淘汰顺序 {order!r}，使用 oldest")
+            order = "oldest"
+        self.order = order
+        self.batch_size = max(1, batch_size)
+
+    async def usage(self) -> StorageUsage:
+        try:
+            free_bytes = (await asyncio.to_thread(shutil.disk_usage, self.media_dir)).free
+        except FileNotFoundError:
+            free_bytes = (await asyncio.to_thread(shutil.disk_usage, ".")).free
+        return StorageUsage(
+            media_bytes=self.db.media_bytes,
+            db_bytes=await self.db.get_database_bytes(),
+            free_bytes=free_bytes,
+        )
+
+    def breaches(self, usage: StorageUsage, low_water: bool = False) -> List[str]:
+        """返回超出的配额；low_water 为 True 时按低水位判断（用于决定是否继续淘汰）。"""
+        factor = self.low_water if low_water else 1.0
+        reasons = []
+        if self.media_quota_bytes and usage.media_bytes > self.media_quota_bytes * factor:
+            reasons.append(REASON_MEDIA_QUOTA)
+        if self.db_quota_bytes and usage.db_bytes > self.db_quota_bytes * factor:
+            reasons.append(REASON_DB_QUOTA)
+        if self.min_free_bytes and usage.free_bytes < self.min_free_bytes / factor:
+            reasons.append(REASON_DISK_FREE)
+        return reasons
+
+    async def enforce(self, reclaim_packs: Optional[Callable[[], Awaitable[Any]]] = None) -> EvictionReport:
+        """
+        检查配额，超出时淘汰数据直到回到低水位。
+
+        Args:
+            reclaim_packs: 剩余空间不足且淘汰了媒体时调用，强制压缩含失效空间的打包文件，
+                使被淘汰的打包媒体真正归还磁盘空间。
+        """
+        usage = await self.usage()
+        report = EvictionReport(reasons=self.breaches(usage), before=usage)
+        if not report.reasons:
+            report.after = usage
+            return report
+
+        logger.warning(
+            f"存储容量超出配额 ({', '.join(report.reasons)}): 媒体 {usage.media_bytes} 字节，"
+            f"数据库 {usage.db_bytes} 字节，剩余空间 {usage.free_bytes} 字节，开始淘汰"
+        )
+        while True:
+            pending = self.breaches(usage, low_water=True)
+            if not pending:
+                break
+
+            evicted_media = evicted_messages = 0
+            if REASON_MEDIA_QUOTA in pending or REASON_DISK_FREE in pending:
+                evicted_media, size, paths = await self.db.evict_media_blobs(self.batch_size, self.order)
+                report.evicted_media += evicted_media
+                report.evicted_media_bytes += size
+                await self._delete_files(paths, report)
+                if evicted_media and REASON_DISK_FREE in pending and reclaim_packs is not None:
+                    await reclaim_packs()
+
+            if not evicted_media and (REASON_DB_QUOTA in pending or REASON_DISK_FREE in pending):
+                evicted_messages, paths = await self.db.evict_oldest_messages(self.batch_size)
+                report.evicted_messages += evicted_messages
+                await self._delete_files(paths, report)
+                if evicted_messages:
+                    await self.db.reclaim_database_space()
+
+            if not evicted_media and not evicted_messages:
+                logger.error(f"已无可淘汰的数据，存储仍超出配额: {', '.join(pending)}")
+                break
+
+            previous = usage
+            usage = await self.usage()
+            if evicted_messages and usage.db_bytes >= previous.db_bytes and usage.free_bytes <= previous.free_bytes:
+                # 删除消息未释放任何空间，停止以免删除全部消息
+                logger.error("淘汰消息未能释放空间，停止淘汰")
+                break
+
+        report.after = await self.usage()
+        logger.warning(
+            f"容量淘汰完成: 淘汰媒体 {report.evicted_media} 个 ({report.evicted_media_bytes} 字节，"
+            f"删除文件 {report.deleted_files} 个)，删除消息 {report.evicted_messages} 条；"
+            f"媒体 {report.after.media_bytes} 字节，数据库 {report.after.db_bytes} 字节，"
+            f"剩余空间 {report.after.free_bytes} 字节"
+        )
+        return report
+
+    @staticmethod
+    async def _delete_files(paths: List[str], report: EvictionReport) -> int:
+        """删除单独保存的媒体文件，返回释放的字节数。"""
+        if not paths:
+            return 0
+        freed = await asyncio.to_thread(_total_size, paths)
+        stats = ExpiryStats()
+        await asyncio.to_thread(DatabaseManager._delete_media_files, paths, stats)
+        report.deleted_files += stats.deleted_files
+        return freed
+
+
+def _total_size(paths: List[str]) -> int:
+    total = 0
+    for path in paths:
+        try:
+            total += os.path.getsize(path)
+        except OSError:
+            pass
+    return total
@@ -1,3 +1,4 @@
-from .file_encrypt import encrypted, decrypted
+from .file_encrypt import encrypted, decrypted, encrypted_async, decrypted_async
+from .crypto_executor import CryptoExecutor, crypto_executor
 
-__all__ = ['encrypted', 'decrypted']
+__all__ = ['encrypted', 'decrypted', 'encrypted_async', 'decrypted_async', 'CryptoExecutor', 'crypto_executor']
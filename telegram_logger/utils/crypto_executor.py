@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+from dotenv import load_dotenv
+
+load_dotenv()
+CRYPTO_WORKERS = int(os.getenv("CRYPTO_WORKERS", "2"))
+
+logger = logging.getLogger(__name__)
+
+
+class _JobStats:
+    """单类任务的计数与耗时统计（秒）。"""
+
+    __slots__ = ("count", "failed", "wait_total", "run_total", "run_max")
+
+    def __init__(self):
+        self.count = 0
+        self.failed = 0
+        self.wait_total = 0.0
+        self.run_total = 0.0
+        self.run_max = 0.0
+
+
+class CryptoExecutor:
+    """
+    媒体加解密与哈希计算的专用线程池。
+
+    密钥派生（8192 轮 SHA256）和 AES 加解密都是 CPU 密集的同步调用，
+    直接在事件循环线程执行会阻塞所有事件处理。通过 run() 提交到固定大小的线程池，
+    并发数由 max_workers 限制；同时统计排队深度和每类任务的等待/执行耗时。
+    """
+
+    def __init__(self, max_workers: int = CRYPTO_WORKERS):
+        self.max_workers = max(1, max_workers)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="crypto")
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._jobs: Dict[str, _JobStats] = {}
+
+    @property
+    def queue_depth(self) -> int:
+        """已提交但尚未开始执行的任务数。"""
+        return self._queued
+
+    async def run(self, job: str, fn: Callable[..., Any], *args) -> Any:
+        """在线程池中执行 fn(*args)，job 为统计用的任务类别名。"""
+        submitted = time.perf_counter()
+        with self._lock:
+            self._queued += 1
+
+        def call():
+            started = time.perf_counter()
+            with self._lock:
+                self._queued -= 1
+                self._running += 1
+            failed = True
+            try:
+                result = fn(*args)
+                failed = False
+                return result
+            finally:
+                self._record(job, started - submitted, time.perf_counter() - started, failed)
+
+        future = self._executor.submit(call)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # 尚未开始的任务直接取消；已在执行的任务会运行完毕并照常计入统计
+            if future.cancel():
+                with self._lock:
+                    self._queued -= 1
+            raise
+
+    def _record(self, job: str, wait: float, elapsed: float, failed: bool):
+        with self._lock:
+            self._running -= 1
+            stats = self._jobs.get(job)
+            if stats is None:
+                stats = self._jobs[job] = _JobStats()
+            stats.count += 1
+            stats.failed += failed
+            stats.wait_total += wait
+            stats.run_total += elapsed
+            stats.run_max = max(stats.run_max, elapsed)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            jobs = {
+                name: {
+                    "count": s.count,
+                    "failed": s.failed,
+                    "avg_wait_ms": s.wait_total / s.count * 1000,
+                    "avg_run_ms": s.run_total / s.count * 1000,
+                    "max_run_ms": s.run_max * 1000,
+                }
+                for name, s in self._jobs.items()
+            }
+            return {
+                "workers": self.max_workers,
+                "queued": self._queued,
+                "running": self._running,
+                "jobs": jobs,
+            }
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+        logger.info(f"加解密线程池已关闭，统计: {self.stats()}")
+
+
+# 进程内共享的默认实例，媒体保存和解密都通过它执行
+crypto_executor = CryptoExecutor()
@@ -1,42 +1,658 @@
+import asyncio
+import functools
+import hashlib
 import io
 import os
+import struct
 from os import stat
-from contextlib import contextmanager
+from contextlib import asynccontextmanager, contextmanager
+from typing import List
 import pyAesCrypt
+from cryptography.exceptions import InvalidSignature, InvalidTag
+from cryptography.hazmat.primitives import hashes, hmac
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from dotenv import load_dotenv
 
+from .crypto_executor import CryptoExecutor, crypto_executor
+
 load_dotenv()
 BUFFER_SIZE = 1024 * 1024
 FILE_PASSWORD = os.getenv("FILE_PASSWORD", "default-weak-password")  # 使用 FILE_PASSWORD 环境变量
 
+# 加密写入过程中的临时文件后缀，完成后原子重命名为目标路径
+PARTIAL_SUFFIX = ".part"
+
+AES_BLOCK_SIZE = 16
+
+# --- 分块容器格式 ---
+# 文件头: magic(4) | version(1) | chunk_size(4, 大端) | file_salt(16)
+# 之后每个块为 AES-256-GCM 密文 + 16 字节 tag，除最后一块外明文长度均为 chunk_size。
+# 块 i 的 nonce 为 i 的 12 字节大端编码，附加数据为文件头 + 是否最后一块，
+# 因此块不能被重排，文件也不能在块边界被截断。
+CONTAINER_MAGIC = b"TLMC"
+CONTAINER_VERSION = 1
+CONTAINER_CHUNK_SIZE = 64 * 1024
+_CONTAINER_HEADER = struct.Struct(">4sBI16s")
+_GCM_TAG_SIZE = 16
+
+# 主密钥由 FILE_PASSWORD 派生，每个进程只计算一次；每个文件再用随机 salt 经 HKDF 派生文件密钥
+_MASTER_KEY_SALT = b"telegram-logger/media-container/v1"
+_MASTER_KEY_ITERATIONS = 200_000
+
 # this is meant to be more about obfuscation and less about security
 
 
+@functools.lru_cache(maxsize=4)
+def _master_key(password: str) -> bytes:
+    kdf = PBKDF2HMAC(
+        algorithm=hashes.SHA256(), length=32, salt=_MASTER_KEY_SALT, iterations=_MASTER_KEY_ITERATIONS
+    )
+    return kdf.derive(password.encode("utf-8"))
+
+
+def _file_cipher(password: str, file_salt: bytes) -> AESGCM:
+    key = HKDF(algorithm=hashes.SHA256(), length=32, salt=file_salt, info=b"media chunk key").derive(
+        _master_key(password)
+    )
+    return AESGCM(key)
+
+
+def _chunk_nonce(index: int) -> bytes:
+    return index.to_bytes(12, "big")
+
+
+def _encrypt_chunk(aead: AESGCM, header: bytes, index: int, plaintext: bytes, final: bool) -> bytes:
+    return aead.encrypt(_chunk_nonce(index), plaintext, header + (b"\x01" if final else b"\x00"))
+
+
+def _container_header(password: str, chunk_size: int):
+    file_salt = os.urandom(16)
+    header = _CONTAINER_HEADER.pack(CONTAINER_MAGIC, CONTAINER_VERSION, chunk_size, file_salt)
+    return header, _file_cipher(password, file_salt)
+
+
+def encrypt_container(data: bytes, password: str = FILE_PASSWORD, chunk_size: int = CONTAINER_CHUNK_SIZE) -> bytes:
+    """把内存中的 data 整体加密为一个分块容器（与 ChunkedEncryptingWriter 写出的格式相同）。"""
+    header, aead = _container_header(password, chunk_size)
+    count = max(1, -(-len(data) // chunk_size))
+    parts = [header]
+    for index in range(count):
+        chunk = data[index * chunk_size:(index + 1) * chunk_size]
+        parts.append(_encrypt_chunk(aead, header, index, chunk, index == count - 1))
+    return b"".join(parts)
+
+
+def _aescrypt_header(password: str, iv0: bytes, int_key: bytes) -> bytes:
+    """构造 AES Crypt v2 文件头（与 pyAesCrypt.encryptStream 写出的格式一致）。"""
+    if len(password) > pyAesCrypt.crypto.maxPassLen:
+        raise ValueError("Password is too long.")
+    iv1 = os.urandom(AES_BLOCK_SIZE)
+    key = pyAesCrypt.crypto.stretch(password, iv1)
+
+    encryptor = Cipher(algorithms.AES(key), modes.CBC(iv1)).encryptor()
+    c_iv_key = encryptor.update(iv0 + int_key) + encryptor.finalize()
+    key_hmac = hmac.HMAC(key, hashes.SHA256())
+    key_hmac.update(c_iv_key)
+
+    created_by = b"CREATED_BY\x00" + f"pyAesCrypt {pyAesCrypt.crypto.version}".encode("utf8")
+    return b"".join([
+        b"AES\x02\x00",
+        b"\x00" + bytes([len(created_by)]), created_by,
+        b"\x00\x80" + b"\x00" * 128,  # container 扩展
+        b"\x00\x00",  # 扩展结束
+        iv1, c_iv_key, key_hmac.finalize(),
+    ])
+
+
+class _AtomicEncryptingWriter:
+    """
+    加密写入器基类：写入 `<file_path>.part`，commit 时写入尾部、fsync 后原子重命名为 file_path，
+    abort 时删除临时文件。子类实现 write 和 _write_trailer。
+    """
+
+    def __init__(self, file_path: str, header: bytes):
+        self.file_path = file_path
+        self.name = os.path.basename(file_path)
+        self.partial_path = file_path + PARTIAL_SUFFIX
+        self.bytes_written = 0
+        self._closed = False
+        self._digest = hashlib.sha256()  # 明文的 SHA-256，用于媒体去重
+        self._file = open(self.partial_path, "wb")
+        try:
+            self._file.write(header)
+        except BaseException:
+            self.abort()
+            raise
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    @property
+    def content_hash(self) -> str:
+        """已写入明文的 SHA-256（十六进制）。"""
+        return self._digest.hexdigest()
+
+    def _check_open(self):
+        if self._closed:
+            raise ValueError(f"write to closed {type(self).__name__}")
+
+    def write(self, data) -> int:
+        raise NotImplementedError
+
+    def _write_trailer(self):
+        raise NotImplementedError
+
+    def flush(self):
+        if not self._closed:
+            self._file.flush()
+
+    def commit(self):
+        """写入尾部，落盘后重命名为最终文件。"""
+        if self._closed:
+            return
+        try:
+            self._write_trailer()
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            os.replace(self.partial_path, self.file_path)
+            self._closed = True
+        except BaseException:
+            self.abort()
+            raise
+
+    def abort(self):
+        """放弃写入并删除临时文件，目标路径保持不变。"""
+        self._closed = True
+        try:
+            self._file.close()
+        except Exception:
+            pass
+        try:
+            os.remove(self.partial_path)
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        self.commit()
+
+
+class EncryptingWriter(_AtomicEncryptingWriter):
+    """
+    AES Crypt v2 格式的流式加密写入器（旧格式，保留用于兼容和基准测试）。
+
+    每次 write 的数据按 AES 块对齐后立即加密写入，内存中最多保留不足一个块的数据；
+    commit 时写入填充和 HMAC。输出可以直接用 pyAesCrypt.decryptStream 解密。
+    """
+
+    def __init__(self, file_path: str, password: str = FILE_PASSWORD):
+        iv0 = os.urandom(AES_BLOCK_SIZE)
+        int_key = os.urandom(32)
+        self._encryptor = Cipher(algorithms.AES(int_key), modes.CBC(iv0)).encryptor()
+        self._hmac = hmac.HMAC(int_key, hashes.SHA256())
+        self._pending = b""
+        super().__init__(file_path, _aescrypt_header(password, iv0, int_key))
+
+    def write(self, data) -> int:
+        self._check_open()
+        data = bytes(data)
+        self._digest.update(data)
+        self.bytes_written += len(data)
+        buffered = self._pending + data
+        aligned = len(buffered) - len(buffered) % AES_BLOCK_SIZE
+        if aligned:
+            self._write_ciphertext(self._encryptor.update(buffered[:aligned]))
+        self._pending = buffered[aligned:]
+        return len(data)
+
+    def _write_ciphertext(self, chunk: bytes):
+        self._hmac.update(chunk)
+        self._file.write(chunk)
+
+    def _write_trailer(self):
+        fs16 = len(self._pending)
+        if fs16:
+            pad_len = AES_BLOCK_SIZE - fs16
+            self._write_ciphertext(self._encryptor.update(self._pending + bytes([pad_len]) * pad_len))
+        self._write_ciphertext(self._encryptor.finalize())
+        self._file.write(bytes([fs16]))
+        self._file.write(self._hmac.finalize())
+
+
+class ChunkedEncryptingWriter(_AtomicEncryptingWriter):
+    """
+    分块容器格式的流式加密写入器。
+
+    数据按 chunk_size 分块，每块独立以 AES-256-GCM 加密和认证，
+    内存中最多保留一个块；主密钥每进程只派生一次，打开新文件只需一次 HKDF。
+    """
+
+    def __init__(self, file_path: str, password: str = FILE_PASSWORD, chunk_size: int = CONTAINER_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self._header, self._aead = _container_header(password, chunk_size)
+        self._buffer = bytearray()
+        self._index = 0
+        super().__init__(file_path, self._header)
+
+    def write(self, data) -> int:
+        self._check_open()
+        self._buffer += data
+        self._digest.update(data)
+        self.bytes_written += len(data)
+        # 保留最后一个完整块，直到确定它是否为最后一块
+        while len(self._buffer) > self.chunk_size:
+            self._write_chunk(bytes(self._buffer[:self.chunk_size]), final=False)
+            del self._buffer[:self.chunk_size]
+        return len(data)
+
+    def _write_chunk(self, plaintext: bytes, final: bool):
+        self._file.write(_encrypt_chunk(self._aead, self._header, self._index, plaintext, final))
+        self._index += 1
+
+    def _write_trailer(self):
+        self._write_chunk(bytes(self._buffer), final=True)
+        self._buffer = bytearray()
+
+
+class _SeekableDecryptingReader(io.RawIOBase):
+    """可随机访问的解密读取器基类，子类实现 _read_at(pos, size) 并设置 size。"""
+
+    size = 0
+
+    def __init__(self, file_path: str, buffer_size: int):
+        super().__init__()
+        self.name = os.path.basename(file_path)
+        self._buffer_size = max(AES_BLOCK_SIZE, buffer_size - buffer_size % AES_BLOCK_SIZE)
+        self._file = open(file_path, "rb")
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_SET:
+            pos = offset
+        elif whence == os.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == os.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError(f"invalid whence ({whence})")
+        if pos < 0:
+            raise ValueError(f"negative seek position {pos}")
+        self._pos = pos
+        return pos
+
+    def _clamp(self, size: int) -> int:
+        if size is None or size < 0:
+            size = self.size - self._pos
+        return max(0, min(size, self.size - self._pos))
+
+    def read(self, size: int = -1) -> bytes:
+        if self.closed:
+            raise ValueError("read from closed file")
+        size = self._clamp(size)
+        chunks = []
+        while size > 0:
+            chunk = self._read_at(self._pos, min(size, self._buffer_size))
+            chunks.append(chunk)
+            self._pos += len(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def _read_at(self, pos: int, size: int) -> bytes:
+        raise NotImplementedError
+
+    def _read_exact(self, size: int) -> bytes:
+        data = self._file.read(size)
+        if len(data) != size:
+            raise ValueError("File is corrupted or not an encrypted media file.")
+        return data
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+        super().close()
+
+
+class DecryptingReader(_SeekableDecryptingReader):
+    """
+    AES Crypt v2 文件的流式解密读取器（可随机访问）。
+
+    只在打开时读取文件头和尾部，read 时按需读取并解密对应的 CBC 块
+    （块 i 以密文块 i-1 作为 IV），内存占用与文件大小无关。
+    readable/seekable/tell 齐全，Telethon 上传时可获取文件大小并分块读取。
+    顺序读到末尾时校验整个密文的 HMAC，不一致时抛出 ValueError。
+    """
+
+    def __init__(self, file_path: str, password: str = FILE_PASSWORD, buffer_size: int = BUFFER_SIZE):
+        super().__init__(file_path, buffer_size)
+        try:
+            self._read_header(password, stat(file_path).st_size)
+        except BaseException:
+            self._file.close()
+            raise
+        # 顺序读取时增量计算密文 HMAC，_hmac_pos 为已计入 HMAC 的密文长度
+        self._hmac_pos = 0
+
+    def _read_header(self, password: str, file_size: int):
+        if self._read_exact(3) != b"AES":
+            raise ValueError("File is corrupted or not an AES Crypt file.")
+        if self._read_exact(1) != b"\x02":
+            raise ValueError("Unsupported AES Crypt file format version.")
+        self._read_exact(1)  # 保留字节
+        while True:
+            ext_len = int.from_bytes(self._read_exact(2), "big")
+            if ext_len == 0:
+                break
+            self._read_exact(ext_len)
+
+        iv1 = self._read_exact(AES_BLOCK_SIZE)
+        c_iv_key = self._read_exact(48)
+        expected = self._read_exact(32)
+        key = pyAesCrypt.crypto.stretch(password, iv1)
+        key_hmac = hmac.HMAC(key, hashes.SHA256())
+        key_hmac.update(c_iv_key)
+        try:
+            key_hmac.verify(expected)
+        except InvalidSignature:
+            raise ValueError("Wrong password (or file is corrupted).")
+        decryptor = Cipher(algorithms.AES(key), modes.CBC(iv1)).decryptor()
+        iv_key = decryptor.update(c_iv_key) + decryptor.finalize()
+        self._iv0, self._key = iv_key[:AES_BLOCK_SIZE], iv_key[AES_BLOCK_SIZE:]
+
+        # 文件尾：1 字节明文长度模 16 + 32 字节 HMAC
+        self._data_offset = self._file.tell()
+        self._cipher_len = file_size - self._data_offset - 33
+        if self._cipher_len < 0 or self._cipher_len % AES_BLOCK_SIZE:
+            raise ValueError("File is corrupted.")
+        self._file.seek(self._data_offset + self._cipher_len)
+        fs16 = self._read_exact(1)[0]
+        self._expected_hmac = self._read_exact(32)
+        pad_len = AES_BLOCK_SIZE - fs16 if fs16 else 0
+        if pad_len > self._cipher_len:
+            raise ValueError("File is corrupted.")
+        self.size = self._cipher_len - pad_len
+        self._data_hmac = hmac.HMAC(self._key, hashes.SHA256())
+
+    def _read_at(self, pos: int, size: int) -> bytes:
+        """解密覆盖明文区间 [pos, pos + size) 的密文块。"""
+        first = pos - pos % AES_BLOCK_SIZE
+        end = min(self._cipher_len, -(-(pos + size) // AES_BLOCK_SIZE) * AES_BLOCK_SIZE)
+        if first:
+            self._file.seek(self._data_offset + first - AES_BLOCK_SIZE)
+            iv = self._read_exact(AES_BLOCK_SIZE)
+        else:
+            self._file.seek(self._data_offset)
+            iv = self._iv0
+        ciphertext = self._read_exact(end - first)
+        self._update_hmac(first, ciphertext)
+        decryptor = Cipher(algorithms.AES(self._key), modes.CBC(iv)).decryptor()
+        plaintext = decryptor.update(ciphertext)
+        return plaintext[pos - first:pos - first + size]
+
+    def _update_hmac(self, offset: int, ciphertext: bytes):
+        if self._data_hmac is None or offset > self._hmac_pos:
+            return  # 非顺序读取时跳过，不影响已读数据
+        new = ciphertext[self._hmac_pos - offset:]
+        if not new:
+            return
+        self._data_hmac.update(new)
+        self._hmac_pos += len(new)
+        if self._hmac_pos == self._cipher_len:
+            data_hmac, self._data_hmac = self._data_hmac, None
+            try:
+                data_hmac.verify(self._expected_hmac)
+            except InvalidSignature:
+                raise ValueError("Bad HMAC (file is corrupted).")
+
+
+class ChunkedDecryptingReader(_SeekableDecryptingReader):
+    """
+    分块容器格式的解密读取器。
+
+    块的位置可由块号直接计算，读取任意偏移只需解密覆盖该区间的块；
+    decrypt_chunk 使用 os.pread，不依赖共享的文件位置，可在多个线程中并行调用。
+    每块都经过 GCM 认证，校验失败时抛出 ValueError。
+    offset/length 指定容器在文件中的位置，用于读取打包文件中的单个媒体。
+    """
+
+    def __init__(
+        self,
+        file_path: str,
+        password: str = FILE_PASSWORD,
+        buffer_size: int = BUFFER_SIZE,
+        offset: int = 0,
+        length: int = None,
+    ):
+        super().__init__(file_path, buffer_size)
+        self._base = offset
+        try:
+            if length is None:
+                length = stat(file_path).st_size - offset
+            self._file.seek(offset)
+            self._read_header(password, length)
+        except BaseException:
+            self._file.close()
+            raise
+
+    def _read_header(self, password: str, file_size: int):
+        self._header = self._read_exact(_CONTAINER_HEADER.size)
+        magic, version, chunk_size, file_salt = _CONTAINER_HEADER.unpack(self._header)
+        if magic != CONTAINER_MAGIC:
+            raise ValueError("File is corrupted or not a media container file.")
+        if version != CONTAINER_VERSION or chunk_size <= 0:
+            raise ValueError(f"Unsupported media container version {version}.")
+        self.chunk_size = chunk_size
+        self._aead = _file_cipher(password, file_salt)
+
+        stored_chunk = chunk_size + _GCM_TAG_SIZE
+        body = file_size - _CONTAINER_HEADER.size
+        self.chunk_count = -(-body // stored_chunk)
+        last_size = body - (self.chunk_count - 1) * stored_chunk - _GCM_TAG_SIZE
+        if self.chunk_count == 0 or last_size < 0:
+            raise ValueError("File is corrupted.")
+        self.size = (self.chunk_count - 1) * chunk_size + last_size
+
+    def chunk_indices(self, size: int = -1) -> List[int]:
+        """从当前位置读取 size 字节需要解密的块号。"""
+        size = self._clamp(size)
+        if size == 0:
+            return []
+        return list(range(self._pos // self.chunk_size, (self._pos + size - 1) // self.chunk_size + 1))
+
+    def decrypt_chunk(self, index: int) -> bytes:
+        stored_chunk = self.chunk_size + _GCM_TAG_SIZE
+        final = index == self.chunk_count - 1
+        offset = self._base + _CONTAINER_HEADER.size + index * stored_chunk
+        length = self.size - index * self.chunk_size + _GCM_TAG_SIZE if final else stored_chunk
+        ciphertext = os.pread(self._file.fileno(), length, offset)
+        if len(ciphertext) != length:
+            raise ValueError("File is corrupted.")
+        aad = self._header + (b"\x01" if final else b"\x00")
+        try:
+            return self._aead.decrypt(_chunk_nonce(index), ciphertext, aad)
+        except InvalidTag:
+            raise ValueError(f"Chunk {index} failed authentication (wrong password or file is corrupted).")
+
+    def take(self, first_index: int, chunks: List[bytes], size: int = -1) -> bytes:
+        """从 first_index 开始的已解密块中截取当前位置起的 size 字节，并前移位置。"""
+        size = self._clamp(size)
+        start = self._pos - first_index * self.chunk_size
+        data = b"".join(chunks)[start:start + size]
+        self._pos += len(data)
+        return data
+
+    def _read_at(self, pos: int, size: int) -> bytes:
+        first = pos // self.chunk_size
+        last = (pos + size - 1) // self.chunk_size
+        data = b"".join(self.decrypt_chunk(i) for i in range(first, last + 1))
+        start = pos - first * self.chunk_size
+        return data[start:start + size]
+
+
+def is_legacy_format(file_path: str) -> bool:
+    """文件是否为旧的 AES Crypt 格式（pyAesCrypt 写出）。"""
+    with open(file_path, "rb") as f:
+        return f.read(3) == b"AES"
+
+
+def open_decrypting_reader(
+    file_path: str, password: str = FILE_PASSWORD, offset: int = 0, length: int = None
+) -> _SeekableDecryptingReader:
+    """按文件头自动选择读取器，旧格式文件对调用者透明；指定 length 时读取文件中的一段容器。"""
+    if length is not None:
+        return ChunkedDecryptingReader(file_path, password, offset=offset, length=length)
+    if is_legacy_format(file_path):
+        return DecryptingReader(file_path, password)
+    return ChunkedDecryptingReader(file_path, password)
+
+
+def convert_legacy_file(file_path: str, password: str = FILE_PASSWORD) -> bool:
+    """
+    把旧格式文件就地转换为分块容器格式（写入临时文件后原子替换）。
+    文件已是新格式时返回 False；旧文件 HMAC 校验失败时抛出 ValueError 且保留原文件。
+    """
+    if not is_legacy_format(file_path):
+        return False
+    with DecryptingReader(file_path, password) as reader:
+        writer = ChunkedEncryptingWriter(file_path, password)
+        try:
+            while chunk := reader.read(BUFFER_SIZE):
+                writer.write(chunk)
+        except BaseException:
+            writer.abort()
+            raise
+        if not os.path.exists(file_path):
+            # 转换期间原文件已被清理，不要重新创建它
+            writer.abort()
+            return False
+        writer.commit()
+    return True
+
+
 @contextmanager
 def encrypted(file_path, password=FILE_PASSWORD):
-    tmp_file = io.BytesIO()
+    """产生一个 ChunkedEncryptingWriter；正常退出时提交，异常退出时删除未完成的文件。"""
+    writer = ChunkedEncryptingWriter(file_path, password)
     try:
-        yield tmp_file
-    finally:
-        tmp_file.seek(0)
-        with open(file_path, "wb") as f_out:
-            pyAesCrypt.encryptStream(tmp_file, f_out, password, bufferSize=BUFFER_SIZE)
-        tmp_file.close()
+        yield writer
+    except BaseException:
+        writer.abort()
+        raise
+    writer.commit()
 
 
 @contextmanager
 def decrypted(file_path, password=FILE_PASSWORD):
-    tmp_file = io.BytesIO()
+    """产生一个流式解密的只读文件对象（支持新旧两种格式），退出时关闭。"""
+    reader = open_decrypting_reader(file_path, password)
+    try:
+        yield reader
+    finally:
+        reader.close()
+
+
+class AsyncEncryptingWriter:
+    """加密写入器的异步包装，每次写入的加密在 CryptoExecutor 中执行。"""
+
+    def __init__(self, writer: _AtomicEncryptingWriter, executor: CryptoExecutor):
+        self._writer = writer
+        self._executor = executor
+        self.name = writer.name
+
+    @property
+    def bytes_written(self) -> int:
+        return self._writer.bytes_written
+
+    @property
+    def content_hash(self) -> str:
+        return self._writer.content_hash
+
+    async def write(self, data) -> int:
+        return await self._executor.run("encrypt", self._writer.write, data)
+
+
+@asynccontextmanager
+async def encrypted_async(file_path, password=FILE_PASSWORD, executor: CryptoExecutor = None):
+    """encrypted() 的异步版本：密钥派生、加密和落盘都不占用事件循环线程。"""
+    executor = executor or crypto_executor
+    writer = await executor.run("derive_key", ChunkedEncryptingWriter, file_path, password)
+    try:
+        yield AsyncEncryptingWriter(writer, executor)
+    except BaseException:
+        writer.abort()
+        raise
+    await executor.run("finalize", writer.commit)
+
+
+class AsyncDecryptingReader:
+    """
+    解密读取器的异步包装。read 返回协程并在 CryptoExecutor 中解密，
+    Telethon 上传时会 await 它；分块容器格式的多个块会并行解密。
+    seek/tell 等不涉及解密的操作仍为同步调用。
+    """
+
+    def __init__(self, reader: _SeekableDecryptingReader, executor: CryptoExecutor):
+        self._reader = reader
+        self._executor = executor
+        self.name = reader.name
+        self.size = reader.size
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._reader.tell()
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        return self._reader.seek(offset, whence)
+
+    async def read(self, size: int = -1) -> bytes:
+        reader = self._reader
+        if isinstance(reader, ChunkedDecryptingReader):
+            indices = reader.chunk_indices(size)
+            if len(indices) > 1:
+                chunks = await asyncio.gather(
+                    *(self._executor.run("decrypt", reader.decrypt_chunk, i) for i in indices)
+                )
+                return reader.take(indices[0], chunks, size)
+        return await self._executor.run("decrypt", reader.read, size)
+
+    @property
+    def closed(self) -> bool:
+        return self._reader.closed
+
+    def close(self):
+        self._reader.close()
+
+
+@asynccontextmanager
+async def decrypted_async(
+    file_path, password=FILE_PASSWORD, executor: CryptoExecutor = None, offset: int = 0, length: int = None
+):
+    """decrypted() 的异步版本，产生 AsyncDecryptingReader，退出时关闭。offset/length 见 ChunkedDecryptingReader。"""
+    executor = executor or crypto_executor
+    reader = await executor.run("derive_key", open_decrypting_reader, file_path, password, offset, length)
     try:
-        with open(file_path, "rb") as f_in:
-            pyAesCrypt.decryptStream(
-                f_in,
-                tmp_file,
-                password,
-                bufferSize=BUFFER_SIZE,
-                inputLength=stat(file_path).st_size,
-            )
-        tmp_file.seek(0)
-        yield tmp_file
+        yield AsyncDecryptingReader(reader, executor)
     finally:
-        tmp_file.close()
+        reader.close()
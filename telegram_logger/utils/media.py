@@ -1,9 +1,10 @@
+import asyncio
+import hashlib
 import logging
 import os
-from contextlib import contextmanager
-import logging
-import os
-from contextlib import contextmanager
+import secrets
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict, Optional
 from telethon.tl.types import (
     DocumentAttributeFilename,
     MessageMediaPhoto,
@@ -13,7 +14,10 @@ from telethon.tl.types import (
     Document, # 导入 Document
     MessageMediaDocument # 导入 MessageMediaDocument
 )
-from .file_encrypt import encrypted, decrypted
+from .crypto_executor import crypto_executor
+from .file_encrypt import decrypted, decrypted_async, encrypt_container, encrypted_async
+from .media_pack import MEDIA_PACK_MAX_ENTRY_SIZE, media_pack_store
+from .parallel_download import PARALLEL_DOWNLOAD_MIN_SIZE, parallel_downloader
 # import os # os 已在上面导入
 from dotenv import load_dotenv
 
@@ -23,55 +27,155 @@ FILE_PASSWORD = os.getenv("FILE_PASSWORD", "default-weak-password")  # 统一使
 
 logger = logging.getLogger(__name__)
 
-async def save_media_as_file(client, msg) -> str:
+# 去重媒体文件目录；未启用去重（未传入 db）时仍按消息保存到 media/{msg_id}_{chat_id}
+MEDIA_BLOB_DIR = "media/blobs"
+
+# 正在下载的媒体（media_key -> Future[路径]），同一媒体并发出现时只下载一次
+_inflight_downloads: Dict[str, "asyncio.Future[Optional[str]]"] = {}
+
+
+def _media_key(media) -> Optional[str]:
+    """Telegram 媒体的全局唯一标识（Document.id / Photo.id），无标识的媒体返回 None。"""
+    doc = getattr(media, 'document', None)
+    if isinstance(doc, Document):
+        return f"doc:{doc.id}"
+    photo = getattr(media, 'photo', None)
+    if isinstance(photo, Photo):
+        return f"photo:{photo.id}"
+    return None
+
+
+async def save_media_as_file(client, msg, db=None) -> str:
     """Save media from a message to an encrypted file
-    
+
+    传入 db 时启用去重：先按 Telegram 媒体标识查找已保存的文件（命中则不下载），
+    下载后再按内容哈希合并相同内容的文件。小媒体追加到打包文件中保存，
+    返回的路径是逻辑路径，读取时由 retrieve_restricted_media 通过 db 定位。
+
     Args:
         client: Telegram client
         msg: Message object containing media
-        
+        db: Optional DatabaseManager used for media deduplication
+
     Returns:
         str: Path to the saved file
-        
+
     Raises:
-        Exception: If file is too large or media cannot be saved
+        Exception: If media cannot be saved
     """
     msg_id = msg.id
     chat_id = msg.chat_id
 
     logger.info(f"开始保存媒体文件 - 消息ID: {msg_id}, 聊天ID: {chat_id}")
 
-    if msg.media:
-        # 记录媒体类型
-        logger.info(f"媒体类型: {type(msg.media).__name__}")
-
-        if msg.file:
-            logger.info(f"文件大小: {msg.file.size} bytes")
-
-        if msg.file and msg.file.size > MAX_IN_MEMORY_FILE_SIZE:
-            logger.warning(
-                f"文件太大无法保存 ({msg.file.size} bytes), 最大限制: {MAX_IN_MEMORY_FILE_SIZE} bytes"
-            )
-            raise Exception(f"File too large to save ({msg.file.size} bytes)")
-
-        file_path = f"media/{msg_id}_{chat_id}"
-        logger.info(f"保存文件路径: {file_path}")
-
-        try:
-            # 确保media目录存在
-            os.makedirs("media", exist_ok=True)
-            
-            with encrypted(file_path, FILE_PASSWORD) as f:
-                await client.download_media(msg.media, f)
-            logger.info("媒体文件保存成功")
-            return file_path
-        except Exception as e:
-            logger.error(f"保存媒体文件失败: {str(e)}")
-            raise
-    else:
+    if not msg.media:
         logger.info("消息不包含媒体内容")
         return None
 
+    # 记录媒体类型
+    logger.info(f"媒体类型: {type(msg.media).__name__}")
+
+    if msg.file:
+        logger.info(f"文件大小: {msg.file.size} bytes")
+
+    if db is None:
+        return await _download_media_file(client, msg, f"media/{msg_id}_{chat_id}")
+
+    media_key = _media_key(msg.media)
+    if media_key:
+        while True:
+            path = await db.acquire_media_blob(media_key)
+            if path:
+                logger.info(f"媒体已保存过 ({media_key})，复用文件: {path}")
+                return path
+            inflight = _inflight_downloads.get(media_key)
+            if inflight is None:
+                break
+            # 同一媒体正在被其他消息下载，等待其完成；失败时自行下载
+            if await asyncio.shield(inflight):
+                continue
+            if media_key not in _inflight_downloads:
+                break
+
+    future = asyncio.get_running_loop().create_future()
+    if media_key:
+        _inflight_downloads[media_key] = future
+    path = None
+    try:
+        name = media_key.replace(":", "_") if media_key else f"{msg_id}_{chat_id}_{secrets.token_hex(4)}"
+        file_path = f"{MEDIA_BLOB_DIR}/{name}"
+        if _is_packable(msg):
+            content_hash, size, location = await _download_media_packed(client, msg)
+            # 内容与已有媒体相同时，刚追加的记录成为失效空间，由打包文件压缩回收
+            path = await db.register_media_blob(file_path, content_hash, size, media_key, pack_location=location)
+            return path
+        content_hash, size = await _download_media_file(client, msg, file_path, with_hash=True)
+        path = await db.register_media_blob(file_path, content_hash, size, media_key)
+        if path != file_path:
+            # 内容与已有文件相同（例如重新上传的同一文件），删除刚下载的副本
+            logger.info(f"媒体内容与已有文件 {path} 相同，删除重复副本")
+            await asyncio.to_thread(os.remove, file_path)
+        return path
+    finally:
+        future.set_result(path)
+        if media_key:
+            _inflight_downloads.pop(media_key, None)
+
+
+def _is_packable(msg) -> bool:
+    """已知大小且不超过打包阈值的媒体保存到打包文件中。"""
+    if media_pack_store is None or not msg.file or not msg.file.size:
+        return False
+    return msg.file.size <= MEDIA_PACK_MAX_ENTRY_SIZE
+
+
+def _encrypt_for_pack(data: bytes):
+    return hashlib.sha256(data).hexdigest(), encrypt_container(data, FILE_PASSWORD)
+
+
+async def _download_media_packed(client, msg):
+    """下载小媒体到内存，加密后追加到打包文件。返回 (明文 SHA-256, 大小, (打包文件, 偏移, 长度))。"""
+    data = await client.download_media(msg.media, file=bytes) or b""
+    content_hash, container = await crypto_executor.run("encrypt", _encrypt_for_pack, data)
+    pack_path, offset = await asyncio.to_thread(media_pack_store.append, container)
+    logger.info(f"媒体已追加到打包文件 {pack_path} (offset={offset}, {len(container)} bytes)")
+    return content_hash, len(data), (pack_path, offset, len(container))
+
+
+async def _download_media_file(client, msg, file_path: str, with_hash: bool = False):
+    """下载媒体并流式加密写入 file_path。with_hash 时返回 (明文 SHA-256, 大小)，否则返回路径。"""
+    logger.info(f"保存文件路径: {file_path}")
+    try:
+        # 确保目标目录存在
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+        # 边下载边加密写入 <file_path>.part，完成后原子重命名，内存占用与文件大小无关；
+        # 密钥派生和加密在 crypto_executor 线程池中执行，不阻塞事件循环
+        async with encrypted_async(file_path, FILE_PASSWORD) as f:
+            if isinstance(msg.media, MessageMediaDocument):
+                size = getattr(msg.media.document, 'size', None) or 0
+                if size >= PARALLEL_DOWNLOAD_MIN_SIZE:
+                    # 大文件分段并行下载，按顺序写入加密流
+                    logger.info(f"分段并行下载大文件 ({size} bytes)")
+                    chunks = parallel_downloader.iter_download(client, msg.media, size)
+                else:
+                    chunks = client.iter_download(msg.media)
+                async for chunk in chunks:
+                    await f.write(chunk)
+            else:
+                # 照片、联系人等由 download_media 选择合适的尺寸/格式。
+                # 其部分路径同步调用 write，因此先取回字节（这类媒体体积有限）再整体加密
+                data = await client.download_media(msg.media, file=bytes)
+                if data:
+                    await f.write(data)
+        logger.info("媒体文件保存成功")
+    except Exception as e:
+        logger.error(f"保存媒体文件失败: {str(e)}")
+        raise
+    if with_hash:
+        return f.content_hash, f.bytes_written
+    return file_path
+
 
 @contextmanager
 def retrieve_media_as_file(file_path: str, is_restricted: bool = False):
@@ -137,6 +241,33 @@ def retrieve_media_as_file(file_path: str, is_restricted: bool = False):
                  logger.error(f"Error closing non-restricted file handle {file_path}: {e_close}")
 
 
+@asynccontextmanager
+async def retrieve_restricted_media(file_path: str, db=None):
+    """
+    retrieve_media_as_file(is_restricted=True) 的异步版本。
+    产生一个流式解密的文件对象，密钥派生和分块解密在 crypto_executor 中执行，
+    可直接作为 file 参数传给 Telethon 上传。
+    file_path 不是实际文件时，通过 db 查找它在打包文件中的位置。
+    """
+    if os.path.exists(file_path):
+        logger.info(f"流式解密受限媒体文件: {file_path}")
+        async with decrypted_async(file_path, FILE_PASSWORD) as file_handle:
+            yield file_handle
+        return
+
+    location = await db.get_media_pack_location(file_path) if db is not None else None
+    if location and not os.path.exists(location[0]):
+        # 打包文件刚被压缩移除，记录已指向新位置
+        location = await db.get_media_pack_location(file_path)
+    if not location:
+        raise FileNotFoundError(f"Media file not found at path: {file_path}")
+    pack_path, offset, length = location
+    logger.info(f"流式解密打包媒体: {file_path} ({pack_path} offset={offset})")
+    async with decrypted_async(pack_path, FILE_PASSWORD, offset=offset, length=length) as file_handle:
+        file_handle.name = os.path.basename(file_path)
+        yield file_handle
+
+
 def _get_filename(media) -> str:
     """Get filename from media object"""
     filename = None
@@ -0,0 +1,119 @@
+import logging
+import os
+import re
+import threading
+from typing import List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+# 不超过该大小（明文字节）的媒体追加到打包文件中，0 表示禁用打包存储
+MEDIA_PACK_MAX_ENTRY_SIZE = int(os.getenv("MEDIA_PACK_MAX_ENTRY_SIZE", str(512 * 1024)))
+# 单个打包文件的目标大小，超过后换用新文件
+MEDIA_PACK_MAX_SIZE = int(os.getenv("MEDIA_PACK_MAX_SIZE", str(64 * 1024 * 1024)))
+# 打包文件中已失效的字节占比达到该值时压缩
+MEDIA_PACK_COMPACT_RATIO = float(os.getenv("MEDIA_PACK_COMPACT_RATIO", "0.5"))
+
+MEDIA_PACK_DIR = "media/packs"
+PACK_SUFFIX = ".pack"
+_PACK_NAME = re.compile(r"(\d+)\.pack")
+
+logger = logging.getLogger(__name__)
+
+
+class MediaPackStore:
+    """
+    小媒体的追加写打包存储。
+
+    加密后的小媒体（完整的分块容器）依次追加到当前打包文件末尾，
+    每条记录的位置（打包文件、偏移、长度）保存在数据库 media_blobs 表中，
+    数千个小文件只占用一个 inode，写入也只需对一个文件 fsync。
+    已写入的字节不会被修改；打包文件超过 max_pack_size 后换用编号更大的新文件，
+    旧文件中过期记录占用的空间由 CleanupService 压缩回收。
+    """
+
+    def __init__(self, directory: str = MEDIA_PACK_DIR, max_pack_size: int = MEDIA_PACK_MAX_SIZE):
+        self.directory = directory
+        self.max_pack_size = max(1, max_pack_size)
+        self._lock = threading.Lock()
+        self._file = None
+        # 启动时即确定当前写入的打包文件（未写满的最新文件），压缩不会处理它
+        numbers = self._pack_numbers()
+        last = max(numbers, default=0)
+        if last and os.path.getsize(self._pack_path(last)) < self.max_pack_size:
+            self._active_number = last
+        else:
+            self._active_number = last + 1
+
+    @property
+    def active_path(self) -> str:
+        return self._pack_path(self._active_number)
+
+    def _pack_path(self, number: int) -> str:
+        return os.path.join(self.directory, f"{number:06d}{PACK_SUFFIX}")
+
+    def _pack_numbers(self) -> List[int]:
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(int(m.group(1)) for m in map(_PACK_NAME.fullmatch, names) if m)
+
+    def sealed_packs(self) -> List[str]:
+        """已写满、不再追加的打包文件，只有这些文件可以被压缩。"""
+        with self._lock:
+            active = self._active_number
+        return [self._pack_path(n) for n in self._pack_numbers() if n < active]
+
+    def append(self, data: bytes) -> Tuple[str, int]:
+        """追加一条记录并落盘，返回 (打包文件路径, 偏移)。"""
+        with self._lock:
+            if self._file is None:
+                os.makedirs(self.directory, exist_ok=True)
+                self._file = open(self.active_path, "ab")
+            offset = os.fstat(self._file.fileno()).st_size
+            if offset and offset + len(data) > self.max_pack_size:
+                self._file.close()
+                self._active_number += 1
+                self._file = open(self.active_path, "ab")
+                offset = 0
+                logger.info(f"开始写入新的媒体打包文件: {self.active_path}")
+            try:
+                self._file.write(data)
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            except BaseException:
+                # 写入失败的残留字节视为失效空间，下次从文件末尾继续追加
+                self._file.close()
+                self._file = None
+                raise
+            return self.active_path, offset
+
+    @staticmethod
+    def read(pack_path: str, offset: int, length: int) -> bytes:
+        with open(pack_path, "rb") as f:
+            data = os.pread(f.fileno(), length, offset)
+        if len(data) != length:
+            raise ValueError(f"打包文件 {pack_path} 已损坏: offset={offset} length={length}")
+        return data
+
+    def remove(self, pack_path: str) -> bool:
+        """删除不再被引用的打包文件；当前写入的文件不会被删除。"""
+        with self._lock:
+            if os.path.abspath(pack_path) == os.path.abspath(self.active_path):
+                return False
+        try:
+            os.remove(pack_path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+# 进程内共享的默认实例
+media_pack_store: Optional[MediaPackStore] = MediaPackStore() if MEDIA_PACK_MAX_ENTRY_SIZE > 0 else None
@@ -1,96 +1,186 @@
+import asyncio
 import logging
-from typing import Union # <- 添加这行
+from typing import Dict, Iterable, List, Optional
 from telethon.tl.types import User, Channel, Chat
+from telethon.utils import get_peer_id, resolve_id
+
+from telegram_logger.data.entity_cache import EntityCache
+from telegram_logger.data.models import EntityInfo
 
 logger = logging.getLogger(__name__)
 
 
-async def create_mention(client, entity_id: int, msg_id: int = None) -> str:
-    """生成Telegram实体提及链接"""
-    logger.debug(f"尝试为 ID {entity_id} 创建提及 (消息 ID: {msg_id})")
-    
-    # 特殊处理 entity_id 为 0 的情况 (通常代表自己)
-    if entity_id == 0:
-        try:
-            me = await client.get_me()
+def entity_info(entity) -> Optional[EntityInfo]:
+    """从 Telethon 实体提取提及所需的信息，不支持的实体返回 None。"""
+    if isinstance(entity, User):
+        # 优先使用 "lastname firstname" 格式
+        name = " ".join(part for part in (entity.last_name, entity.first_name) if part) or f"用户 {entity.id}"
+        return EntityInfo(get_peer_id(entity), 'bot' if entity.bot else 'user', name, entity.username)
+    if isinstance(entity, (Channel, Chat)):
+        title = getattr(entity, 'title', None) or f'未知频道/群组 {entity.id}'
+        kind = 'channel' if getattr(entity, 'broadcast', False) else 'group'
+        return EntityInfo(get_peer_id(entity), kind, title, getattr(entity, 'username', None))
+    return None
+
+
+def remember_entities(entity_cache: Optional[EntityCache], *entities):
+    """用事件自带的实体刷新缓存（不调用 API）。"""
+    if entity_cache is None:
+        return
+    for entity in entities:
+        info = entity_info(entity) if entity is not None else None
+        if info:
+            entity_cache.put(info)
+
+
+class EntityResolver:
+    """
+    批量解析实体信息。
+
+    收集一次渲染或指令需要的全部 ID，去重后先查本地缓存，其余的用一次列表形式的
+    client.get_entity 获取（Telethon 按用户/群组/频道各合并为一个请求）；
+    列表中有无法解析的 ID 时整个调用失败，此时逐个重试以隔离错误。
+    获取失败的 ID 回退到已过期的缓存信息，仍无结果时不出现在返回值中。
+    ID 0 表示当前账号。
+    """
+
+    def __init__(self, client, entity_cache: Optional[EntityCache] = None):
+        self.client = client
+        self.entity_cache = entity_cache
+
+    async def resolve(self, entity_ids: Iterable[int]) -> Dict[int, EntityInfo]:
+        ids = [i for i in dict.fromkeys(entity_ids) if i is not None]
+        resolved: Dict[int, EntityInfo] = {}
+        cache = self.entity_cache
+
+        if 0 in ids:
+            me = await self._resolve_self()
             if me:
-                logger.debug("entity_id 为 0，使用 client.get_me() 获取自身信息。")
-                # 复用现有的用户提及格式化逻辑
-                return _format_user_mention(me, msg_id)
-            else:
-                # get_me() 意外返回 None
-                logger.warning("client.get_me() 返回 None，无法格式化 ID 为 0 的提及。")
-                return "自己 (ID: 0)" # 提供一个明确的回退
+                resolved[0] = me
+            ids.remove(0)
+
+        if cache is not None and ids:
+            cached = await asyncio.gather(*(cache.lookup(i) for i in ids))
+            for entity_id, info in zip(ids, cached):
+                if info:
+                    resolved[entity_id] = info
+            ids = [i for i in ids if i not in resolved]
+
+        if ids:
+            for entity_id, info in (await self._fetch(ids)).items():
+                resolved[entity_id] = info
+                if cache is not None:
+                    cache.put(info)
+
+        if cache is not None:
+            # 获取失败（例如 FloodWait）时使用已过期的缓存信息
+            for entity_id in ids:
+                if entity_id not in resolved:
+                    stale = cache.get(entity_id, allow_stale=True)
+                    if stale:
+                        resolved[entity_id] = stale
+        return resolved
+
+    async def _resolve_self(self) -> Optional[EntityInfo]:
+        cache = self.entity_cache
+        if cache is not None and cache.self_id is not None:
+            info = await cache.lookup(cache.self_id)
+            if info:
+                return info
+        try:
+            me = await self.client.get_me()
         except Exception as me_err:
             logger.error(f"尝试使用 client.get_me() 获取自身信息时出错: {me_err}", exc_info=True)
-            return "自己 (获取信息出错)" # 错误时的回退
-
-    try:
-        entity = await client.get_entity(entity_id)
-        logger.debug(f"成功获取实体: 类型={type(entity).__name__}, ID={entity.id}")
-
-        if isinstance(entity, (Channel, Chat)):
-            mention = _format_channel_mention(entity, msg_id)
-            logger.debug(f"格式化为频道/群组提及: {mention}")
-            return mention
-        elif isinstance(entity, User):
-            mention = _format_user_mention(entity, msg_id) # msg_id 可能对用户提及无用，但保持一致性
-            logger.debug(f"格式化为用户提及: {mention}")
-            return mention
-        else:
-            logger.warning(f"获取到未知实体类型 {type(entity).__name__}，ID: {entity_id}")
-            return str(entity_id) # 返回原始 ID 作为回退
-
-    except ValueError as e:
-        # Telethon 在找不到实体时可能抛出 ValueError
-        logger.error(f"无法找到 ID 为 {entity_id} 的实体: {e}", exc_info=True)
-        return str(entity_id) # 返回原始 ID
-    except Exception as e:
-        logger.error(f"为 ID {entity_id} 创建提及失败: {e}", exc_info=True)
-        return str(entity_id) # 返回原始 ID
-
-
-def _format_channel_mention(entity: Union[Channel, Chat], msg_id: int) -> str:
+            return cache.get(cache.self_id, allow_stale=True) if cache is not None and cache.self_id else None
+        if not me:
+            # get_me() 意外返回 None
+            logger.warning("client.get_me() 返回 None，无法格式化 ID 为 0 的提及。")
+            return None
+        logger.debug("entity_id 为 0，使用 client.get_me() 获取自身信息。")
+        info = entity_info(me)
+        if cache is not None:
+            cache.put(info)
+            cache.self_id = info.id
+        return info
+
+    async def _fetch(self, ids: List[int]) -> Dict[int, EntityInfo]:
+        try:
+            entities = list(zip(ids, await self.client.get_entity(ids)))
+            logger.debug(f"批量获取 {len(ids)} 个实体")
+        except Exception as e:
+            if len(ids) > 1:
+                logger.warning(f"批量获取实体失败，逐个重试: {e}")
+            entities = []
+            for entity_id in ids:
+                try:
+                    entities.append((entity_id, await self.client.get_entity(entity_id)))
+                except ValueError as e:
+                    # Telethon 在找不到实体时可能抛出 ValueError
+                    logger.error(f"无法找到 ID 为 {entity_id} 的实体: {e}")
+                except Exception as e:
+                    logger.error(f"获取 ID 为 {entity_id} 的实体失败: {e}", exc_info=True)
+
+        fetched = {}
+        for entity_id, entity in entities:
+            info = entity_info(entity)
+            if info is None:
+                logger.warning(f"获取到未知实体类型 {type(entity).__name__}，ID: {entity_id}")
+                continue
+            fetched[entity_id] = info
+        return fetched
+
+
+def render_mention(resolved: Dict[int, EntityInfo], entity_id: int, msg_id: int = None) -> str:
+    """用 EntityResolver.resolve 的结果生成提及，未解析的 ID 回退为原始 ID。"""
+    info = resolved.get(entity_id)
+    if info is None:
+        return "自己 (获取信息出错)" if entity_id == 0 else str(entity_id)
+    mention = _format_mention(info, msg_id)
+    logger.debug(f"格式化为{'用户' if info.is_user else '频道/群组'}提及: {mention}")
+    return mention
+
+
+async def create_mention(client, entity_id: int, msg_id: int = None, entity_cache: Optional[EntityCache] = None) -> str:
+    """生成Telegram实体提及链接
+
+    传入 entity_cache 时先查缓存，命中则不调用 Telegram API。
+    需要多个提及时使用 EntityResolver 一次解析。
+    """
+    logger.debug(f"尝试为 ID {entity_id} 创建提及 (消息 ID: {msg_id})")
+    resolved = await EntityResolver(client, entity_cache).resolve([entity_id])
+    return render_mention(resolved, entity_id, msg_id)
+
+
+def _format_mention(info: EntityInfo, msg_id: int) -> str:
+    if info.is_user:
+        return _format_user_mention(info)
+    return _format_channel_mention(info, msg_id)
+
+
+def _format_channel_mention(info: EntityInfo, msg_id: int) -> str:
     """格式化频道/群组提及为 MarkdownV2 格式"""
-    # 确保 entity.id 是整数，然后转换为字符串
-    entity_id_str = str(entity.id)
-    # 移除 Telegram 内部使用的 -100 前缀
-    chat_id_for_link = entity_id_str.replace("-100", "")
-    title = getattr(entity, 'title', f'未知频道/群组 {entity.id}') # 添加回退标题
-    mention = f"[{title}](t.me/c/{chat_id_for_link}/{msg_id or 1})"
-    logger.debug(f"格式化频道/群组提及: ID={entity.id}, Title='{title}', MsgID={msg_id}, Mention='{mention}'")
+    # 链接中使用不带 -100 前缀的频道 ID
+    chat_id_for_link, _ = resolve_id(info.id)
+    mention = f"[{info.name}](t.me/c/{chat_id_for_link}/{msg_id or 1})"
+    logger.debug(f"格式化频道/群组提及: ID={info.id}, Title='{info.name}', MsgID={msg_id}, Mention='{mention}'")
     return mention
 
 
-def _format_user_mention(entity: User, msg_id: int) -> str:
+def _format_user_mention(info: EntityInfo) -> str:
     """
     格式化用户提及为 MarkdownV2 格式。
-    优先使用 lastname firstname 的格式显示用户全名。
+    显示名称已按 lastname firstname 的格式保存在 info.name 中。
     """
-    # 获取 first_name 和 last_name，处理 None 的情况
-    first = entity.first_name or ""
-    last = entity.last_name or ""
-
-    # 构建显示名称，优先使用 "lastname firstname" 格式
-    if last and first:
-        display_name = f"{last} {first}"
-    elif last: # 只有 last name
-        display_name = last
-    elif first: # 只有 first name
-        display_name = first
-    else: # 都没有，使用 ID 作为回退
-        display_name = f"用户 {entity.id}"
-
     # 清理 display_name 中的 Markdown 特殊字符，例如 [ ] ( ) ~ ` > # + - = | { } . !
     # 仅转义必要的字符以避免破坏链接
-    safe_display_name = display_name.replace('[', '\\[').replace(']', '\\]')
+    safe_display_name = info.name.replace('[', '\\[').replace(']', '\\]')
 
     # 优先使用用户名链接，其次是 ID 链接
-    if entity.username:
-        mention = f"[{safe_display_name}](@{entity.username})"
-        logger.debug(f"格式化用户提及 (使用用户名): ID={entity.id}, Username='{entity.username}', Display='{safe_display_name}', Mention='{mention}'")
+    if info.username:
+        mention = f"[{safe_display_name}](@{info.username})"
+        logger.debug(f"格式化用户提及 (使用用户名): ID={info.id}, Username='{info.username}', Display='{safe_display_name}', Mention='{mention}'")
     else:
-        mention = f"[{safe_display_name}](tg://user?id={entity.id})"
-        logger.debug(f"格式化用户提及 (使用 ID): ID={entity.id}, Display='{safe_display_name}', Mention='{mention}'")
+        mention = f"[{safe_display_name}](tg://user?id={info.id})"
+        logger.debug(f"格式化用户提及 (使用 ID): ID={info.id}, Display='{safe_display_name}', Mention='{mention}'")
 
     return mention
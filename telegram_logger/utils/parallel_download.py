@@ -0,0 +1,81 @@
+import asyncio
+import logging
+import os
+from collections import deque
+from typing import AsyncIterator, Deque
+
+from dotenv import load_dotenv
+
+load_dotenv()
+PARALLEL_DOWNLOAD_PER_FILE = int(os.getenv("PARALLEL_DOWNLOAD_PER_FILE", "4"))
+PARALLEL_DOWNLOAD_GLOBAL = int(os.getenv("PARALLEL_DOWNLOAD_GLOBAL", "8"))
+# 小于该大小的文件仍按单个顺序流下载（默认 10MB）
+PARALLEL_DOWNLOAD_MIN_SIZE = int(os.getenv("PARALLEL_DOWNLOAD_MIN_SIZE", str(10 * 1024 * 1024)))
+
+# Telegram upload.getFile 单次请求的最大字节数；偏移须为 4KB 的倍数
+REQUEST_SIZE = 512 * 1024
+# 每个并发任务负责的连续字节段，须为 REQUEST_SIZE 的整数倍
+SEGMENT_SIZE = 2 * REQUEST_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+class ParallelDownloader:
+    """
+    大文件的分段并行下载。
+
+    文件按 SEGMENT_SIZE 切分为连续字节段，每段通过 client.iter_download 的
+    offset/limit 单独下载；同一文件最多 per_file 段同时进行（滑动窗口），
+    所有文件合计最多 max_global 段同时进行。各段按顺序产出，
+    可直接写入加密写入器，内存中最多保留 per_file 段。
+    """
+
+    def __init__(self, per_file: int = PARALLEL_DOWNLOAD_PER_FILE, max_global: int = PARALLEL_DOWNLOAD_GLOBAL):
+        self.per_file = max(1, per_file)
+        self.max_global = max(1, max_global)
+        self._global = asyncio.Semaphore(self.max_global)
+
+    async def iter_download(self, client, media, file_size: int) -> AsyncIterator[bytes]:
+        """按顺序产出文件内容，每次一个字节段。"""
+        segments = iter(range(0, file_size, SEGMENT_SIZE))
+        window: Deque[asyncio.Task] = deque()
+
+        def schedule():
+            while len(window) < self.per_file:
+                offset = next(segments, None)
+                if offset is None:
+                    return
+                length = min(SEGMENT_SIZE, file_size - offset)
+                window.append(asyncio.create_task(self._fetch(client, media, offset, length, file_size)))
+
+        try:
+            schedule()
+            while window:
+                data = await window.popleft()
+                schedule()
+                yield data
+        finally:
+            for task in window:
+                task.cancel()
+            if window:
+                await asyncio.gather(*window, return_exceptions=True)
+
+    async def _fetch(self, client, media, offset: int, length: int, file_size: int) -> bytes:
+        async with self._global:
+            parts = []
+            async for chunk in client.iter_download(
+                media,
+                offset=offset,
+                limit=-(-length // REQUEST_SIZE),
+                request_size=REQUEST_SIZE,
+                file_size=file_size,
+            ):
+                parts.append(chunk)
+        data = b"".join(parts)[:length]
+        if len(data) != length:
+            raise IOError(f"分段下载不完整: offset={offset} 期望 {length} 字节，实际 {len(data)} 字节")
+        return data
+
+
+# 进程内共享的默认实例，全局并发上限在所有文件之间共享
+parallel_downloader = ParallelDownloader()
@@ -0,0 +1,701 @@
+import sqlite3
+from dataclasses import replace
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from telegram_logger.data.cache import HotMessageCache
+from telegram_logger.data.codec import TEXT_DELTA, TEXT_ZLIB, apply_delta, make_delta
+from telegram_logger.data.database import DatabaseManager
+from telegram_logger.data.migrations import LATEST_VERSION, run_migrations
+from telegram_logger.data.models import Message
+
+
+def _make_message(msg_id: int, chat_id: int = -1001, text: str = "hello", edited_time=None) -> Message:
+    return Message(
+        id=msg_id,
+        from_id=42,
+        chat_id=chat_id,
+        msg_type=DatabaseManager.MSG_TYPE_MAP['group'],
+        msg_text=text,
+        media_path=None,
+        noforwards=False,
+        self_destructing=False,
+        created_time=datetime(2024, 1, 1, 12, 0, msg_id % 60, tzinfo=timezone.utc),
+        edited_time=edited_time,
+    )
+
+
+@pytest.fixture
+def db(tmp_path):
+    manager = DatabaseManager(db_path=str(tmp_path / "messages.db"), ingest_flush_interval=0.05)
+    yield manager
+    manager.close()
+
+
+def test_save_message_is_batched_and_flushed(db):
+    """消息经写入队列批量落盘，重复消息被忽略"""
+    edit_time = datetime(2024, 1, 1, 13, 0, tzinfo=timezone.utc)
+    for i in range(1, 51):
+        db.save_message(_make_message(i))
+    db.save_message(_make_message(7, text="edited", edited_time=edit_time))
+    db.save_message(_make_message(7, text="edited", edited_time=edit_time))
+
+    assert db.flush_ingest_queue(timeout=5)
+    count = db.pool.read_sync(lambda conn: conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0])
+    assert count == 51
+    assert db.ingest_queue.ignored_count == 1
+
+
+def test_pending_message_is_readable_before_flush(tmp_path):
+    """写入队列中的消息在落盘前也能被读取"""
+    manager = DatabaseManager(db_path=str(tmp_path / "messages.db"), ingest_flush_interval=30)
+    try:
+        manager.save_message(_make_message(99, text="pending"))
+        found = manager.get_message_by_id(99)
+        assert found is not None and found.msg_text == "pending"
+    finally:
+        manager.close()
+    reopened = DatabaseManager(db_path=str(tmp_path / "messages.db"))
+    try:
+        assert reopened.get_message_by_id(99).msg_text == "pending"
+    finally:
+        reopened.close()
+
+
+@pytest.mark.asyncio
+async def test_async_methods_use_pooled_connections(db):
+    """异步方法复用连接池中的长连接，读写结果一致"""
+    assert await db.set_model_alias("fast", "gpt-4o-mini")
+    assert await db.get_model_id_by_alias("fast") == "gpt-4o-mini"
+    assert await db.get_user_bot_settings(1) == {}
+    mode = await db.pool.read(lambda conn: conn.execute("PRAGMA journal_mode").fetchone()[0])
+    assert mode.lower() == "wal"
+
+
+def test_get_message_is_chat_scoped_and_versioned(db):
+    """get_message 按 (chat_id, id) 查找，并区分原始版本与最新版本"""
+    first_edit = datetime(2024, 1, 1, 13, 0, tzinfo=timezone.utc)
+    second_edit = datetime(2024, 1, 1, 14, 0, tzinfo=timezone.utc)
+    db.save_message(_make_message(5, chat_id=-1001, text="chat A"))
+    db.save_message(_make_message(5, chat_id=-1002, text="chat B"))
+    db.save_message(_make_message(5, chat_id=-1001, text="edit 1", edited_time=first_edit))
+    db.save_message(_make_message(5, chat_id=-1001, text="edit 2", edited_time=second_edit))
+    assert db.flush_ingest_queue(timeout=5)
+
+    assert db.get_message(-1001, 5).msg_text == "chat A"
+    assert db.get_message(-1002, 5).msg_text == "chat B"
+    assert db.get_message(-1001, 5, version='latest').msg_text == "edit 2"
+    assert db.get_message(-1003, 5) is None
+    with pytest.raises(ValueError):
+        db.get_message(-1001, 5, version='newest')
+
+    plan = db.pool.read_sync(
+        lambda conn: " ".join(
+            row[3] for row in conn.execute(
+                "EXPLAIN QUERY PLAN SELECT * FROM messages WHERE chat_id = ? AND id = ? ORDER BY edited_time LIMIT 1",
+                (-1001, 5),
+            )
+        )
+    )
+    assert "USING INDEX" in plan and "SCAN messages" not in plan
+
+
+@pytest.mark.asyncio
+async def test_async_message_lookups_match_sync(db):
+    """异步单条查找与同步版本结果一致：热缓存、数据库和写入队列中的消息都能读到"""
+    edit_time = datetime(2024, 1, 1, 13, 0, tzinfo=timezone.utc)
+    db.save_message(_make_message(5, text="original"))
+    db.save_message(_make_message(5, text="edited", edited_time=edit_time))
+    assert db.flush_ingest_queue(timeout=5)
+    db.hot_cache.clear()
+
+    assert (await db.get_message_async(-1001, 5)).msg_text == "original"
+    assert (await db.get_message_async(-1001, 5, version='latest')).msg_text == "edited"
+    assert (await db.get_message_by_id_async(5)).msg_text == "original"
+    assert await db.get_message_async(-1002, 5) is None
+    assert await db.get_message_by_id_async(6) is None
+    with pytest.raises(ValueError):
+        await db.get_message_async(-1001, 5, version='newest')
+
+    db.save_message(_make_message(6, text="cached"))
+    assert (await db.get_message_async(-1001, 6)).msg_text == "cached"
+    assert (await db.get_message_by_id_async(6)).msg_text == "cached"
+
+
+@pytest.mark.asyncio
+async def test_get_messages_bulk_resolves_saved_and_pending(db):
+    db.save_message(_make_message(1))
+    db.save_message(_make_message(2, text="edited", edited_time=datetime(2024, 1, 2, tzinfo=timezone.utc)))
+    db.save_message(_make_message(2, text="original"))
+    db.save_message(_make_message(3, chat_id=-2002))
+    assert db.flush_ingest_queue()
+    db.save_message(_make_message(4, text="pending"))
+
+    found = await db.get_messages_bulk(-1001, [1, 2, 3, 4, 5, 2])
+    assert set(found) == {1, 2, 4}
+    assert found[2].msg_text == "original"
+    assert found[4].msg_text == "pending"
+
+    found_any_chat = await db.get_messages_bulk(None, [3, 5])
+    assert set(found_any_chat) == {3}
+    assert await db.get_messages_bulk(-1001, []) == {}
+
+
+@pytest.mark.asyncio
+async def test_delete_expired_messages_in_batches(db, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    media_dir = tmp_path / "media"
+    media_dir.mkdir()
+    old = datetime.now(timezone.utc) - timedelta(days=10)
+    for msg_id in range(1, 6):
+        media = media_dir / f"{msg_id}.bin"
+        media.write_bytes(b"x")
+        db.save_message(replace(
+            _make_message(msg_id), msg_type=1, created_time=old, media_path=str(media)
+        ))
+    db.save_message(replace(_make_message(10), msg_type=1, created_time=datetime.now(timezone.utc)))
+    db.save_message(replace(_make_message(11), msg_type=2, created_time=old))
+    assert db.flush_ingest_queue(timeout=5)
+
+    stats = await db.delete_expired_messages({"user": 1, "channel": 30}, batch_size=2, pause=0)
+
+    assert stats.deleted_rows == 5
+    assert stats.deleted_files == 5
+    assert stats.batches == 3
+    assert stats.rows_by_type == {"user": 5}
+    assert not any(media_dir.iterdir())
+    remaining = db.pool.read_sync(lambda conn: [r[0] for r in conn.execute("SELECT id FROM messages ORDER BY id")])
+    assert remaining == [10, 11]
+
+
+@pytest.mark.asyncio
+async def test_shared_media_blob_is_deleted_with_last_reference(db, tmp_path, monkeypatch):
+    """去重媒体文件被多条消息引用，只有最后一个引用过期后才删除"""
+    monkeypatch.chdir(tmp_path)
+    blob = tmp_path / "media" / "blobs" / "doc_1"
+    blob.parent.mkdir(parents=True)
+    blob.write_bytes(b"x")
+    path = await db.register_media_blob(str(blob), "hash-1", 1, "doc:1")
+    assert await db.register_media_blob(str(blob) + "_copy", "hash-1", 1, "doc:2") == path
+    assert await db.acquire_media_blob("doc:2") == path
+
+    now = datetime.now(timezone.utc)
+    db.save_message(replace(_make_message(1), msg_type=1, created_time=now - timedelta(days=10), media_path=path))
+    db.save_message(replace(_make_message(2), msg_type=2, created_time=now - timedelta(days=10), media_path=path))
+    assert db.flush_ingest_queue(timeout=5)
+    refcount = lambda: db.pool.read_sync(
+        lambda conn: conn.execute("SELECT refcount FROM media_blobs WHERE path = ?", (path,)).fetchone()
+    )
+    assert refcount()[0] == 2
+
+    monkeypatch.setattr(DatabaseManager, "MEDIA_BLOB_GRACE_SECONDS", 0)
+    await db.delete_expired_messages({"user": 1, "channel": 30}, pause=0)
+    assert blob.exists() and refcount()[0] == 1
+
+    # 最后一个引用过期，但 last_used 仍在宽限期内时保留文件
+    monkeypatch.setattr(DatabaseManager, "MEDIA_BLOB_GRACE_SECONDS", 3600)
+    await db.delete_expired_messages({"user": 1, "channel": 1}, pause=0)
+    assert blob.exists() and refcount()[0] == 0
+
+    monkeypatch.setattr(DatabaseManager, "MEDIA_BLOB_GRACE_SECONDS", -1)
+    stats = await db.delete_expired_messages({"user": 1, "channel": 1}, pause=0)
+    assert stats.deleted_files == 1
+    assert not blob.exists() and refcount() is None
+    assert await db.acquire_media_blob("doc:1") is None
+
+
+@pytest.mark.asyncio
+async def test_media_path_is_backfilled_after_insert(db, tmp_path):
+    """消息先写入，媒体下载完成后经写入队列回填 media_path 并计入引用"""
+    blob = tmp_path / "doc_5"
+    blob.write_bytes(b"x")
+    path = await db.register_media_blob(str(blob), "hash-5", 1, "doc:5")
+    message = _make_message(5)
+    db.save_message(message)
+    db.set_media_path(message, path)  # 消息可能仍在队列中
+
+    assert db.get_message(message.chat_id, 5).media_path == path
+    assert db.flush_ingest_queue(timeout=5)
+    db.hot_cache.clear()
+    assert db.get_message(message.chat_id, 5).media_path == path
+    assert db.ingest_queue.find_pending(5, message.chat_id) == []
+    refcount = db.pool.read_sync(lambda conn: conn.execute("SELECT refcount FROM media_blobs").fetchone()[0])
+    assert refcount == 1
+
+    # 重复回填不覆盖已有路径，也不重复计数
+    db.set_media_path(message, path)
+    assert db.flush_ingest_queue(timeout=5)
+    refcount = db.pool.read_sync(lambda conn: conn.execute("SELECT refcount FROM media_blobs").fetchone()[0])
+    assert refcount == 1
+
+
+@pytest.mark.asyncio
+async def test_packed_blob_location_and_compaction_moves(db, tmp_path):
+    """打包存储的媒体按逻辑路径定位；压缩只移动仍位于旧位置的记录"""
+    pack = tmp_path / "000001.pack"
+    pack.write_bytes(b"x" * 100)
+    path = await db.register_media_blob("media/blobs/doc_6", "hash-6", 10, "doc:6", pack_location=(str(pack), 40, 60))
+
+    assert path == "media/blobs/doc_6"
+    assert await db.acquire_media_blob("doc:6") == path  # 打包文件存在即视为有效
+    assert await db.get_media_pack_location(path) == (str(pack), 40, 60)
+    assert await db.get_media_pack_usage() == {str(pack): 60}
+
+    new_pack = str(tmp_path / "000002.pack")
+    assert not await db.move_packed_blob(path, (str(pack), 0), (new_pack, 0))
+    assert await db.move_packed_blob(path, (str(pack), 40), (new_pack, 0))
+    assert await db.get_packed_blobs(new_pack) == [(path, 0, 60)]
+    assert not await db.is_media_pack_referenced(str(pack))
+
+    # 引用归零后只删除记录，打包文件中的空间由压缩回收
+    unused = db.pool.write_sync(db._media_write(db._sync_collect_unused_blobs), 2**40)
+    assert unused == []
+    assert await db.get_media_pack_location(path) is None
+
+
+@pytest.mark.asyncio
+async def test_quota_eviction_tracks_media_bytes(db, tmp_path):
+    """容量淘汰：媒体字节数增量维护，先淘汰最大/最久未用的媒体，再删除最早的消息"""
+    for i, size in enumerate((10, 300, 20), start=1):
+        blob = tmp_path / f"doc_{i}"
+        blob.write_bytes(b"x" * size)
+        await db.register_media_blob(str(blob), f"hash-{i}", size, f"doc:{i}")
+    assert db.media_bytes == 330
+
+    count, size, paths = await db.evict_media_blobs(1, order="largest")
+    assert (count, size, paths) == (1, 300, [str(tmp_path / "doc_2")])
+    count, size, paths = await db.evict_media_blobs(5, order="oldest")
+    assert count == 2 and size == 30
+    assert db.media_bytes == 0
+
+    for i in range(1, 6):
+        db.save_message(_make_message(i))
+    assert db.flush_ingest_queue(timeout=5)
+    assert await db.get_database_bytes() > 0
+    deleted, _ = await db.evict_oldest_messages(batch_size=2)
+    assert deleted == 1  # 只删除最早那一秒的消息
+    assert db.get_message(-1001, 1) is None
+    assert db.get_message(-1001, 2) is not None
+
+
+@pytest.mark.asyncio
+async def test_media_bytes_unchanged_when_transaction_rolls_back(db, tmp_path):
+    """登记媒体的事务失败回滚时，媒体字节数保持不变"""
+    blob = tmp_path / "doc_8"
+    blob.write_bytes(b"x" * 40)
+    await db.register_media_blob(str(blob), "hash-8", 40, "doc:8")
+    assert db.media_bytes == 40
+
+    # 替换同一路径的旧记录后插入新记录失败，整个事务回滚
+    await db.pool.write(lambda conn: conn.execute(
+        "CREATE TRIGGER fail_insert BEFORE INSERT ON media_blobs BEGIN SELECT RAISE(ABORT, 'boom'); END"
+    ))
+    await db.register_media_blob(str(blob), "hash-8b", 70, "doc:8b")
+    assert db.media_bytes == 40
+    sizes = db.pool.read_sync(lambda conn: conn.execute("SELECT path, size FROM media_blobs").fetchall())
+    assert [tuple(row) for row in sizes] == [(str(blob), 40)]
+
+
+@pytest.mark.asyncio
+async def test_legacy_media_files_are_counted_and_evictable(tmp_path, monkeypatch):
+    """升级时登记去重之前按消息保存的媒体文件：计入媒体字节数，并按时间从旧到新淘汰"""
+    monkeypatch.chdir(tmp_path)
+    db_path = tmp_path / "legacy_media.db"
+    DatabaseManager(db_path=str(db_path)).close()
+    (tmp_path / "media").mkdir()
+    for name, size in (("old.jpg", 100), ("new.mp4", 250)):
+        (tmp_path / "media" / name).write_bytes(b"x" * size)
+    rows = [
+        (1, "media/old.jpg", 1_700_000_000),
+        (2, "media/new.mp4", 1_700_000_100),
+        (3, "media/old.jpg", 1_700_000_050),  # 同一文件在另一批次中再次被引用
+        (4, "media/missing.png", 1_700_000_200),
+        (5, None, 1_700_000_300),
+    ]
+    conn = sqlite3.connect(db_path)
+    conn.executemany(
+        "INSERT INTO messages (id, from_id, chat_id, type, msg_text, media_path, created_time, edited_time) "
+        "VALUES (?, 42, -1001, 3, 'legacy', ?, ?, 0)",
+        rows,
+    )
+    conn.execute("PRAGMA user_version = 9")
+    conn.commit()
+    assert run_migrations(conn, batch_size=2) == LATEST_VERSION
+    conn.close()
+
+    manager = DatabaseManager(db_path=str(db_path))
+    try:
+        assert manager.media_bytes == 350
+        refcounts = manager.pool.read_sync(
+            lambda c: dict(c.execute("SELECT path, refcount FROM media_blobs").fetchall())
+        )
+        assert refcounts == {"media/old.jpg": 2, "media/new.mp4": 1}
+
+        assert await manager.evict_media_blobs(1, order="oldest") == (1, 100, ["media/old.jpg"])
+        assert manager.media_bytes == 250
+        assert manager.get_message(-1001, 1).media_path is None
+        assert manager.get_message(-1001, 2).media_path == "media/new.mp4"
+    finally:
+        manager.close()
+
+
+@pytest.mark.asyncio
+async def test_evicted_blob_redownload_survives_old_reference_expiry(db, tmp_path, monkeypatch):
+    """淘汰后重新下载到同一去重路径，旧消息过期不影响新文件"""
+    monkeypatch.chdir(tmp_path)
+    blob = tmp_path / "media" / "blobs" / "doc_7"
+    blob.parent.mkdir(parents=True)
+    blob.write_bytes(b"x")
+    path = await db.register_media_blob(str(blob), "hash-7", 1, "doc:7")
+    old = datetime.now(timezone.utc) - timedelta(days=10)
+    db.save_message(replace(_make_message(1), msg_type=1, created_time=old, media_path=path))
+    assert db.flush_ingest_queue(timeout=5)
+
+    assert (await db.evict_media_blobs(1))[2] == [path]
+    blob.unlink()
+    assert db.get_message(-1001, 1).media_path is None
+
+    blob.write_bytes(b"x")
+    assert await db.register_media_blob(str(blob), "hash-7", 1, "doc:7") == path
+    db.save_message(replace(_make_message(2), msg_type=1, created_time=datetime.now(timezone.utc), media_path=path))
+    assert db.flush_ingest_queue(timeout=5)
+
+    monkeypatch.setattr(DatabaseManager, "MEDIA_BLOB_GRACE_SECONDS", -1)
+    stats = await db.delete_expired_messages({"user": 1}, pause=0)
+    assert stats.deleted_rows == 1 and stats.deleted_files == 0
+    assert blob.exists()
+    refcount = db.pool.read_sync(
+        lambda conn: conn.execute("SELECT refcount FROM media_blobs WHERE path = ?", (path,)).fetchone()[0]
+    )
+    assert refcount == 1
+
+
+def test_legacy_timestamps_are_migrated_to_integers(tmp_path):
+    """旧版 ISO 字符串时间戳分批迁移为整数时间戳，原始消息的重复行被合并"""
+    db_path = tmp_path / "legacy.db"
+    conn = sqlite3.connect(db_path)
+    conn.execute("""
+        CREATE TABLE messages (
+            id INTEGER, from_id INTEGER, chat_id INTEGER, type INTEGER,
+            msg_text TEXT, media_path TEXT, noforwards INTEGER DEFAULT 0,
+            self_destructing INTEGER DEFAULT 0, created_time TIMESTAMP, edited_time TIMESTAMP,
+            PRIMARY KEY (chat_id, id, edited_time)
+        )
+    """)
+    rows = [
+        (1, 42, -1001, 3, "one", None, 0, 0, "2024-01-01 12:00:00+00:00", None),
+        (1, 42, -1001, 3, "one", None, 0, 0, "2024-01-01 12:00:00+00:00", None),
+        (1, 42, -1001, 3, "one edited", None, 0, 0, "2024-01-01 12:00:00+00:00", "2024-01-01 13:30:00.500000+00:00"),
+        (2, 42, -1001, 3, "two", None, 0, 0, "2024-01-02 08:00:00+08:00", None),
+        (3, 42, -1002, 3, "three", None, 0, 0, "2024-01-03 00:00:00+00:00", None),
+    ]
+    conn.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    conn.commit()
+
+    assert run_migrations(conn, batch_size=2) == LATEST_VERSION
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == LATEST_VERSION
+    assert conn.execute("SELECT typeof(created_time), typeof(edited_time) FROM messages LIMIT 1").fetchone() == ("integer", "integer")
+    assert conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0] == 4
+    conn.close()
+
+    manager = DatabaseManager(db_path=str(db_path))
+    try:
+        original = manager.get_message(-1001, 1)
+        latest = manager.get_message(-1001, 1, version='latest')
+        assert original.msg_text == "one" and original.edited_time is None
+        assert original.created_time == datetime(2024, 1, 1, 12, 0, tzinfo=timezone.utc)
+        assert latest.edited_time == datetime(2024, 1, 1, 13, 30, tzinfo=timezone.utc)
+        assert manager.get_message(-1001, 2).created_time == datetime(2024, 1, 2, 0, 0, tzinfo=timezone.utc)
+        # 迁移时回填全文索引
+        indexed = manager.pool.read_sync(lambda c: c.execute("SELECT COUNT(*) FROM messages_fts").fetchone()[0])
+        assert indexed == 4
+    finally:
+        manager.close()
+
+
+@pytest.mark.asyncio
+async def test_fulltext_index_survives_vacuum(db):
+    """消息表使用显式 rowid 主键，VACUUM 之后全文索引仍指向正确的消息"""
+    columns = db.pool.read_sync(lambda conn: [row[1] for row in conn.execute("PRAGMA table_info(messages)")])
+    assert columns[0] == "msg_rowid"
+    for msg_id in range(1, 21):
+        db.save_message(_make_message(msg_id, text=f"第 {msg_id} 条 {'关键字' if msg_id % 5 == 0 else '普通'}消息"))
+    assert db.flush_ingest_queue(timeout=5)
+    await db.pool.write(lambda conn: conn.execute("DELETE FROM messages WHERE id < 5"))
+
+    db.pool.write_sync(lambda conn: conn.execute("VACUUM"))
+    assert [m.id for m in await db.search_messages("关键字")] == [20, 15, 10, 5]
+
+
+def test_delta_roundtrip():
+    base = "第一版：" + "长文本内容 " * 50
+    text = base.replace("第一版", "第二版") + "追加的一行"
+    assert apply_delta(base, make_delta(base, text)) == text
+    assert apply_delta(text, make_delta(text, "")) == ""
+
+
+def test_edit_history_is_stored_as_deltas(db):
+    """长消息的多次编辑以差量存储，所有版本均可完整还原"""
+    base_text = "频道公告 " + " ".join(f"条目{i}: 详细说明" for i in range(200))
+    versions = [base_text] + [base_text + f" 更新 {n}" for n in range(1, 31)]
+    db.save_message(_make_message(9, text=versions[0]))
+    for n in range(1, 16):
+        db.save_message(_make_message(9, text=versions[n], edited_time=datetime(2024, 1, 2, 0, n, tzinfo=timezone.utc)))
+    assert db.flush_ingest_queue(timeout=5)  # 剩余版本的基准版本来自数据库
+    for n in range(16, 31):
+        db.save_message(_make_message(9, text=versions[n], edited_time=datetime(2024, 1, 2, 0, n, tzinfo=timezone.utc)))
+    assert db.flush_ingest_queue(timeout=5)
+
+    def _load(conn):
+        rows = conn.execute("SELECT * FROM messages WHERE chat_id = -1001 AND id = 9 ORDER BY edited_time").fetchall()
+        return [r["text_codec"] for r in rows], [db._row_to_message(r, conn).msg_text for r in rows], \
+            sum(len(r["text_blob"] or b"") + len((r["msg_text"] or "").encode()) for r in rows)
+
+    codecs, texts, stored = db.pool.read_sync(_load)
+    assert texts == versions
+    assert codecs[0] == TEXT_ZLIB
+    assert codecs.count(TEXT_DELTA) >= 27  # 每 16 个版本一个关键帧
+    assert stored * 10 < sum(len(v.encode()) for v in versions)
+    assert db.get_message(-1001, 9, version='latest').msg_text == versions[-1]
+
+
+@pytest.mark.asyncio
+async def test_search_messages_uses_fulltext_index(db):
+    """全文搜索支持中文子串、聊天/时间过滤和分页，编辑版本只返回最新的匹配版本"""
+    assert db.fts_enabled
+    db.save_message(_make_message(1, text="今天发布了新版本 Release"))
+    db.save_message(_make_message(2, text="新版本修复了若干问题"))
+    db.save_message(_make_message(3, chat_id=-2002, text="另一个聊天中的新版本"))
+    db.save_message(_make_message(4, text="无关内容"))
+    db.save_message(_make_message(4, text="无关内容，补充：新版本链接", edited_time=datetime(2024, 1, 2, tzinfo=timezone.utc)))
+    assert db.flush_ingest_queue(timeout=5)
+
+    found = await db.search_messages("新版本")
+    assert [(m.chat_id, m.id) for m in found] == [(-1001, 4), (-2002, 3), (-1001, 2), (-1001, 1)]
+    assert found[0].edited_time is not None
+    assert [m.id for m in await db.search_messages("新版本", chat_id=-1001, limit=2, offset=1)] == [2, 1]
+    assert [m.id for m in await db.search_messages("release 新版本")] == [1]
+    assert await db.search_messages("新版本", since=datetime(2025, 1, 1, tzinfo=timezone.utc)) == []
+    # 少于 3 个字符的词退回逐行匹配
+    assert [m.id for m in await db.search_messages("版本", chat_id=-1001)] == [4, 2, 1]
+
+    plan = db.pool.read_sync(lambda conn: " ".join(
+        row[3] for row in conn.execute(
+            "EXPLAIN QUERY PLAN SELECT m.* FROM messages_fts JOIN messages m ON m.msg_rowid = messages_fts.rowid "
+            "WHERE messages_fts MATCH ?", ('"新版本"',)
+        )
+    ))
+    assert "VIRTUAL TABLE INDEX" in plan and "SEARCH m USING INTEGER PRIMARY KEY" in plan
+
+    # 过期清理同时移除全文索引条目
+    await db.delete_expired_messages({"group": 1}, pause=0)
+    assert db.pool.read_sync(lambda conn: conn.execute("SELECT COUNT(*) FROM messages_fts").fetchone()[0]) == 0
+
+
+@pytest.mark.asyncio
+async def test_partitioned_storage_routes_reads_and_drops_expired_partitions(tmp_path):
+    """分区模式下消息按天写入分区表，读取跨分区路由，过期分区整表删除"""
+    manager = DatabaseManager(
+        db_path=str(tmp_path / "partitioned.db"), ingest_flush_interval=0.05, partition_period="day"
+    )
+    try:
+        now = datetime.now(timezone.utc)
+        old = now - timedelta(days=10)
+        manager.save_message(replace(_make_message(1, text="旧消息内容"), created_time=old))
+        manager.save_message(replace(_make_message(1, text="旧消息内容 已编辑"), created_time=old, edited_time=old + timedelta(minutes=5)))
+        manager.save_message(replace(_make_message(2, text="新消息内容"), created_time=now))
+        assert manager.flush_ingest_queue(timeout=5)
+
+        tables = manager.partitions.tables()
+        assert len(tables) == 3 and tables[-1] == "messages"
+        assert manager.get_message(-1001, 1).msg_text == "旧消息内容"
+        assert manager.get_message(-1001, 1, version='latest').msg_text == "旧消息内容 已编辑"
+        assert set(await manager.get_messages_bulk(-1001, [1, 2])) == {1, 2}
+        assert [m.id for m in await manager.search_messages("消息内容")] == [2, 1]
+        assert [m.id for m in await manager.get_messages_before(-1001, 3, 10)] == [1, 1, 2]
+        # 没有时间戳的查找只查询 ID 范围包含该消息的分区
+        assert manager.partitions.tables_for_ids([2], -1001) == [tables[0], "messages"]
+        assert manager.partitions.tables_for_ids([1]) == [tables[1], "messages"]
+        assert manager.partitions.tables_for_ids([1], -2002) == ["messages"]
+
+        stats = await manager.delete_expired_messages({"group": 5, "user": 1}, pause=0)
+        assert stats.dropped_partitions == 1
+        assert stats.deleted_rows == 2 and stats.batches == 0
+        assert manager.get_message(-1001, 1) is None
+        assert manager.get_message(-1001, 2).msg_text == "新消息内容"
+        names = manager.pool.read_sync(
+            lambda conn: [r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE name LIKE 'messages_p%'")]
+        )
+        assert not any(name.startswith(f"messages_p{old:%Y%m%d}") for name in names)
+        assert manager.pool.read_sync(lambda conn: conn.execute("PRAGMA freelist_count").fetchone()[0]) == 0
+    finally:
+        manager.close()
+
+    # 重启后从数据库加载 ID 范围，已删除分区的范围随之移除
+    reopened = DatabaseManager(db_path=str(tmp_path / "partitioned.db"), partition_period="day")
+    try:
+        assert reopened.partitions.tables_for_ids([1, 2], -1001) == [tables[0], "messages"]
+        assert reopened.get_message(-1001, 2).msg_text == "新消息内容"
+    finally:
+        reopened.close()
+
+
+def test_hot_cache_evicts_by_chat_and_bytes():
+    cache = HotMessageCache(per_chat=2, max_bytes=10_000)
+    for msg_id in range(1, 4):
+        cache.put(_make_message(msg_id))
+    assert cache.get(-1001, 1) is None
+    assert [m.id for m in cache.get(-1001, 3)] == [3]
+    cache.put(_make_message(3, text="edited", edited_time=datetime(2024, 1, 2, tzinfo=timezone.utc)))
+    assert len(cache.get(-1001, 3)) == 2
+    # 超出内存上限时先淘汰最久未使用的聊天
+    for chat_id in range(-2000, -2040, -1):
+        cache.put(_make_message(1, chat_id=chat_id, text="x" * 100))
+    assert cache.size <= 10_000
+    assert cache.get(-1001, 3) is None
+    assert cache.hits == 2 and cache.misses == 2 and cache.evictions > 1
+
+
+def test_lookups_read_through_hot_cache(db, monkeypatch):
+    db.save_message(_make_message(1, text="cached"))
+    db.save_message(_make_message(1, text="cached edit", edited_time=datetime(2024, 1, 2, tzinfo=timezone.utc)))
+    # 未刷新写入队列也能从缓存读到，且不访问数据库
+    def _no_db_access(*args, **kwargs):
+        raise AssertionError("热缓存命中时不应访问数据库")
+
+    monkeypatch.setattr(db.pool, "read_sync", _no_db_access)
+    assert db.get_message(-1001, 1).msg_text == "cached"
+    assert db.get_message(-1001, 1, version='latest').msg_text == "cached edit"
+    assert db.get_message_by_id(1).msg_text == "cached"
+    assert db.hot_cache.hits == 3
+    monkeypatch.undo()
+
+    # 只缓存了编辑版本时，原始版本回落到数据库
+    assert db.flush_ingest_queue(timeout=5)
+    db.hot_cache.clear()
+    db.hot_cache.put(_make_message(1, text="cached edit", edited_time=datetime(2024, 1, 2, tzinfo=timezone.utc)))
+    assert db.get_message(-1001, 1).msg_text == "cached"
+
+
+@pytest.mark.asyncio
+async def test_entity_cache_persists_across_restarts(tmp_path):
+    """实体信息缓存：内容未变化时不重复回写，关闭后从 entities 表恢复"""
+    from telegram_logger.data.models import EntityInfo
+
+    db_path = str(tmp_path / "messages.db")
+    manager = DatabaseManager(db_path=db_path, entity_cache_ttl=3600)
+    cache = manager.entity_cache
+    cache.put(EntityInfo(42, "user", "Doe John", "jdoe"))
+    cache.put(EntityInfo(-1001, "group", "Test Group"))
+    assert cache.get(42).username == "jdoe"
+    assert await cache.lookup(7) is None
+    manager.close()
+
+    manager = DatabaseManager(db_path=db_path, entity_cache_ttl=3600)
+    try:
+        info = await manager.entity_cache.lookup(-1001)
+        assert (info.kind, info.name) == ("group", "Test Group")
+        assert manager.entity_cache.stats()["hits"] == 1
+    finally:
+        manager.close()
+
+    # 过期的实体不会被 lookup 返回，但可作为获取失败时的回退
+    manager = DatabaseManager(db_path=db_path, entity_cache_ttl=0)
+    try:
+        assert await manager.entity_cache.lookup(42) is None
+        assert manager.entity_cache.get(42, allow_stale=True).name == "Doe John"
+    finally:
+        manager.close()
+
+
+class _FakeEntityClient:
+    """只支持列表形式 get_entity 的假客户端，记录每次调用的 ID。"""
+
+    def __init__(self):
+        self.calls = []
+
+    async def get_entity(self, ids):
+        from telethon.tl.types import User
+
+        self.calls.append(ids)
+        return [User(id=i, first_name=f"User{i}") for i in ids]
+
+
+@pytest.mark.asyncio
+async def test_entity_resolver_batches_misses(tmp_path):
+    """批量解析：去重后只为缓存未命中的 ID 发起一次 get_entity"""
+    from telegram_logger.data.models import EntityInfo
+    from telegram_logger.utils.mentions import EntityResolver, render_mention
+
+    manager = DatabaseManager(db_path=str(tmp_path / "messages.db"))
+    try:
+        manager.entity_cache.put(EntityInfo(1, "user", "Cached"))
+        client = _FakeEntityClient()
+        resolver = EntityResolver(client, manager.entity_cache)
+
+        resolved = await resolver.resolve([1, 2, 3, 2, None])
+        assert client.calls == [[2, 3]]
+        assert render_mention(resolved, 1) == "[Cached](tg://user?id=1)"
+        assert render_mention(resolved, 3) == "[User3](tg://user?id=3)"
+        assert render_mention(resolved, 4) == "4"
+
+        await resolver.resolve([1, 2, 3])
+        assert len(client.calls) == 1
+    finally:
+        manager.close()
+
+
+def test_chat_restriction_cache_follows_chat_updates():
+    """转发限制缓存：由实体填充，聊天更新携带实体时刷新，否则失效"""
+    from telethon.tl.types import Channel, ChatPhotoEmpty, UpdateChannel, User
+
+    from telegram_logger.data.restriction_cache import ChatRestrictionCache
+
+    def channel(noforwards):
+        return Channel(id=123, title="Chan", photo=ChatPhotoEmpty(), date=None, noforwards=noforwards)
+
+    cache = ChatRestrictionCache()
+    cache.observe(channel(True), User(id=5), None)
+    assert cache.is_restricted(-1000000000123) is True
+    assert cache.is_restricted(5) is None
+
+    update = UpdateChannel(channel_id=123)
+    update._entities = {-1000000000123: channel(False)}
+    cache.handle_update(update)
+    assert cache.is_restricted(-1000000000123) is False
+
+    cache.handle_update(UpdateChannel(channel_id=123))
+    assert cache.is_restricted(-1000000000123) is None
+    assert cache.stats()["hits"] == 2
+
+
+@pytest.mark.asyncio
+async def test_persistence_signals_wake_waiters():
+    """持久化完成通知：等待方在完成时立即返回，未开始的消息不算正在持久化"""
+    import asyncio
+
+    from telegram_logger.data.persistence_signals import PersistenceSignals
+
+    signals = PersistenceSignals()
+    assert not signals.is_pending(-100, 1)
+    # 未跟踪的消息立即返回，不创建条目
+    assert await signals.wait(-100, 2, timeout=5) is False
+    assert signals.waits == 0 and not signals._entries
+
+    signals.begin(-100, 1)
+    assert signals.is_pending(-100, 1)
+    row_waiter = asyncio.create_task(signals.wait(-100, 1, timeout=5))
+    media_waiter = asyncio.create_task(signals.wait(-100, 1, timeout=5, media=True))
+    await asyncio.sleep(0)
+
+    signals.finish_row(-100, 1, media_pending=True)
+    assert await row_waiter is True
+    assert not media_waiter.done()
+    signals.finish_media(-100, 1)
+    assert await media_waiter is True
+
+    # 编辑重新开始持久化后，通知重新变为未完成
+    signals.begin(-100, 1)
+    assert await signals.wait(-100, 1, timeout=0.01) is False
+    assert signals.timeouts == 1
@@ -0,0 +1,84 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from telethon import events
+from telethon.tl import types
+
+from telegram_logger.handlers.pipeline import EventPipeline
+from telegram_logger.services.event_queue import ShardedEventQueue
+
+
+@pytest.mark.asyncio
+async def test_private_chats_progress_independently():
+    """一个私聊的慢处理不会阻塞其他私聊和普通群组，无法确定聊天的事件使用单独的分片"""
+    processed = []
+    release = asyncio.Event()
+
+    async def handler(item):
+        if item == ("new", 777):
+            await release.wait()  # 慢的保存/转发
+        processed.append(item)
+
+    queue = ShardedEventQueue(handler, workers=4, capacity=100)
+    await queue.start()
+    try:
+        await queue.put(777, ("new", 777))
+        await queue.put(778, ("new", 778))
+        await queue.put(-12346, ("new", -12346))
+        await queue.put(None, ("deleted", None))
+        for _ in range(20):
+            if len(processed) == 3:
+                break
+            await asyncio.sleep(0.01)
+        assert sorted(processed, key=str) == sorted([("new", 778), ("new", -12346), ("deleted", None)], key=str)
+    finally:
+        release.set()
+        await queue.stop()
+
+    assert processed[-1] == ("new", 777)
+    assert queue.shard_for(None) == 0
+    assert 0 not in {queue.shard_for(chat_id) for chat_id in (777, 778, -12346, -1001234567890)}
+
+
+@pytest.mark.asyncio
+async def test_chatless_delete_is_routed_to_its_chat():
+    """不带 chat_id 的删除事件按被删除消息所在的聊天分片，不会越过该聊天的新消息"""
+
+    class FakeDB:
+        async def get_messages_bulk(self, chat_id, message_ids):
+            assert chat_id is None
+            stored = {9: SimpleNamespace(chat_id=-12345), 11: SimpleNamespace(chat_id=-1001234567890)}
+            return {msg_id: stored[msg_id] for msg_id in message_ids if msg_id in stored}
+
+    pipeline = EventPipeline(FakeDB())
+    new = events.NewMessage.Event(types.Message(id=5, peer_id=types.PeerUser(777), date=None, message="hi"))
+    assert await pipeline.queue_key(new) == 777
+
+    # 刚入队、尚未保存的消息
+    assert await pipeline.queue_key(events.MessageDeleted.Event(deleted_ids=[5], peer=None)) == 777
+    # 已保存的消息，从数据库 id 索引查找；频道中同 ID 的消息不采用
+    assert await pipeline.queue_key(events.MessageDeleted.Event(deleted_ids=[9], peer=None)) == -12345
+    assert await pipeline.queue_key(events.MessageDeleted.Event(deleted_ids=[11, 12], peer=None)) is None
+
+
+@pytest.mark.asyncio
+async def test_events_put_while_stopping_are_queued_behind_pending_ones():
+    """停止时先处理完已入队的事件，期间到达的事件排在其后，不会被直接处理而插队"""
+    processed = []
+    queue = None
+
+    async def handler(item):
+        if item == "first":
+            await asyncio.sleep(0.05)
+            await queue.put(1, "late")  # 停止过程中到达
+        processed.append(item)
+
+    queue = ShardedEventQueue(handler, workers=1, capacity=10)
+    await queue.start()
+    await queue.put(1, "first")
+    await queue.put(1, "second")
+    await queue.stop()
+
+    assert processed == ["first", "second", "late"]
+    assert queue.stats()["enqueued"] == 3
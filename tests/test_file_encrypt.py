@@ -0,0 +1,277 @@
+import asyncio
+import io
+import os
+
+import pyAesCrypt
+import pytest
+
+from telegram_logger.utils.crypto_executor import CryptoExecutor
+from telegram_logger.utils.file_encrypt import (
+    CONTAINER_CHUNK_SIZE,
+    PARTIAL_SUFFIX,
+    ChunkedDecryptingReader,
+    ChunkedEncryptingWriter,
+    EncryptingWriter,
+    convert_legacy_file,
+    decrypted,
+    decrypted_async,
+    encrypt_container,
+    encrypted,
+    encrypted_async,
+    is_legacy_format,
+)
+from telegram_logger.utils.media_pack import MediaPackStore
+from telegram_logger.utils.parallel_download import SEGMENT_SIZE, ParallelDownloader
+
+PASSWORD = "test-password"
+
+
+def _write_in_pieces(writer, payload, piece=777):
+    # 模拟 iter_download 的不规则分块
+    for start in range(0, len(payload), piece):
+        writer.write(payload[start:start + piece])
+
+
+@pytest.mark.parametrize("size", [0, 1, 15, 16, 17, 4096, 100_003])
+def test_legacy_writer_is_pyaescrypt_compatible(tmp_path, size):
+    path = str(tmp_path / "media")
+    payload = os.urandom(size)
+
+    writer = EncryptingWriter(path, PASSWORD)
+    _write_in_pieces(writer, payload)
+    writer.commit()
+
+    out = io.BytesIO()
+    with open(path, "rb") as f_in:
+        pyAesCrypt.decryptStream(f_in, out, PASSWORD)
+    assert out.getvalue() == payload
+
+    with decrypted(path, PASSWORD) as f:
+        assert f.read() == payload
+
+
+@pytest.mark.parametrize("size", [0, 1, 63, 64, 65, 128, 1000])
+def test_container_roundtrip_and_random_access(tmp_path, size):
+    path = str(tmp_path / "media")
+    payload = os.urandom(size)
+
+    writer = ChunkedEncryptingWriter(path, PASSWORD, chunk_size=64)
+    _write_in_pieces(writer, payload, piece=50)
+    assert os.path.exists(path + PARTIAL_SUFFIX) and not os.path.exists(path)
+    writer.commit()
+    assert not os.path.exists(path + PARTIAL_SUFFIX)
+
+    with decrypted(path, PASSWORD) as f:
+        assert isinstance(f, ChunkedDecryptingReader)
+        assert f.seek(0, os.SEEK_END) == size
+        f.seek(0)
+        assert f.read() == payload
+        for offset in (0, 1, 63, 64, size // 2, max(size - 5, 0)):
+            f.seek(offset)
+            assert f.read(70) == payload[offset:offset + 70]
+
+
+def test_container_rejects_tampering_and_truncation(tmp_path):
+    path = str(tmp_path / "media")
+    with encrypted(path, PASSWORD) as f:
+        f.write(os.urandom(200_000))
+
+    with pytest.raises(ValueError):
+        with decrypted(path, "wrong-password") as f:
+            f.read()
+
+    with open(path, "r+b") as f:
+        f.seek(-100, os.SEEK_END)
+        byte = f.read(1)
+        f.seek(-100, os.SEEK_END)
+        f.write(bytes([byte[0] ^ 1]))
+    with decrypted(path, PASSWORD) as f:
+        f.read(1000)  # 前面的块不受影响
+        with pytest.raises(ValueError):
+            f.read()
+
+    # 在块边界截断：剩余的最后一块并非以“最后一块”加密
+    with open(path, "r+b") as f:
+        f.truncate(os.stat(path).st_size - 200_000 % CONTAINER_CHUNK_SIZE - 16)
+    with decrypted(path, PASSWORD) as f:
+        with pytest.raises(ValueError):
+            f.read()
+
+
+def test_convert_legacy_file(tmp_path):
+    path = str(tmp_path / "media")
+    payload = os.urandom(150_000)
+    with open(path, "wb") as f_out:
+        pyAesCrypt.encryptStream(io.BytesIO(payload), f_out, PASSWORD)
+
+    assert is_legacy_format(path)
+    assert convert_legacy_file(path, PASSWORD)
+    assert not is_legacy_format(path)
+    assert not convert_legacy_file(path, PASSWORD)
+    with decrypted(path, PASSWORD) as f:
+        assert f.read() == payload
+
+
+def test_streaming_encrypt_aborts_on_error(tmp_path):
+    path = str(tmp_path / "media")
+
+    with pytest.raises(RuntimeError):
+        with encrypted(path, PASSWORD) as f:
+            f.write(b"partial download")
+            raise RuntimeError("connection lost")
+
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + PARTIAL_SUFFIX)
+
+
+def _encrypt_with_pyaescrypt(path, payload):
+    with open(path, "wb") as f_out:
+        pyAesCrypt.encryptStream(io.BytesIO(payload), f_out, PASSWORD)
+
+
+@pytest.mark.parametrize("size", [0, 15, 16, 33, 100_003])
+def test_streaming_decrypt_random_access(tmp_path, size):
+    path = str(tmp_path / "media")
+    payload = os.urandom(size)
+    _encrypt_with_pyaescrypt(path, payload)
+
+    with decrypted(path, PASSWORD) as f:
+        assert f.seekable()
+        assert f.seek(0, os.SEEK_END) == size
+        f.seek(0)
+        # 按 Telethon 上传的方式分块顺序读取
+        parts = iter(lambda: f.read(4096), b"")
+        assert b"".join(parts) == payload
+        for offset in (0, 1, 17, size // 2, max(size - 5, 0)):
+            f.seek(offset)
+            assert f.read(40) == payload[offset:offset + 40]
+
+
+def test_streaming_decrypt_detects_tampering(tmp_path):
+    path = str(tmp_path / "media")
+    _encrypt_with_pyaescrypt(path, os.urandom(1000))
+
+    with pytest.raises(ValueError):
+        with decrypted(path, "wrong-password"):
+            pass
+
+    with open(path, "r+b") as f:
+        f.seek(-100, os.SEEK_END)
+        byte = f.read(1)
+        f.seek(-100, os.SEEK_END)
+        f.write(bytes([byte[0] ^ 1]))
+    with decrypted(path, PASSWORD) as f:
+        with pytest.raises(ValueError):
+            f.read()
+
+
+@pytest.mark.asyncio
+async def test_async_roundtrip_runs_in_executor(tmp_path):
+    executor = CryptoExecutor(max_workers=2)
+    path = str(tmp_path / "media")
+    payload = os.urandom(300_000)
+
+    async with encrypted_async(path, PASSWORD, executor) as f:
+        for start in range(0, len(payload), 65536):
+            await f.write(payload[start:start + 65536])
+
+    async with decrypted_async(path, PASSWORD, executor) as f:
+        assert f.seek(0, os.SEEK_END) == len(payload)
+        f.seek(0)
+        parts = []
+        while chunk := await f.read(131072):
+            parts.append(chunk)
+    assert b"".join(parts) == payload
+
+    stats = executor.stats()
+    executor.shutdown()
+    assert stats["queued"] == 0 and stats["running"] == 0
+    assert stats["jobs"]["derive_key"]["count"] == 2
+    assert stats["jobs"]["encrypt"]["count"] == 5
+    # 128KB 的读取跨越两个 64KB 块，分别提交到线程池并行解密；最后一块和末尾的空读取各一次
+    assert stats["jobs"]["decrypt"]["count"] == 6
+
+
+class _FakeDownloadClient:
+    """按 offset/limit/request_size 返回字节切片，并记录最大并发数。"""
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.active = 0
+        self.max_active = 0
+
+    async def iter_download(self, media, *, offset=0, limit=None, request_size=None, file_size=None):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            for i in range(limit):
+                await asyncio.sleep(0)
+                start = offset + i * request_size
+                if start >= len(self.payload):
+                    return
+                yield self.payload[start:start + request_size]
+        finally:
+            self.active -= 1
+
+
+@pytest.mark.asyncio
+async def test_parallel_download_reassembles_in_order():
+    payload = os.urandom(5 * SEGMENT_SIZE + 12345)
+    client = _FakeDownloadClient(payload)
+    downloader = ParallelDownloader(per_file=3, max_global=2)
+
+    parts = [chunk async for chunk in downloader.iter_download(client, None, len(payload))]
+
+    assert b"".join(parts) == payload
+    assert client.max_active == 2
+
+
+@pytest.mark.asyncio
+async def test_pack_store_entries_decrypt_in_place(tmp_path):
+    store = MediaPackStore(str(tmp_path / "packs"), max_pack_size=150_000)
+    payloads = [os.urandom(n) for n in (0, 1000, CONTAINER_CHUNK_SIZE, 100_000, 70_000)]
+    locations = []
+    for payload in payloads:
+        container = encrypt_container(payload, PASSWORD)
+        locations.append((*store.append(container), len(container)))
+    store.close()
+
+    # 超过 max_pack_size 时换用新文件，之前的文件变为可压缩
+    assert len({location[0] for location in locations}) == 3
+    assert store.sealed_packs() == sorted({location[0] for location in locations})[:2]
+
+    for payload, (pack_path, offset, length) in zip(payloads, locations):
+        async with decrypted_async(pack_path, PASSWORD, offset=offset, length=length) as f:
+            assert f.size == len(payload)
+            f.seek(len(payload) // 2)
+            assert await f.read() == payload[len(payload) // 2:]
+
+    # 重启后继续写入未写满的最新打包文件
+    assert MediaPackStore(str(tmp_path / "packs"), max_pack_size=150_000).active_path == locations[-1][0]
+
+
+@pytest.mark.asyncio
+async def test_packed_sticker_is_opened_by_logical_path(tmp_path):
+    """打包保存的贴纸只有逻辑路径，发送时须通过数据库定位打包文件并解密"""
+    from telegram_logger.data.database import DatabaseManager
+    from telegram_logger.utils.media import FILE_PASSWORD, retrieve_media_as_file, retrieve_restricted_media
+
+    sticker = b"RIFF\x00\x00\x00\x00WEBPVP8 " + os.urandom(3000)
+    store = MediaPackStore(str(tmp_path / "packs"))
+    container = encrypt_container(sticker, FILE_PASSWORD)
+    pack_path, offset = store.append(container)
+    store.close()
+
+    db = DatabaseManager(db_path=str(tmp_path / "messages.db"))
+    try:
+        path = await db.register_media_blob(
+            "media/blobs/doc_9", "hash-9", len(sticker), "doc:9", pack_location=(pack_path, offset, len(container))
+        )
+        with pytest.raises(FileNotFoundError):
+            with retrieve_media_as_file(path):
+                pass
+        async with retrieve_restricted_media(path, db) as f:
+            assert f.name == "doc_9"
+            assert await f.read() == sticker
+    finally:
+        db.close()